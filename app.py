@@ -2,25 +2,54 @@
 
 # --- 1. 导入所有需要的库 ---
 import os
+import atexit
+import base64
+import cProfile
+import hashlib
+import html
+import json
+import queue
+import random
+import re
+import select
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from functools import wraps
+from itertools import islice
+import click
 import jwt
-import requests
-import mistune # 你之前用到了 mistune，需要导入它
-from flask import Flask, jsonify, request
+from itsdangerous import BadSignature, TimestampSigner
+from flask import Flask, Response, g, has_request_context, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, desc, or_ # 你代码后面用到了这些，也需要导入
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy import Select, and_, case, create_engine, delete, func, desc, insert, inspect, or_, select as sa_select, text, tuple_, update # 你代码后面用到了这些，也需要导入
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session, contains_eager, joinedload
 from werkzeug.security import generate_password_hash, check_password_hash # 强烈建议使用的安全工具
+# 可选依赖：装了就用更快的 JSON 编码和 brotli 压缩，没装退回标准库 / gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 # --- 2. 初始化和配置 ---
 app = Flask(__name__)
 
 # 配置 CORS，允许跨域请求
-CORS(app, supports_credentials=True)
-
-# 配置 Markdown 解析器 (如果你的代码中用到了)
-# markdown_parser = mistune.create_markdown(escape=True, hard_wrap=True)
+CORS(app, supports_credentials=True, expose_headers=['X-Replica-Sticky'])
 
 # 从环境变量获取数据库 URL，并修正格式 (Heroku/Render 的常见做法)
 db_url = os.environ.get('DATABASE_URL')
@@ -36,8 +65,42 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # 配置应用的 SECRET_KEY，用于 session、flash 消息和我们的 JWT 签名
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-very-strong-default-secret-key-for-dev')
 
+# 读取数值型环境变量的小工具，各种超时、缓存大小等参数都用它
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+# 连接池参数：默认值和 SQLAlchemy 一样，另外默认打开 pre_ping 并且 30 分钟回收一次连接，
+# 避免拿到被数据库或负载均衡在空闲时断开的连接。SQLite 没有连接池大小这些选项。
+def _engine_options(url, statement_timeout_ms):
+    options = {'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1', 'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800)}
+    if url and not url.startswith('sqlite'):
+        options.update(pool_size=_env_int('DB_POOL_SIZE', 5), max_overflow=_env_int('DB_MAX_OVERFLOW', 10), pool_timeout=_env_float('DB_POOL_TIMEOUT', 30))
+        # 语句超时（毫秒，0 表示不限制）：慢查询到时间就被数据库取消，不会一直占着连接
+        if statement_timeout_ms and url.startswith('postgresql'):
+            options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout_ms}'}
+    return options
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(db_url, _env_int('DB_STATEMENT_TIMEOUT_MS', 0))
+
+# 只读副本（可选）：标了 @use_read_replica 的只读列表接口把 SELECT 发到副本上，见 4.2 节
+replica_url = os.environ.get('REPLICA_DATABASE_URL')
+if replica_url and replica_url.startswith("postgres://"):
+    replica_url = replica_url.replace("postgres://", "postgresql://", 1)
+
+class RoutingSession(FlaskSQLAlchemySession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # flush 和写语句、SELECT ... FOR UPDATE 始终走主库
+        if bind is None and not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None and _reading_from_replica():
+            return _replica_engine()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 # 初始化 SQLAlchemy 实例
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 
 
 AVATAR_CHOICES = [
@@ -65,6 +128,13 @@ class User(db.Model):
     password = db.Column(db.String(120), nullable=False)
     likes_received = db.Column(db.Integer, nullable=False, default=0)
     avatar_url = db.Column(db.String(255), nullable=True)
+    # 单词数冗余存一份，由 add_vocab / 删除单词在同一个事务里维护，排行榜不用再 GROUP BY 整张 vocabs 表
+    vocab_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 每次"退出所有设备"加一，签发的 token 里带着这个版本号
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 笔记 / 单词本每次写入加一，用作 ETag 和增量同步的游标
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (db.Index('ix_users_rank', vocab_count.desc(), likes_received.desc(), 'id'),)
   
     def to_dict(self):
         return {
@@ -80,7 +150,8 @@ class Like(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     liker_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     liked_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    __table_args__ = (db.UniqueConstraint('liker_id', 'liked_user_id', name='_liker_liked_user_uc'),)
+    # (liker_id, liked_user_id) 唯一约束兼做"我赞过谁"的索引；被赞方单独一个索引，删除用户时检查外键不用扫全表
+    __table_args__ = (db.UniqueConstraint('liker_id', 'liked_user_id', name='_liker_liked_user_uc'), db.Index('ix_likes_liked_user', 'liked_user_id'))
 
 class Note(db.Model):
     __tablename__ = 'notes'
@@ -89,14 +160,17 @@ class Note(db.Model):
     summary = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     user = db.relationship('User', backref=db.backref('notes', lazy=True, cascade="all, delete-orphan"))
+    # 笔记列表按 (user_id, created_at) 倒序读，不用再单独排序
+    __table_args__ = (db.Index('ix_notes_user_version', 'user_id', 'version'), db.Index('ix_notes_user_created', 'user_id', 'created_at'))
 
     def to_dict(self):
         return {
             'id': self.id,
             'content': self.content,
             'summary': self.summary,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
+            'created_at': self.created_at.isoformat(sep=' ', timespec='seconds')
         }
 
 class Vocab(db.Model):
@@ -106,8 +180,9 @@ class Vocab(db.Model):
     phonetic = db.Column(db.String(100))
     meaning = db.Column(db.Text, nullable=False) 
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     user = db.relationship('User', backref=db.backref('vocabs', lazy=True, cascade="all, delete-orphan"))
-    __table_args__ = (db.UniqueConstraint('user_id', 'word', name='_user_word_uc'),)
+    __table_args__ = (db.UniqueConstraint('user_id', 'word', name='_user_word_uc'), db.Index('ix_vocabs_user_version', 'user_id', 'version'))
 
     def to_dict(self):
         return {
@@ -117,6 +192,46 @@ class Vocab(db.Model):
             'meaning': self.meaning 
         }
 
+class SyncTombstone(db.Model):
+    # 删除的笔记 / 单词留一条记录，增量同步时告诉客户端哪些要删掉
+    __tablename__ = 'sync_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('ix_sync_tombstones_user_version', 'user_id', 'version'),)
+
+class SummaryJob(db.Model):
+    # 笔记摘要的后台任务队列：add_note 只负责入队，worker 线程按 run_after 顺序领取（见 4.10）
+    __tablename__ = 'summary_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('notes.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    # pending -> running -> done / failed；失败后还有重试次数就回到 pending，run_after 往后推
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    # 课程名之类的上下文，拼进提示词里
+    course_name = db.Column(db.String(200))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    note = db.relationship('Note', backref=db.backref('summary_jobs', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.Index('ix_summary_jobs_status_run_after', 'status', 'run_after'), db.Index('ix_summary_jobs_note', 'note_id'))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'note_id': self.note_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.last_error if self.status == 'failed' else None,
+            'created_at': self.created_at.isoformat() + 'Z',
+            'finished_at': self.finished_at.isoformat() + 'Z' if self.finished_at else None
+        }
+
 class Feedback(db.Model):
     __tablename__ = 'feedbacks'
     id = db.Column(db.Integer, primary_key=True)
@@ -129,7 +244,7 @@ class Feedback(db.Model):
         return {
             'id': self.id,
             'content': self.content,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'created_at': self.created_at.isoformat(sep=' ', timespec='seconds'),
             'user_id': self.user_id
         }
 
@@ -142,6 +257,24 @@ class PlazaTopic(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     author_username = db.Column(db.String(80), db.ForeignKey('users.username', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
     author = db.relationship('User', backref=db.backref('plaza_topics', lazy=True, cascade="all, delete-orphan"))
+    # 纯文本摘要，发帖时生成，信息流卡片只读这一列，不用把整篇 HTML 拉出来
+    excerpt = db.Column(db.String(300))
+    # content 是渲染好的 HTML；content_md 保存用户写的原始 Markdown，content_hash 用来判断是否需要重新渲染
+    content_md = db.Column(db.Text)
+    content_hash = db.Column(db.String(64))
+    # 去掉标签的正文，给全文搜索用：直接索引 HTML 的话搜 strong、href、class 都能命中
+    content_text = db.Column(db.Text)
+
+    EXCERPT_LENGTH = 140
+
+    @staticmethod
+    def make_plain_text(html_content):
+        return ' '.join(html.unescape(re.sub(r'<[^>]+>', ' ', html_content or '')).split())
+
+    @staticmethod
+    def make_excerpt(html_content):
+        plain = PlazaTopic.make_plain_text(html_content)
+        return plain if len(plain) <= PlazaTopic.EXCERPT_LENGTH else plain[:PlazaTopic.EXCERPT_LENGTH] + '…'
 
     def to_dict(self):
         return {
@@ -154,6 +287,11 @@ class PlazaTopic(db.Model):
             'author_avatar_url': self.author.avatar_url or AVATAR_CHOICES[0]
         }
 
+# 信息流按 (created_at, id) 倒序翻页
+db.Index('ix_plaza_topics_created_id', PlazaTopic.created_at.desc(), PlazaTopic.id.desc())
+# 改用户名 / 删用户时要按作者级联更新帖子
+db.Index('ix_plaza_topics_author', PlazaTopic.author_username)
+
 class PlazaComment(db.Model):
     __tablename__ = 'plaza_comments'
     id = db.Column(db.Integer, primary_key=True)
@@ -163,11 +301,17 @@ class PlazaComment(db.Model):
     author = db.relationship('User', backref=db.backref('plaza_comments', lazy=True))
     topic_id = db.Column(db.Integer, db.ForeignKey('plaza_topics.id', ondelete='CASCADE'), nullable=False)
     topic = db.relationship('PlazaTopic', backref=db.backref('comments', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.Index('ix_plaza_comments_topic_created', 'topic_id', 'created_at', 'id'), db.Index('ix_plaza_comments_author', 'author_username'))
+    # 和帖子一样：content 列存渲染好的 HTML，content_md 列存原始 Markdown
+    content_md = db.Column(db.Text)
+    content_hash = db.Column(db.String(64))
 
     def to_dict(self):
+        # 接口里的 content 一直是用户写的原文，老客户端照常按纯文本显示；渲染好的 HTML 放在 content_html
         return {
             'id': self.id,
-            'content': self.content,
+            'content': self.content_md if self.content_md is not None else self.content,
+            'content_html': self.content,
             'created_at': self.created_at.isoformat() + 'Z',
             'author_username': self.author.username,
             'author_likes': self.author.likes_received,
@@ -187,40 +331,1659 @@ class ChatMessage(db.Model):
     # 明确指定每个关系(sender, receiver)对应的外键列，消除歧义。
     sender = db.relationship('User', foreign_keys=[sender_username])
     receiver = db.relationship('User', foreign_keys=[receiver_username])
+    # 会话键：两个用户名排序后拼起来，同一对用户的消息都落在 (conversation_key, id) 索引的一段连续范围里
+    conversation_key = db.Column(db.String(200), nullable=True)
+    # 私信推送断线补发按"我发的或发给我的、id 大于 N"查，两个索引合起来走 OR
+    __table_args__ = (
+        db.Index('ix_chat_messages_conversation_id', 'conversation_key', 'id'),
+        db.Index('ix_chat_messages_sender_id', 'sender_username', 'id'),
+        db.Index('ix_chat_messages_receiver_id', 'receiver_username', 'id'),
+    )
+
+    @staticmethod
+    def make_conversation_key(username_a, username_b):
+        first, second = sorted([username_a, username_b])
+        # 带上长度前缀，避免用户名里本身含分隔符时产生歧义
+        return f"{len(first)}:{first}|{second}"
+
+    def to_dict(self, participants=None):
+        # participants: {username: User}，调用方已经加载好双方用户时传进来，避免每条消息都懒加载 sender/receiver
+        sender = participants[self.sender_username] if participants else self.sender
+        receiver = participants[self.receiver_username] if participants else self.receiver
+        return {
+            'id': self.id,
+            'content': self.content,
+            'created_at': self.created_at.isoformat() + 'Z',
+            'sender_id': sender.id,
+            'receiver_id': receiver.id,
+            'sender_username': sender.username,
+            'receiver_username': receiver.username,
+            'sender_avatar_url': sender.avatar_url or AVATAR_CHOICES[0],
+            'receiver_avatar_url': receiver.avatar_url or AVATAR_CHOICES[0]
+        }
 
-    def to_dict(self):
+    def to_compact_dict(self, participants):
+        # 分页接口用：参与者信息只在外层返回一次，每条消息只带 id
         return {
             'id': self.id,
             'content': self.content,
             'created_at': self.created_at.isoformat() + 'Z',
-            'sender_id': self.sender.id,
-            'receiver_id': self.receiver.id,
-            'sender_username': self.sender.username,
-            'receiver_username': self.receiver.username,
-            'sender_avatar_url': self.sender.avatar_url or AVATAR_CHOICES[0],
-            'receiver_avatar_url': self.receiver.avatar_url or AVATAR_CHOICES[0]
+            'sender_id': participants[self.sender_username].id,
+            'receiver_id': participants[self.receiver_username].id
         }
 
-# --- 3. 数据库表创建 ---
-with app.app_context():
-    db.create_all()
+@db.event.listens_for(ChatMessage, 'before_insert')
+def _set_conversation_key(mapper, connection, target):
+    target.conversation_key = ChatMessage.make_conversation_key(target.sender_username, target.receiver_username)
+
+class ChatReadMarker(db.Model):
+    # 每个用户在每个会话里读到哪条消息：未读数 = 对方发来的、id 大于 last_read_id 的消息数
+    __tablename__ = 'chat_read_markers'
+    username = db.Column(db.String(80), db.ForeignKey('users.username', onupdate='CASCADE', ondelete='CASCADE'), primary_key=True)
+    conversation_key = db.Column(db.String(200), primary_key=True)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class TranslationCacheEntry(db.Model):
+    # 翻译结果的持久化缓存（所有 gunicorn worker 共享），key 是规范化原文 + 目标语言的 sha256
+    __tablename__ = 'translation_cache'
+    key = db.Column(db.String(64), primary_key=True)
+    target_lang = db.Column(db.String(16), nullable=False)
+    source_text = db.Column(db.Text, nullable=False)
+    translated_text = db.Column(db.Text, nullable=False)
+    detected_source_language = db.Column(db.String(16))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_translation(self):
+        return {'detected_source_language': self.detected_source_language, 'text': self.translated_text}
+
+class DictionaryEntry(db.Model):
+    # 词典查询结果缓存：word 是规范化后的单词，payload 原样保存上游返回的 JSON（包括 404 的"查无此词"）
+    __tablename__ = 'dictionary_entries'
+    word = db.Column(db.String(100), primary_key=True)
+    status_code = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+# --- 2.1 全文搜索索引 ---
+# Postgres 上是 tsvector 表达式 + GIN 索引，随表自动更新；SQLite 上是 FTS5 外部内容表，由触发器同步。
+# 第一列权重高（标题 / 单词），第二列权重低。
+SEARCH_SCOPES = {
+    'notes': {'model': Note, 'columns': ('content', 'summary'), 'user_scoped': True},
+    'vocab': {'model': Vocab, 'columns': ('word', 'meaning'), 'user_scoped': True},
+    'topics': {'model': PlazaTopic, 'columns': ('title', 'content_text'), 'user_scoped': False},
+}
+SEARCH_TS_CONFIG = 'simple'
+
+def _search_document_sql(scope, alias=None):
+    prefix = f'{alias}.' if alias else ''
+    first, second = SEARCH_SCOPES[scope]['columns']
+    return (f"setweight(to_tsvector('{SEARCH_TS_CONFIG}', coalesce({prefix}{first}, '')), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_TS_CONFIG}', coalesce({prefix}{second}, '')), 'B')")
+
+def _search_ddl(scope, dialect_name):
+    table = SEARCH_SCOPES[scope]['model'].__tablename__
+    first, second = SEARCH_SCOPES[scope]['columns']
+    if dialect_name == 'postgresql':
+        return [f'CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING GIN (({_search_document_sql(scope)}))']
+    if dialect_name != 'sqlite': return []
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({first}, {second}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {first}, {second}) VALUES (new.id, new.{first}, new.{second}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {first}, {second}) VALUES ('delete', old.id, old.{first}, old.{second}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {first}, {second} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {first}, {second}) VALUES ('delete', old.id, old.{first}, old.{second}); "
+        f"INSERT INTO {fts}(rowid, {first}, {second}) VALUES (new.id, new.{first}, new.{second}); END",
+    ]
+
+def _make_search_ddl_listener(scope):
+    def create_search_index(target, connection, **kw):
+        if connection.dialect.name == 'sqlite':
+            # 表是刚建的：drop_all 不会删 FTS 虚拟表，把上一轮留下的旧索引清掉
+            connection.execute(text(f'DROP TABLE IF EXISTS {target.name}_fts'))
+        for statement in _search_ddl(scope, connection.dialect.name): connection.execute(text(statement))
+    return create_search_index
+
+for _scope, _config in SEARCH_SCOPES.items():
+    db.event.listen(_config['model'].__table__, 'after_create', _make_search_ddl_listener(_scope))
+
+# --- 3. 数据库迁移 ---
+# import 时不再 create_all：每个 worker 启动都要反射表结构，多个 worker 同时执行 DDL 还会互相锁表。
+# 表结构变更统一放在 SCHEMA_MIGRATIONS 里，部署时执行一次 `flask upgrade-db`（或 python init_db.py），
+# 按版本号执行还没执行过的迁移；worker 启动时只查一下当前版本号（见第 9 节）。
+# 每一步都可以重复执行，已有的老数据库第一次迁移时会把所有步骤过一遍。
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+def _has_column(table_name, column_name):
+    return any(c['name'] == column_name for c in inspect(db.engine).get_columns(table_name))
+
+def _create_missing_indexes(model):
+    for index in model.__table__.indexes: index.create(db.engine, checkfirst=True)
+
+def _upgrade_chat_conversation_key():
+    if not _has_column('chat_messages', 'conversation_key'):
+        db.session.execute(text('ALTER TABLE chat_messages ADD COLUMN conversation_key VARCHAR(200)'))
+        db.session.commit()
+    while True:
+        rows = db.session.execute(text('SELECT id, sender_username, receiver_username FROM chat_messages WHERE conversation_key IS NULL LIMIT 1000')).all()
+        if not rows: break
+        db.session.execute(text('UPDATE chat_messages SET conversation_key = :key WHERE id = :id'),
+                           [{'id': row.id, 'key': ChatMessage.make_conversation_key(row.sender_username, row.receiver_username)} for row in rows])
+        db.session.commit()
+    _create_missing_indexes(ChatMessage)
+
+def _upgrade_plaza_topic_excerpt():
+    if not _has_column('plaza_topics', 'excerpt'):
+        db.session.execute(text('ALTER TABLE plaza_topics ADD COLUMN excerpt VARCHAR(300)'))
+        db.session.commit()
+    while True:
+        rows = db.session.execute(text('SELECT id, content FROM plaza_topics WHERE excerpt IS NULL LIMIT 500')).all()
+        if not rows: break
+        db.session.execute(text('UPDATE plaza_topics SET excerpt = :excerpt WHERE id = :id'),
+                           [{'id': row.id, 'excerpt': PlazaTopic.make_excerpt(row.content)} for row in rows])
+        db.session.commit()
+    _create_missing_indexes(PlazaTopic)
+
+def _upgrade_user_vocab_count():
+    if not _has_column('users', 'vocab_count'):
+        db.session.execute(text('ALTER TABLE users ADD COLUMN vocab_count INTEGER NOT NULL DEFAULT 0'))
+        # 只在加列时回填一次；之后由写接口维护
+        db.session.execute(text('UPDATE users SET vocab_count = (SELECT COUNT(*) FROM vocabs WHERE vocabs.user_id = users.id)'))
+        db.session.commit()
+    _create_missing_indexes(User)
+
+def _upgrade_user_token_version():
+    if not _has_column('users', 'token_version'):
+        db.session.execute(text('ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0'))
+        db.session.commit()
+
+def _upgrade_plaza_markdown_source():
+    for table in ('plaza_topics', 'plaza_comments'):
+        if not _has_column(table, 'content_md'):
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN content_md TEXT'))
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN content_hash VARCHAR(64)'))
+            db.session.commit()
+    # 以前的评论存的是原始文本，没有渲染过：原文挪到 content_md，content 列换成渲染后的 HTML。
+    # 原文没有丢，接口返回的 content 仍然是它（见 PlazaComment.to_dict）。
+    # 以前的帖子只存了 HTML，原始 Markdown 已经找不回来了，保持原样。
+    while True:
+        rows = db.session.execute(text('SELECT id, content FROM plaza_comments WHERE content_md IS NULL LIMIT 500')).all()
+        if not rows: break
+        params = []
+        for row in rows:
+            rendered, content_hash = render_markdown(row.content)
+            params.append({'id': row.id, 'md': row.content, 'html': rendered, 'hash': content_hash})
+        db.session.execute(text('UPDATE plaza_comments SET content_md = :md, content = :html, content_hash = :hash WHERE id = :id'), params)
+        db.session.commit()
+
+def _upgrade_sync_versions():
+    for table, column in (('users', 'data_version'), ('notes', 'version'), ('vocabs', 'version')):
+        if not _has_column(table, column):
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'))
+            db.session.commit()
+    _create_missing_indexes(Note)
+    _create_missing_indexes(Vocab)
+
+def _upgrade_search_indexes():
+    dialect_name = db.engine.dialect.name
+    for scope, config in SEARCH_SCOPES.items():
+        table = config['model'].__tablename__
+        # 老库按顺序迁移时，要索引的列可能是后面的迁移才加上的，到那一步再建
+        if not all(_has_column(table, column) for column in config['columns']): continue
+        created = dialect_name == 'sqlite' and not inspect(db.engine).has_table(f'{table}_fts')
+        for statement in _search_ddl(scope, dialect_name): db.session.execute(text(statement))
+        # 新建的 FTS5 表是空的，从原表灌一次
+        if created: db.session.execute(text(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"))
+        db.session.commit()
+
+def _upgrade_topic_search_text():
+    if not _has_column('plaza_topics', 'content_text'):
+        db.session.execute(text('ALTER TABLE plaza_topics ADD COLUMN content_text TEXT'))
+        db.session.commit()
+    while True:
+        rows = db.session.execute(text('SELECT id, content FROM plaza_topics WHERE content_text IS NULL LIMIT 500')).all()
+        if not rows: break
+        db.session.execute(text('UPDATE plaza_topics SET content_text = :plain WHERE id = :id'),
+                           [{'id': row.id, 'plain': PlazaTopic.make_plain_text(row.content)} for row in rows])
+        db.session.commit()
+    # 以前的帖子搜索索引建在 HTML 的 content 列上，删掉按 content_text 重建
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('DROP INDEX IF EXISTS ix_plaza_topics_search'))
+    elif db.engine.dialect.name == 'sqlite':
+        for suffix in ('ai', 'ad', 'au'): db.session.execute(text(f'DROP TRIGGER IF EXISTS plaza_topics_fts_{suffix}'))
+        db.session.execute(text('DROP TABLE IF EXISTS plaza_topics_fts'))
+    db.session.commit()
+    _upgrade_search_indexes()
+
+def _upgrade_route_indexes():
+    for model in (Note, Like, PlazaTopic, PlazaComment, ChatMessage): _create_missing_indexes(model)
+
+# 只能往后追加，版本号就是在列表里的位置（从 1 开始）
+SCHEMA_MIGRATIONS = [
+    ('create tables', db.create_all),
+    ('chat_messages.conversation_key', _upgrade_chat_conversation_key),
+    ('plaza_topics.excerpt', _upgrade_plaza_topic_excerpt),
+    ('plaza_comments.topic_created index', lambda: _create_missing_indexes(PlazaComment)),
+    ('users.vocab_count', _upgrade_user_vocab_count),
+    ('users.token_version', _upgrade_user_token_version),
+    ('plaza content_md / content_hash', _upgrade_plaza_markdown_source),
+    ('notes / vocabs sync version', _upgrade_sync_versions),
+    ('full-text search indexes', _upgrade_search_indexes),
+    ('secondary indexes for route queries', _upgrade_route_indexes),
+    ('summary_jobs table', lambda: SummaryJob.__table__.create(db.engine, checkfirst=True)),
+    ('chat_read_markers table', lambda: ChatReadMarker.__table__.create(db.engine, checkfirst=True)),
+    ('plaza_topics.content_text for search', _upgrade_topic_search_text),
+]
+
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+MIGRATION_LOCK_KEY = 7012001
+
+def applied_schema_version():
+    # 启动检查用：只有一条查询；表还不存在（全新的库或者老库）就是 0
+    try:
+        return db.session.query(func.max(SchemaMigration.version)).scalar() or 0
+    except SQLAlchemyError:
+        db.session.rollback()
+        return 0
+
+@contextmanager
+def _migration_lock():
+    # 多个实例同时部署时，Postgres 上用 advisory lock 保证只有一个在执行迁移
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect() as connection:
+        connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        connection.commit()
+        try:
+            yield
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            connection.commit()
+
+def migrate_database():
+    with _migration_lock():
+        SchemaMigration.__table__.create(db.engine, checkfirst=True)
+        current = applied_schema_version()
+        for version, (name, migrate) in enumerate(SCHEMA_MIGRATIONS, start=1):
+            if version <= current: continue
+            print(f"正在执行数据库迁移 {version}: {name} ...")
+            migrate()
+            db.session.add(SchemaMigration(version=version, name=name))
+            db.session.commit()
+    return SCHEMA_VERSION
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    version = migrate_database()
+    print(f"数据库升级完成！当前结构版本 {version}")
 
 # --- 4. JWT 身份验证辅助函数 ---
+class TTLCache:
+    # 线程安全的进程内 LRU（认证、翻译、词典等缓存共用）：超过 maxsize 淘汰最久没用的，超过 ttl 秒的条目视为失效
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock: self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# 验证过的 token 缓存起来，同一个 token 不用每个请求都重新验签；缓存时间不会超过 token 自己的 exp
+_verified_tokens = TTLCache(_env_int('AUTH_TOKEN_CACHE_SIZE', 10000), 300)
+# 每个用户当前的 token 版本号，"退出所有设备"时加一，旧 token 随即失效；其他 worker 最多延迟 AUTH_VERSION_TTL 秒生效
+_token_versions = TTLCache(_env_int('AUTH_TOKEN_CACHE_SIZE', 10000), _env_float('AUTH_VERSION_TTL', 30))
+
+def _current_token_version(user_id):
+    version = _token_versions.get(user_id)
+    if version is None:
+        version = db.session.query(User.token_version).filter(User.id == user_id).scalar() or 0
+        _token_versions.set(user_id, version)
+    return version
+
+def _verify_token(token):
+    claims = _verified_tokens.get(token)
+    if claims is None:
+        try:
+            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+            return None
+        # 推送票据（带 scope）只能用来打开 SSE 连接，不能当登录 token 用
+        if data.get('scope'): return None
+        claims = {'user_id': data['user_id'], 'username': data['username'], 'token_version': data.get('tv', 0), 'exp': data.get('exp')}
+        ttl = min(_verified_tokens.ttl, claims['exp'] - time.time()) if claims['exp'] else None
+        _verified_tokens.set(token, claims, ttl)
+    elif claims['exp'] and claims['exp'] <= time.time():
+        _verified_tokens.pop(token)
+        return None
+    if claims['token_version'] != _current_token_version(claims['user_id']): return None
+    return {'user_id': claims['user_id'], 'username': claims['username']}
+
 def get_user_from_token():
     auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return None
+    if not auth_header or not auth_header.startswith('Bearer '): return None
     token = auth_header.split(" ")[1]
+    # 同一个请求里多次调用只验证一次
+    cached = g.get('_auth')
+    if cached is not None and cached[0] == token: return cached[1]
+    user_info = _verify_token(token)
+    g._auth = (token, user_info)
+    return user_info
+
+def get_current_user():
+    # 当前请求的用户对象，第一次用到时才查数据库，同一个请求里最多查一次
+    if '_current_user' not in g:
+        user_info = g._auth[1] if '_auth' in g else get_user_from_token()
+        g._current_user = db.session.get(User, user_info['user_id']) if user_info else None
+    return g._current_user
+
+# --- 4.1 上游 HTTP 客户端 (DeepL / DeepSeek / 词典) ---
+# 每个上游一个长连接 Session，各自的超时、重试和熔断配置都可以用环境变量覆盖，
+# 例如 DEEPL_READ_TIMEOUT=5、DEEPSEEK_MAX_RETRIES=0、DICTIONARY_API_URL=http://127.0.0.1:9000
+class UpstreamError(Exception):
+    def __init__(self, upstream, message, status_code=None):
+        super().__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+        self.status_code = status_code
+
+class UpstreamUnavailable(UpstreamError):
+    # 熔断器打开时直接抛出，不再去连一个已经挂掉的上游
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None: return True
+            if time.monotonic() - self._opened_at < self.reset_timeout: return False
+            # 半开状态：只放一个试探请求过去
+            if self._trial_in_flight: return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures, self._opened_at, self._trial_in_flight = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None: return 'closed'
+            return 'open' if time.monotonic() - self._opened_at < self.reset_timeout else 'half-open'
+
+class UpstreamClient:
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, name, base_url, connect_timeout, read_timeout, max_retries=2, backoff=0.2, pool_size=10, failure_threshold=5, reset_timeout=30):
+        prefix = name.upper()
+        self.name = name
+        self.base_url = os.environ.get(f'{prefix}_API_URL', base_url).rstrip('/')
+        self.timeout = (_env_float(f'{prefix}_CONNECT_TIMEOUT', connect_timeout), _env_float(f'{prefix}_READ_TIMEOUT', read_timeout))
+        self.max_retries = _env_int(f'{prefix}_MAX_RETRIES', max_retries)
+        self.backoff = _env_float(f'{prefix}_RETRY_BACKOFF', backoff)
+        self.pool_size = _env_int(f'{prefix}_POOL_SIZE', pool_size)
+        self.breaker = CircuitBreaker(_env_int(f'{prefix}_BREAKER_THRESHOLD', failure_threshold), _env_float(f'{prefix}_BREAKER_RESET', reset_timeout))
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # 懒加载，gunicorn fork 之后每个 worker 各自建立连接池。
+        # requests（连同 urllib3）也是第一次调用上游时才导入，不拖慢 worker 启动
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    # 下面几个方法只做判断、不发请求，asgi.py 的异步客户端也用它们，重试和熔断规则只写一份
+    @staticmethod
+    def resolve_idempotent(method, idempotent):
+        return method.upper() in ('GET', 'HEAD', 'OPTIONS') if idempotent is None else idempotent
+
+    def check_breaker(self):
+        if not self.breaker.allow(): raise UpstreamUnavailable(self.name, '上游服务暂时不可用（熔断中）', 503)
+
+    def should_retry(self, attempt, idempotent, status_code=None, connect_failed=False):
+        if attempt >= self.max_retries: return False
+        if status_code is not None: return idempotent and status_code in self.RETRY_STATUSES
+        # 连接没建立起来时请求肯定没发出去，非幂等请求也可以安全重试
+        return idempotent or connect_failed
+
+    def retry_delay(self, attempt):
+        # 指数退避 + full jitter，避免所有 worker 同时重试打爆上游
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def record_status(self, status_code):
+        if status_code >= 500: self.breaker.record_failure()
+        else: self.breaker.record_success()
+
+    def failed(self, e):
+        # 网络错误且不再重试：计入熔断，转换成 UpstreamError
+        self.breaker.record_failure()
+        return UpstreamError(self.name, str(e) or type(e).__name__)
+
+    @staticmethod
+    def error_kind(e):
+        return 'circuit_open' if isinstance(e, UpstreamUnavailable) else ('http' if e.status_code else 'network')
+
+    def request(self, method, path, idempotent=None, raise_for_status=True, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self._request(method, path, idempotent, raise_for_status, **kwargs)
+        except UpstreamError as e:
+            UPSTREAM_ERRORS.inc(upstream=self.name, kind=self.error_kind(e))
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream=self.name)
+        return response
+
+    def _request(self, method, path, idempotent, raise_for_status, **kwargs):
+        import requests
+        idempotent = self.resolve_idempotent(method, idempotent)
+        self.check_breaker()
+        kwargs.setdefault('timeout', self.timeout)
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                if self.should_retry(attempt, idempotent, connect_failed=isinstance(e, requests.exceptions.ConnectTimeout)):
+                    time.sleep(self.retry_delay(attempt)); attempt += 1
+                    continue
+                raise self.failed(e) from e
+            if self.should_retry(attempt, idempotent, status_code=response.status_code):
+                response.close()
+                time.sleep(self.retry_delay(attempt)); attempt += 1
+                continue
+            self.record_status(response.status_code)
+            if raise_for_status and response.status_code >= 400:
+                response.close()
+                raise UpstreamError(self.name, f"HTTP {response.status_code}", response.status_code)
+            return response
+
+    def iter_lines(self, response):
+        # 流式读取时的网络异常同样转换成 UpstreamError，并计入熔断
+        import requests
+        try:
+            yield from response.iter_lines(chunk_size=None)
+        except requests.exceptions.RequestException as e:
+            UPSTREAM_ERRORS.inc(upstream=self.name, kind='stream')
+            raise self.failed(e) from e
+
+upstreams = {
+    'deepl': UpstreamClient('deepl', 'https://api-free.deepl.com', connect_timeout=3, read_timeout=10),
+    # LLM 生成很慢，读超时要给足；POST 非幂等，只在连接阶段失败时重试
+    'deepseek': UpstreamClient('deepseek', 'https://api.deepseek.com', connect_timeout=5, read_timeout=120, max_retries=1),
+    'dictionary': UpstreamClient('dictionary', 'https://api.dictionaryapi.dev', connect_timeout=3, read_timeout=8),
+}
+
+def _upstream_error_response(e, message):
+    status = 503 if isinstance(e, UpstreamUnavailable) else 502
+    return jsonify({'error': message, 'details': str(e)}), status
+
+# --- 4.2 数据库与管理工具 ---
+def _dialect_insert(model):
+    # PostgreSQL 和 SQLite 都支持 INSERT ... ON CONFLICT，但要用各自方言的 insert
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+def _is_admin_secret(secret_key):
+    return secret_key == os.environ.get('RESET_SECRET_WORD', 'my_default_reset_word')
+
+# --- 4.2.0 只读副本路由 ---
+# 副本的引擎在第一次用到时才创建（gunicorn fork 之后），连接池参数和主库一样。
+# 副本有复制延迟：用户自己刚写过数据，之后 REPLICA_STICKY_SECONDS 秒内他的请求都读主库，保证能读到自己的写入。
+# 本进程内记在 _recent_writers 里；多 worker 时下一个请求不一定落在同一个进程，所以写入后还会下发一个
+# 带签名和时间戳的 cookie（同时放在 X-Replica-Sticky 响应头里，不带 cookie 的客户端可以原样放进请求头）。
+REPLICA_STICKY_SECONDS = _env_float('REPLICA_STICKY_SECONDS', 10)
+REPLICA_STICKY_COOKIE = 'replica_sticky'
+_recent_writers = TTLCache(_env_int('REPLICA_STICKY_USERS', 50000), REPLICA_STICKY_SECONDS)
+_sticky_signer = TimestampSigner(app.config['SECRET_KEY'], salt='replica-sticky')
+_replica_engine_lock = threading.Lock()
+_replica_engines = {}
+
+def _replica_engine():
+    engine = _replica_engines.get('replica')
+    if engine is None:
+        with _replica_engine_lock:
+            engine = _replica_engines.get('replica')
+            if engine is None:
+                engine = _replica_engines['replica'] = create_engine(
+                    replica_url, **_engine_options(replica_url, _env_int('DB_REPLICA_STATEMENT_TIMEOUT_MS', _env_int('DB_STATEMENT_TIMEOUT_MS', 0))))
+    return engine
+
+def _reading_from_replica():
+    return bool(replica_url) and has_request_context() and g.get('_read_replica', False)
+
+def use_read_replica(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if replica_url:
+            user_info = get_user_from_token()
+            g._read_replica = not (user_info and _recently_wrote(user_info['user_id']))
+        return view(*args, **kwargs)
+    return wrapper
+
+def _recently_wrote(user_id):
+    if _recent_writers.get(user_id): return True
+    marker = request.headers.get('X-Replica-Sticky') or request.cookies.get(REPLICA_STICKY_COOKIE)
+    if not marker: return False
     try:
-        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return {'user_id': data['user_id'], 'username': data['username']}
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-        return None
+        return _sticky_signer.unsign(marker, max_age=REPLICA_STICKY_SECONDS).decode() == str(user_id)
+    except BadSignature:
+        return False
+
+@app.after_request
+def _set_replica_sticky(response):
+    user_id = g.pop('_replica_sticky_user', None)
+    if not replica_url or user_id is None: return response
+    marker = _sticky_signer.sign(str(user_id)).decode()
+    response.headers['X-Replica-Sticky'] = marker
+    # 前端和后端不同源，https 下要 SameSite=None 才会随跨域请求带上
+    response.set_cookie(REPLICA_STICKY_COOKIE, marker, max_age=int(REPLICA_STICKY_SECONDS) + 1, httponly=True,
+                        secure=request.is_secure, samesite='None' if request.is_secure else 'Lax')
+    return response
+
+@db.event.listens_for(Session, 'after_flush')
+def _mark_session_write(session, flush_context):
+    session.info['wrote'] = True
+
+@db.event.listens_for(Session, 'do_orm_execute')
+def _mark_statement_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+@db.event.listens_for(Session, 'after_commit')
+def _remember_recent_writer(session):
+    if not session.info.pop('wrote', False) or not has_request_context(): return
+    user_info = g._auth[1] if '_auth' in g else None
+    if user_info:
+        _recent_writers.set(user_info['user_id'], True)
+        g._replica_sticky_user = user_info['user_id']
+
+@db.event.listens_for(Session, 'after_rollback')
+def _forget_session_write(session):
+    session.info.pop('wrote', None)
+
+# --- 4.2.1 Markdown 渲染 ---
+# 整个进程共用一个配置好的解析器；escape=True 会转义用户写的原始 HTML，mistune 也会把 javascript: 之类的危险链接替换掉。
+# 渲染结果按内容哈希缓存，哈希里带着渲染器版本号：改了渲染配置就把版本号加一，再执行 `flask rerender-markdown`。
+MARKDOWN_RENDERER_VERSION = '1'
+PLAZA_TOPIC_MAX_CHARS = _env_int('PLAZA_TOPIC_MAX_CHARS', 20000)
+PLAZA_COMMENT_MAX_CHARS = _env_int('PLAZA_COMMENT_MAX_CHARS', 2000)
+_markdown_renderer = None
+_rendered_markdown = TTLCache(_env_int('MARKDOWN_CACHE_SIZE', 2000), 3600)
+
+def _get_markdown_renderer():
+    global _markdown_renderer
+    if _markdown_renderer is None:
+        import mistune
+        _markdown_renderer = mistune.create_markdown(escape=True, hard_wrap=True, plugins=['strikethrough', 'table', 'url'])
+    return _markdown_renderer
+
+def markdown_hash(raw_content):
+    return hashlib.sha256(f"{MARKDOWN_RENDERER_VERSION}\n{raw_content}".encode('utf-8')).hexdigest()
+
+def render_markdown(raw_content):
+    # 返回 (html, content_hash)；同样的内容只渲染一次
+    content_hash = markdown_hash(raw_content)
+    rendered = _rendered_markdown.get(content_hash)
+    if rendered is None:
+        rendered = _get_markdown_renderer()(raw_content)
+        _rendered_markdown.set(content_hash, rendered)
+    return rendered, content_hash
+
+@app.cli.command('rerender-markdown')
+@click.option('--batch-size', default=200, help='每批处理多少行')
+def rerender_markdown(batch_size):
+    # 渲染器升级后批量重新渲染帖子和评论，只处理哈希对不上的行
+    for model in (PlazaTopic, PlazaComment):
+        updated, last_id = 0, 0
+        while True:
+            rows = model.query.filter(model.id > last_id, model.content_md.isnot(None)).order_by(model.id).limit(batch_size).all()
+            if not rows: break
+            for row in rows:
+                if row.content_hash != markdown_hash(row.content_md):
+                    row.content, row.content_hash = render_markdown(row.content_md)
+                    if model is PlazaTopic: row.excerpt, row.content_text = PlazaTopic.make_excerpt(row.content), PlazaTopic.make_plain_text(row.content)
+                    updated += 1
+            last_id = rows[-1].id
+            db.session.commit()
+        print(f"{model.__tablename__}: 重新渲染了 {updated} 行")
+
+# --- 4.3 翻译缓存 ---
+# 第一层是进程内 LRU，第二层是数据库表 translation_cache，命中时直接返回 DeepL 同样的结构
+class TranslationCache:
+    def __init__(self):
+        self.memory = TTLCache(_env_int('TRANSLATION_CACHE_SIZE', 5000), _env_float('TRANSLATION_CACHE_TTL', 3600))
+        self.db_ttl = timedelta(days=_env_float('TRANSLATION_CACHE_DB_TTL_DAYS', 30))
+        self._stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0}
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        # 只合并空白，不改大小写：大小写会影响翻译结果。
+        # 只用在缓存键上，发给 DeepL 的还是原文，换行和段落要保留
+        return ' '.join(text.split())
+
+    @staticmethod
+    def make_key(text, target_lang):
+        return hashlib.sha256(f"{target_lang}\n{TranslationCache.normalize(text)}".encode('utf-8')).hexdigest()
+
+    def _count(self, name, n=1):
+        if n:
+            with self._stats_lock: self._stats[name] += n
+
+    def lookup(self, texts, target_lang):
+        # 按合并空白后的文本查；返回 {text: translation}（键是传进来的原文），没命中的不在结果里
+        found, missing = {}, {}
+        for text in texts:
+            key = self.make_key(text, target_lang)
+            cached = self.memory.get(key)
+            if cached is not None: found[text] = cached
+            else: missing[key] = text
+        self._count('memory_hits', len(found))
+        if missing:
+            try:
+                rows = TranslationCacheEntry.query.filter(
+                    TranslationCacheEntry.key.in_(list(missing)),
+                    TranslationCacheEntry.created_at >= datetime.utcnow() - self.db_ttl
+                ).all()
+            except SQLAlchemyError as e:
+                # 缓存坏了不能影响翻译，当作没命中
+                db.session.rollback()
+                print(f"[translation-cache] db lookup failed: {e}")
+                rows = []
+            for row in rows:
+                translation = row.to_translation()
+                self.memory.set(row.key, translation)
+                found[missing[row.key]] = translation
+            self._count('db_hits', len(rows))
+            self._count('misses', len(missing) - len(rows))
+        return found
+
+    def store(self, pairs, target_lang):
+        # pairs: [(text, translation_dict), ...]
+        rows = {}
+        for text, translation in pairs:
+            key = self.make_key(text, target_lang)
+            self.memory.set(key, translation)
+            rows[key] = {
+                'key': key, 'target_lang': target_lang, 'source_text': self.normalize(text),
+                'translated_text': translation.get('text') or '',
+                'detected_source_language': translation.get('detected_source_language'),
+                'created_at': datetime.utcnow()
+            }
+        if not rows: return
+        try:
+            stmt = _dialect_insert(TranslationCacheEntry).values(list(rows.values()))
+            # 别的 worker 可能刚写入同一个 key，以最新结果为准
+            db.session.execute(stmt.on_conflict_do_update(index_elements=['key'], set_={
+                'translated_text': stmt.excluded.translated_text,
+                'detected_source_language': stmt.excluded.detected_source_language,
+                'created_at': stmt.excluded.created_at
+            }))
+            db.session.commit()
+            self._count('stores', len(rows))
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"[translation-cache] db store failed: {e}")
+
+    def stats(self):
+        with self._stats_lock: stats = dict(self._stats)
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['memory_entries'] = len(self.memory)
+        stats['hit_ratio'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 4) if lookups else None
+        return stats
+
+    def purge(self, expired_only=False):
+        self.memory.clear()
+        query = TranslationCacheEntry.query
+        if expired_only: query = query.filter(TranslationCacheEntry.created_at < datetime.utcnow() - self.db_ttl)
+        deleted = query.delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+translation_cache = TranslationCache()
+
+# --- 4.4 DeepL 请求合并 ---
+# 同一时间窗口内、同一 target_lang 的单句翻译请求攒成一个批次，只调一次 DeepL。
+# 第一个到达的请求当"领头人"：等窗口结束（或批次满了）后发请求，再把结果分发给每个等待者。
+# DEEPL_COALESCE_WINDOW_MS=0 可以关闭合并。只有多线程 worker（如 gthread）下才有并发可合并，
+# 同步 worker 一次只处理一个请求，等窗口只会白白增加延迟，所以调用方按 wsgi.multithread 决定要不要合并。
+DEEPL_MAX_BATCH = 50  # DeepL 单次请求最多 50 段文本
+
+class _PendingBatch:
+    def __init__(self):
+        self.items = []  # [(text, Future)]
+        self.full = threading.Event()
+
+class TranslationCoalescer:
+    def __init__(self, translate_fn, window, wait_timeout, max_batch=DEEPL_MAX_BATCH):
+        self.translate_fn = translate_fn
+        self.window = window
+        self.wait_timeout = wait_timeout
+        self.max_batch = max_batch
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, text, target_lang, coalesce=True):
+        if self.window <= 0 or not coalesce: return self.translate_fn([text], target_lang)[0]
+        future = Future()
+        with self._lock:
+            batch = self._pending.get(target_lang)
+            is_leader = batch is None
+            if is_leader: batch = self._pending[target_lang] = _PendingBatch()
+            batch.items.append((text, future))
+            if len(batch.items) >= self.max_batch:
+                # 批次满了就不再接收新请求，叫醒领头人马上发送
+                del self._pending[target_lang]
+                batch.full.set()
+        if is_leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(target_lang) is batch: del self._pending[target_lang]
+            self._flush(batch, target_lang)
+        try:
+            # 领头人的上游请求卡住（慢响应 + 重试）时，跟着等的请求最多等 wait_timeout 秒
+            return future.result(timeout=self.wait_timeout)
+        except FutureTimeoutError:
+            raise UpstreamError('deepl', '等待合并的翻译结果超时')
+
+    def _flush(self, batch, target_lang):
+        texts = list(dict.fromkeys(text for text, _ in batch.items))
+        try:
+            results = dict(zip(texts, self.translate_fn(texts, target_lang)))
+        except Exception as e:
+            for _, future in batch.items: future.set_exception(e)
+            return
+        for text, future in batch.items:
+            if text in results: future.set_result(results[text])
+            else: future.set_exception(UpstreamError('deepl', '翻译结果数量与请求不一致'))
+
+def _deepl_translate_texts(texts, target_lang):
+    # 按 DeepL 的批量上限分片请求，返回与 texts 顺序一致的翻译结果，并写入缓存
+    api_key = os.environ.get('DEEPL_API_KEY')
+    translations = []
+    for start in range(0, len(texts), DEEPL_MAX_BATCH):
+        chunk = texts[start:start + DEEPL_MAX_BATCH]
+        response = upstreams['deepl'].request('POST', '/v2/translate', idempotent=True, headers={'Authorization': f'DeepL-Auth-Key {api_key}'}, json={'text': chunk, 'target_lang': target_lang})
+        try:
+            result = response.json().get('translations') or []
+        except ValueError as e:
+            raise UpstreamError('deepl', f'返回内容无法解析: {e}') from e
+        if len(result) != len(chunk): raise UpstreamError('deepl', '翻译结果数量与请求不一致')
+        translations.extend(result)
+    translation_cache.store(list(zip(texts, translations)), target_lang)
+    return translations
+
+translation_coalescer = TranslationCoalescer(_deepl_translate_texts, _env_float('DEEPL_COALESCE_WINDOW_MS', 5) / 1000, _env_float('DEEPL_COALESCE_TIMEOUT', 30))
+
+# --- 4.5 词典缓存 ---
+# 查到的（200）和查不到的（404）都缓存，分别有自己的过期时间；其他状态码（429、5xx）不缓存
+class DictionaryCache:
+    CACHEABLE_STATUSES = (200, 404)
+
+    def __init__(self):
+        self.memory = TTLCache(_env_int('DICTIONARY_CACHE_SIZE', 20000), _env_float('DICTIONARY_CACHE_TTL', 600))
+        self.positive_ttl = timedelta(days=_env_float('DICTIONARY_CACHE_TTL_DAYS', 30))
+        self.negative_ttl = timedelta(hours=_env_float('DICTIONARY_NEGATIVE_TTL_HOURS', 24))
+
+    @staticmethod
+    def normalize(word):
+        # 和前端 showDictionaryPopup 的处理保持一致：去掉首尾标点、转小写
+        return word.strip().strip('.,?!:;"\'()[]').lower()
+
+    def _is_fresh(self, entry):
+        ttl = self.positive_ttl if entry.status_code == 200 else self.negative_ttl
+        return entry.fetched_at >= datetime.utcnow() - ttl
+
+    def lookup(self, words):
+        # 返回 {word: (status_code, payload)}，没命中或已过期的不在结果里
+        found, missing = {}, []
+        for word in words:
+            cached = self.memory.get(word)
+            if cached is not None: found[word] = cached
+            else: missing.append(word)
+        if missing:
+            try:
+                rows = DictionaryEntry.query.filter(DictionaryEntry.word.in_(missing)).all()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                print(f"[dictionary-cache] db lookup failed: {e}")
+                rows = []
+            for row in rows:
+                if not self._is_fresh(row): continue
+                found[row.word] = (row.status_code, row.payload)
+                self.memory.set(row.word, found[row.word])
+        return found
+
+    def store(self, results):
+        # results: {word: (status_code, payload)}
+        rows = []
+        for word, (status_code, payload) in results.items():
+            if status_code not in self.CACHEABLE_STATUSES: continue
+            self.memory.set(word, (status_code, payload))
+            rows.append({'word': word, 'status_code': status_code, 'payload': payload, 'fetched_at': datetime.utcnow()})
+        if not rows: return
+        try:
+            stmt = _dialect_insert(DictionaryEntry).values(rows)
+            db.session.execute(stmt.on_conflict_do_update(index_elements=['word'], set_={
+                'status_code': stmt.excluded.status_code,
+                'payload': stmt.excluded.payload,
+                'fetched_at': stmt.excluded.fetched_at
+            }))
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"[dictionary-cache] db store failed: {e}")
+
+dictionary_cache = DictionaryCache()
+# 原词 404 之后最多再试几个词原形：每个候选都是一次上游请求
+DICTIONARY_MAX_LEMMAS = _env_int('DICTIONARY_MAX_LEMMAS', 3)
+
+def _lemma_candidates(word):
+    # 很粗糙的英文词形还原，只在原词查不到时兜底用：cats -> cat, studies -> study, running -> run
+    candidates = []
+    if word.endswith('ies') and len(word) > 4: candidates.append(word[:-3] + 'y')
+    if word.endswith('es') and word[:-2].endswith(('s', 'x', 'z', 'ch', 'sh')): candidates.append(word[:-2])
+    if word.endswith('s') and not word.endswith('ss') and len(word) > 3: candidates.append(word[:-1])
+    if word.endswith('ied') and len(word) > 4: candidates.append(word[:-3] + 'y')
+    for suffix in ('ed', 'ing'):
+        if word.endswith(suffix) and len(word) > len(suffix) + 2:
+            stem = word[:-len(suffix)]
+            # stopping -> stop 比 stopp / stoppe 更可能，放在前面（候选有数量上限）
+            if len(stem) > 2 and stem[-1] == stem[-2]: candidates.append(stem[:-1])
+            candidates.extend([stem, stem + 'e'])
+    return list(dict.fromkeys(c for c in candidates if c != word))[:DICTIONARY_MAX_LEMMAS]
+
+def _definition_steps(word):
+    # 查词的流程本身不发请求：yield 要查的词，收回 (status_code, payload) 或者被 throw 进请求异常，最后 return 结果。
+    # 下面的 _fetch_definition 和 asgi.py 里的异步版本都只负责按它的要求发请求，兜底规则只写一份
+    status_code, payload = yield word
+    json.loads(payload)  # 上游返回的不是 JSON 时抛 ValueError
+    if status_code != 404: return status_code, payload
+    for lemma in _lemma_candidates(word):
+        # 原词已经确定查不到了，词原形这一步出错就按查不到处理，不把整个请求变成 502
+        try:
+            lemma_status, lemma_payload = yield lemma
+            if lemma_status == 200:
+                json.loads(lemma_payload)
+                return 200, lemma_payload
+        except (UpstreamError, ValueError):
+            break
+    return status_code, payload
+
+def _fetch_definition(word):
+    # 查上游；原词 404 时再试几个可能的词原形，找到就用词原形的释义
+    client = upstreams['dictionary']
+    steps = _definition_steps(word)
+    target = next(steps)
+    try:
+        while True:
+            try: response = client.request('GET', f"/api/v2/entries/en/{target}", raise_for_status=False)
+            except UpstreamError as e: target = steps.throw(e)
+            else: target = steps.send((response.status_code, response.text))
+    except StopIteration as done:
+        return done.value
+
+def _resolve_definitions(words):
+    # 先查缓存，没命中的并发去上游取；返回 {word: (status_code, payload)}，失败的词值为异常对象
+    words = list(dict.fromkeys(words))
+    results = dictionary_cache.lookup(words)
+    missing = [w for w in words if w not in results]
+    if not missing: return results
+    fetched = {}
+    if len(missing) == 1:
+        try: fetched[missing[0]] = _fetch_definition(missing[0])
+        except (UpstreamError, ValueError) as e: results[missing[0]] = e
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(missing), _env_int('DICTIONARY_FETCH_CONCURRENCY', 8))) as pool:
+            futures = {word: pool.submit(_fetch_definition, word) for word in missing}
+        for word, future in futures.items():
+            try: fetched[word] = future.result()
+            except (UpstreamError, ValueError) as e: results[word] = e
+    dictionary_cache.store(fetched)
+    results.update(fetched)
+    return results
+
+@app.cli.command('warm-dictionary-cache')
+@click.option('--limit', default=1000, help='最多预热多少个单词')
+def warm_dictionary_cache(limit):
+    # 用单词本里已有的单词预热词典缓存：大家收藏过的词，就是最常被查的词
+    words = [row[0] for row in db.session.query(func.lower(Vocab.word)).distinct().limit(limit * 5)]
+    words = [w for w in dict.fromkeys(dictionary_cache.normalize(w) for w in words) if w][:limit]
+    cached = dictionary_cache.lookup(words)
+    missing = [w for w in words if w not in cached]
+    print(f"单词本共 {len(words)} 个不同单词，已缓存 {len(cached)} 个，开始预热 {len(missing)} 个...")
+    for start in range(0, len(missing), 100):
+        results = _resolve_definitions(missing[start:start + 100])
+        failed = [w for w, r in results.items() if isinstance(r, Exception)]
+        if failed: print(f"预热失败: {', '.join(failed)}")
+    print("词典缓存预热完成！")
+
+# --- 4.6 消息推送总线 ---
+# 默认只在本进程内分发；多 worker 部署时设置 CHAT_BUS=postgres，通过 LISTEN/NOTIFY 在 worker 之间广播
+class _Subscription:
+    def __init__(self, channel, notify=None):
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=1000)
+        self.overflowed = False
+        # 有新事件时调用（在发布方的线程里），asgi.py 的异步推送靠它唤醒事件循环
+        self.notify = notify
+
+class InProcessBus:
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, notify=None):
+        subscription = _Subscription(channel, notify)
+        with self._lock: self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is None: return
+            subscribers.discard(subscription)
+            if not subscribers: del self._subscribers[subscription.channel]
+
+    def publish(self, channels, event, event_id, data):
+        self._deliver(channels, event, event_id, data)
+
+    def _deliver(self, channels, event, event_id, data):
+        with self._lock:
+            targets = [sub for channel in set(channels) for sub in self._subscribers.get(channel, ())]
+        for sub in targets:
+            try:
+                sub.queue.put_nowait((event, event_id, data))
+            except queue.Full:
+                # 客户端消费太慢：让它断开重连，再用 Last-Event-ID 从数据库补齐
+                sub.overflowed = True
+            if sub.notify: sub.notify()
+
+class PostgresBus(InProcessBus):
+    NOTIFY_CHANNEL = 'app_events'
+    MAX_PAYLOAD = 7900  # NOTIFY 的 payload 上限是 8000 字节
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+        self._listener_pid = None
+
+    def subscribe(self, channel, notify=None):
+        self._ensure_listener()
+        return super().subscribe(channel, notify)
+
+    def publish(self, channels, event, event_id, data):
+        payload = json.dumps({'channels': list(channels), 'event': event, 'id': event_id, 'data': data}, ensure_ascii=False)
+        if len(payload.encode('utf-8')) > self.MAX_PAYLOAD:
+            # 消息太长就只广播 id，订阅方自己去数据库取
+            payload = json.dumps({'channels': list(channels), 'event': event, 'id': event_id, 'data': None})
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': self.NOTIFY_CHANNEL, 'payload': payload})
+                conn.commit()
+        except SQLAlchemyError as e:
+            # 广播失败时至少保证本进程的订阅者能收到
+            print(f"[chat-bus] pg_notify failed: {e}")
+            self._deliver(channels, event, event_id, data)
+
+    def _ensure_listener(self):
+        # gunicorn fork 之后线程不会被继承，所以按进程号判断是否需要重新启动监听线程
+        if self._listener_pid == os.getpid() and self._listener.is_alive(): return
+        with self._lock:
+            if self._listener_pid == os.getpid() and self._listener.is_alive(): return
+            self._listener = threading.Thread(target=self._listen_forever, name='chat-bus-listener', daemon=True)
+            self._listener_pid = os.getpid()
+            self._listener.start()
+
+    def _listen_forever(self):
+        while True:
+            try:
+                raw = db.engine.raw_connection()
+                try:
+                    conn = raw.driver_connection
+                    conn.autocommit = True
+                    conn.cursor().execute(f"LISTEN {self.NOTIFY_CHANNEL}")
+                    while True:
+                        if select.select([conn], [], [], 30) == ([], [], []): continue
+                        conn.poll()
+                        while conn.notifies:
+                            message = json.loads(conn.notifies.pop(0).payload)
+                            self._deliver(message['channels'], message['event'], message['id'], message['data'])
+                finally:
+                    raw.invalidate()
+            except Exception as e:
+                print(f"[chat-bus] listener error, reconnecting: {e}")
+                time.sleep(1)
+
+chat_bus = PostgresBus() if os.environ.get('CHAT_BUS') == 'postgres' else InProcessBus()
+
+# --- 4.7 点赞计数 ---
+# 默认直接在数据库里原子加减（UPDATE ... SET likes_received = likes_received + 1），不再先查后改。
+# 设置 LIKE_WRITE_BEHIND=1 后，点赞数的变化先攒在本进程内存里，每隔 LIKE_FLUSH_INTERVAL 秒（以及进程退出时）批量写回。
+class LikeCounterBuffer:
+    def __init__(self, enabled, interval):
+        self.enabled = enabled
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def add(self, user_id, delta):
+        with self._lock: self._pending[user_id] = self._pending.get(user_id, 0) + delta
+        self._ensure_flusher()
+
+    def pending(self, user_id):
+        with self._lock: return self._pending.get(user_id, 0)
+
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid(): return
+        with self._lock:
+            if self._flusher_pid == os.getpid(): return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='like-counter-flusher', daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            deltas, self._pending = {k: v for k, v in self._pending.items() if v}, {}
+        if not deltas: return
+        try:
+            with app.app_context():
+                db.session.execute(
+                    text('UPDATE users SET likes_received = CASE WHEN likes_received + :delta < 0 THEN 0 ELSE likes_received + :delta END WHERE id = :user_id'),
+                    [{'user_id': user_id, 'delta': delta} for user_id, delta in deltas.items()]
+                )
+                db.session.commit()
+        except SQLAlchemyError as e:
+            # 写回失败就把增量放回去，下一轮再试
+            print(f"[like-buffer] flush failed, will retry: {e}")
+            with self._lock:
+                for user_id, delta in deltas.items(): self._pending[user_id] = self._pending.get(user_id, 0) + delta
+
+like_buffer = LikeCounterBuffer(os.environ.get('LIKE_WRITE_BEHIND') == '1', _env_float('LIKE_FLUSH_INTERVAL', 2))
+atexit.register(like_buffer.flush)
+
+@db.event.listens_for(Session, 'after_commit')
+def _commit_like_deltas(session):
+    # 点赞记录所在的事务提交成功后，增量才进入缓冲区
+    for user_id, delta in session.info.pop('like_deltas', ()): like_buffer.add(user_id, delta)
+
+@db.event.listens_for(Session, 'after_soft_rollback')
+def _discard_like_deltas(session, previous_transaction):
+    session.info.pop('like_deltas', None)
+
+def _apply_like_delta(user_id, delta):
+    # 在当前事务里给 user_id 的获赞数加上 delta，返回调用方应该看到的最新值（读自己的写）
+    if like_buffer.enabled:
+        if delta: db.session.info.setdefault('like_deltas', []).append((user_id, delta))
+        current = db.session.query(User.likes_received).filter(User.id == user_id).scalar() or 0
+        return max(0, current + like_buffer.pending(user_id) + delta)
+    if not delta:
+        return db.session.query(User.likes_received).filter(User.id == user_id).scalar()
+    new_value = User.likes_received + delta
+    return db.session.execute(
+        update(User).where(User.id == user_id)
+        .values(likes_received=case((new_value < 0, 0), else_=new_value))
+        .returning(User.likes_received)
+    ).scalar()
+
+# --- 4.8 监控指标与性能分析 ---
+# /metrics 输出 Prometheus 文本格式。指标按 worker 进程各自统计，Prometheus 抓取时请按实例区分。
+def _format_labels(labels):
+    if not labels: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels.keys(), escaped)) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help_text, self.labelnames = name, help_text, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock: items = list(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in items]
+
+class Histogram(Counter):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None: state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock: items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        result = []
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                result.append((f'{self.name}_bucket', {**labels, 'le': repr(float(bound))}, bucket_count))
+            result.append((f'{self.name}_bucket', {**labels, 'le': '+Inf'}, count))
+            result.append((f'{self.name}_sum', labels, total))
+            result.append((f'{self.name}_count', labels, count))
+        return result
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, read_fn, labelname=None):
+        # 抓取时才调用 read_fn 读取当前值；带 labelname 时 read_fn 返回 {标签值: 数值}
+        self.name, self.help_text, self.read_fn, self.labelname = name, help_text, read_fn, labelname
+
+    def samples(self):
+        try: value = self.read_fn()
+        except Exception: return []
+        if value is None: return []
+        if self.labelname: return [(self.name, {self.labelname: k}, v) for k, v in value.items()]
+        return [(self.name, {}, value)]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{_format_labels(labels)} {value}' for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.register(Counter('http_requests_total', '按路由、方法、状态码统计的请求数', ('endpoint', 'method', 'status')))
+HTTP_LATENCY = metrics.register(Histogram('http_request_duration_seconds', '请求处理耗时（流式响应只算到开始返回）', ('endpoint', 'method')))
+DB_QUERIES_PER_REQUEST = metrics.register(Histogram('db_queries_per_request', '每个请求执行的 SQL 条数', ('endpoint',), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500)))
+DB_TIME_PER_REQUEST = metrics.register(Histogram('db_query_seconds_per_request', '每个请求花在 SQL 上的总时间', ('endpoint',)))
+UPSTREAM_LATENCY = metrics.register(Histogram('upstream_request_duration_seconds', '调用上游服务（含重试）的耗时', ('upstream',)))
+UPSTREAM_ERRORS = metrics.register(Counter('upstream_errors_total', '上游服务调用失败次数', ('upstream', 'kind')))
+
+def _pool_stat(method_name):
+    def read():
+        method = getattr(db.engine.pool, method_name, None)
+        return method() if callable(method) else None
+    return read
+
+metrics.register(Gauge('db_pool_size', '连接池容量', _pool_stat('size')))
+metrics.register(Gauge('db_pool_checked_out', '正在被使用的连接数', _pool_stat('checkedout')))
+metrics.register(Gauge('db_pool_overflow', '超出容量额外创建的连接数', _pool_stat('overflow')))
+metrics.register(Gauge('upstream_circuit_open', '上游熔断器是否打开（1 = 打开或半开）', lambda: {name: int(client.breaker.state != 'closed') for name, client in upstreams.items()}, labelname='upstream'))
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # 开始时间记在这次执行自己的 context 上：语句出错时 after 不会被调用，也不会留下残留
+    context._query_started = time.perf_counter()
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    if started is not None and has_request_context() and '_metrics_started' in g:
+        g._db_queries += 1
+        g._db_time += time.perf_counter() - started
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+
+@app.before_request
+def _start_request_metrics():
+    g._metrics_started = time.perf_counter()
+    g._db_queries, g._db_time = 0, 0.0
+    # 带上 X-Profile: <PROFILE_SECRET> 请求头时对本次请求做 cProfile；没配置 PROFILE_SECRET 则完全关闭
+    secret = os.environ.get('PROFILE_SECRET')
+    if secret and request.headers.get('X-Profile') == secret:
+        g._profiler = cProfile.Profile()
+        g._profiler.enable()
+
+@app.after_request
+def _record_request_metrics(response):
+    if '_metrics_started' not in g: return response
+    elapsed = time.perf_counter() - g._metrics_started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    HTTP_LATENCY.observe(elapsed, endpoint=endpoint, method=request.method)
+    state, request_endpoint = g._get_current_object(), request.endpoint
+
+    def finish():
+        # 统计结束后 SQL 计数就停下来
+        state.pop('_metrics_started', None)
+        DB_QUERIES_PER_REQUEST.observe(state._db_queries, endpoint=endpoint)
+        DB_TIME_PER_REQUEST.observe(state._db_time, endpoint=endpoint)
+        profiler = state.pop('_profiler', None)
+        if profiler is None: return None
+        profiler.disable()
+        # 只保存慢请求的分析结果（阈值 PROFILE_MIN_MS，默认 0 表示全部保存）
+        if elapsed * 1000 < _env_float('PROFILE_MIN_MS', 0): return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = os.path.join(PROFILE_DIR, f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{request_endpoint or 'unmatched'}.prof")
+        profiler.dump_stats(filename)
+        return filename
+
+    if response.is_streamed:
+        # 流式响应剩下的查询在发送响应体时才执行，等响应结束（连接关闭）再统计 SQL 条数和耗时；
+        # 这时响应头早就发出去了，所以流式响应没有 X-Query-Count
+        response.call_on_close(finish)
+        return response
+    filename = finish()
+    response.headers['X-Query-Count'] = str(state._db_queries)
+    # 只返回文件名，不把服务器上的目录暴露出去（文件在 PROFILE_DIR 下）
+    if filename: response.headers['X-Profile-File'] = os.path.basename(filename)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # 配置了 METRICS_TOKEN 时需要 ?token= 才能访问
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.args.get('token') != token: return jsonify({'error': '未授权'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # =======================================================
 # ==================== API 路由 =========================
 # =======================================================
 
+# --- 4.9 响应序列化与压缩 ---
+# orjson 输出的 JSON 和标准库的内容一致（同样按 key 排序），只是中文不再转义成 \uXXXX
+def _json_dumps_bytes(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=DefaultJSONProvider.default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=DefaultJSONProvider.default, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if kwargs or orjson is None: return super().dumps(obj, **kwargs)
+        return _json_dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs or orjson is None: return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+app.json = FastJSONProvider(app)
+
+STREAM_JSON_BATCH = _env_int('STREAM_JSON_BATCH', 500)
+
+def stream_json_array(query, serialize):
+    # 大列表边查边输出：yield_per 在 Postgres 上用服务端游标，每批 STREAM_JSON_BATCH 行编码一次写出去，
+    # 不再先把整个列表和整段 JSON 都攒在内存里。输出和 jsonify(list) 完全一样。
+    # 视图返回后 Flask 会先弹出一次请求上下文（teardown 里 db.session 被 remove），发送响应体时 stream_with_context
+    # 再把同一个上下文推回来，发完再 teardown 一次。所以查询不用 db.session，而是单独借一个连接：
+    # 第一批在视图里就查出来（查询出错时由视图自己的 try/except 处理，结果不满一批就直接普通返回），
+    # 剩下的边读边发，响应结束时（包括客户端没读完就断开）归还连接。
+    connection = db.session.get_bind(clause=query.statement).connect()
+    session = Session(bind=connection)
+
+    def close():
+        session.close()
+        connection.close()
+
+    try:
+        rows = iter(query.with_session(session).yield_per(STREAM_JSON_BATCH))
+        first = [_json_dumps_bytes(serialize(row)) for row in islice(rows, STREAM_JSON_BATCH)]
+    except Exception:
+        close()
+        raise
+    if len(first) < STREAM_JSON_BATCH:
+        close()
+        return Response(b'[' + b','.join(first) + b']\n', mimetype='application/json')
+
+    def generate():
+        try:
+            yield b'[' + b','.join(first)
+            batch = []
+            for row in rows:
+                batch.append(_json_dumps_bytes(serialize(row)))
+                if len(batch) >= STREAM_JSON_BATCH:
+                    yield b',' + b','.join(batch)
+                    batch = []
+            if batch: yield b',' + b','.join(batch)
+            yield b']\n'
+        except SQLAlchemyError:
+            # 已经开始发送，状态码改不了：记下日志后直接结束，客户端拿到的是不完整的 JSON，不会误以为列表就这么长
+            app.logger.exception('streaming %s failed', request.path)
+        finally:
+            close()
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    response.call_on_close(close)
+    return response
+
+COMPRESS_MIN_BYTES = _env_int('COMPRESS_MIN_BYTES', 1024)
+COMPRESS_GZIP_LEVEL = _env_int('COMPRESS_GZIP_LEVEL', 6)
+COMPRESS_BROTLI_QUALITY = _env_int('COMPRESS_BROTLI_QUALITY', 4)
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml'}
+
+def _make_compressor(encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+def _compress_stream(chunks, encoding):
+    # 每一块都 flush，客户端能边收边解析
+    compress, flush, finish = _make_compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str): chunk = chunk.encode('utf-8')
+            yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'): chunks.close()
+
+def _negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']: return 'br'
+    if accepted['gzip']: return 'gzip'
+    return None
+
+@app.after_request
+def _compress_response(response):
+    # SSE（text/event-stream）、文件下载（direct_passthrough）、已经压缩过的响应都不动
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough: return response
+    if response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers: return response
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding()
+    if not encoding: return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES: return response
+        compress, _, finish = _make_compressor(encoding)
+        response.set_data(compress(data) + finish())
+    response.headers['Content-Encoding'] = encoding
+    # 同一个资源有压缩 / 不压缩两种字节，ETag 改成弱校验
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True)
+    return response
+
+# --- 4.10 后台摘要任务 ---
+# 以前摘要是浏览器调 /api/deepseek-chat 生成好再随笔记一起提交：LLM 一慢，代理 worker 被占住，标签页一关摘要就丢了。
+# 现在 add_note 带 summarize=true 时先把笔记存下来，再往 summary_jobs 表里插一条任务，由后台线程调 DeepSeek 生成摘要。
+# 队列在数据库里，进程重启不会丢任务。任务由单独常驻的 `flask summary-worker` 进程处理：
+# web 进程默认不起摘要线程（SUMMARY_WORKERS=0），否则每个 gunicorn worker 都会多出几条轮询线程和请求抢资源。
+# 只有单进程部署时才设 SUMMARY_WORKERS=N，让 web 进程收到第一个请求时自己起 N 个线程处理；`python app.py` 本地调试默认起 2 个。
+# 长文本按 SUMMARY_CHUNK_CHARS 切块，先并发为每块生成摘要，再把分块摘要合并成最终摘要（map-reduce）。
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', 'deepseek-chat')
+SUMMARY_CHUNK_CHARS = _env_int('SUMMARY_CHUNK_CHARS', 6000)
+SUMMARY_MAP_CONCURRENCY = _env_int('SUMMARY_MAP_CONCURRENCY', 4)
+SUMMARY_MAX_ATTEMPTS = _env_int('SUMMARY_MAX_ATTEMPTS', 3)
+SUMMARY_RETRY_BACKOFF = _env_float('SUMMARY_RETRY_BACKOFF', 30)
+# 分块摘要最多做几轮：模型输出不一定比输入短，不设上限会一直调上游
+SUMMARY_MAX_ROUNDS = _env_int('SUMMARY_MAX_ROUNDS', 3)
+# running 状态超过这么久还没结束，说明领取它的进程已经挂了，允许别的 worker 重新领取
+SUMMARY_JOB_LEASE = _env_float('SUMMARY_JOB_LEASE', 600)
+SUMMARY_MAP_PROMPT = '下面是一段课堂笔记的一部分，请用中文提炼其中的要点，保留关键术语和结论，不要添加原文没有的内容。'
+SUMMARY_REDUCE_PROMPT = '下面是同一份课堂笔记各部分的要点，请把它们整合成一段连贯、简洁的中文摘要。'
+SUMMARY_PROMPT = '请用中文为下面的课堂笔记写一段简洁的摘要，保留关键术语和结论，不要添加原文没有的内容。'
+
+SUMMARY_JOBS = metrics.register(Counter('summary_jobs_total', '摘要任务处理结果', ('result',)))
+
+def _split_for_summary(content, size=None):
+    # 按段落切块，单个段落太长再按长度硬切
+    size = size or SUMMARY_CHUNK_CHARS
+    chunks, current = [], ''
+    for paragraph in content.split('\n'):
+        while len(paragraph) > size:
+            if current: chunks.append(current); current = ''
+            chunks.append(paragraph[:size]); paragraph = paragraph[size:]
+        if current and len(current) + len(paragraph) + 1 > size:
+            chunks.append(current); current = ''
+        current = f'{current}\n{paragraph}' if current else paragraph
+    if current.strip(): chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+def _deepseek_complete(system_prompt, user_content, course_name=None):
+    if course_name: system_prompt = f'这是《{course_name}》课程的课堂笔记。{system_prompt}'
+    api_key = os.environ.get('DEEPSEEK_API_KEY')
+    if not api_key: raise UpstreamError('deepseek', '服务器未配置 DeepSeek API Key')
+    response = upstreams['deepseek'].request('POST', '/chat/completions', headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}, json={
+        'model': SUMMARY_MODEL,
+        'messages': [{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': user_content}],
+        'stream': False
+    })
+    try:
+        return response.json()['choices'][0]['message']['content'].strip()
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        raise UpstreamError('deepseek', f'无法解析摘要结果: {e}') from e
+
+summary_map_executor = ThreadPoolExecutor(max_workers=SUMMARY_MAP_CONCURRENCY, thread_name_prefix='summary-map')
+
+class SummaryTooLongError(Exception):
+    pass
+
+def summarize_text(content, course_name=None, depth=0):
+    chunks = _split_for_summary(content)
+    if not chunks: return ''
+    if len(chunks) == 1: return _deepseek_complete(SUMMARY_PROMPT, chunks[0], course_name)
+    partials = list(summary_map_executor.map(lambda chunk: _deepseek_complete(SUMMARY_MAP_PROMPT, chunk, course_name), chunks))
+    combined = '\n\n'.join(partials)
+    # 分块摘要合起来还是太长，就再做一轮
+    if len(combined) > SUMMARY_CHUNK_CHARS:
+        if depth + 1 >= SUMMARY_MAX_ROUNDS: raise SummaryTooLongError(f'笔记太长，{SUMMARY_MAX_ROUNDS} 轮分块摘要后仍超过 {SUMMARY_CHUNK_CHARS} 字')
+        return summarize_text(combined, course_name, depth + 1)
+    return _deepseek_complete(SUMMARY_REDUCE_PROMPT, combined, course_name)
+
+def _claim_summary_job():
+    # 先挑一条可执行的任务，再用带条件的 UPDATE 抢占：两个 worker 挑到同一条时只有一个能更新成功
+    now = datetime.utcnow()
+    expired = and_(SummaryJob.status == 'running', SummaryJob.locked_at < now - timedelta(seconds=SUMMARY_JOB_LEASE))
+    # 租约过期说明处理它的进程挂了（或一直在出错），次数用完就不再领取，直接标记失败
+    db.session.execute(
+        update(SummaryJob).where(expired, SummaryJob.attempts >= SUMMARY_MAX_ATTEMPTS)
+        .values(status='failed', locked_at=None, last_error='处理超时，已达最大重试次数', finished_at=now)
+    )
+    ready = or_(
+        and_(SummaryJob.status == 'pending', SummaryJob.run_after <= now),
+        and_(expired, SummaryJob.attempts < SUMMARY_MAX_ATTEMPTS)
+    )
+    candidate = db.session.query(SummaryJob.id).filter(ready).order_by(SummaryJob.run_after, SummaryJob.id).limit(1)
+    if db.engine.dialect.name == 'postgresql': candidate = candidate.with_for_update(skip_locked=True)
+    job_id = candidate.scalar()
+    claimed = None
+    if job_id is not None:
+        claimed = db.session.execute(
+            update(SummaryJob).where(SummaryJob.id == job_id, ready)
+            .values(status='running', locked_at=now, attempts=SummaryJob.attempts + 1)
+            .returning(SummaryJob.id, SummaryJob.note_id, SummaryJob.user_id, SummaryJob.attempts, SummaryJob.course_name)
+        ).first()
+    db.session.commit()
+    return claimed
+
+def _finish_summary_job(job, values):
+    db.session.execute(update(SummaryJob).where(SummaryJob.id == job.id).values(locked_at=None, **values))
+
+def _summary_event_data(job):
+    data = job.to_dict()
+    if job.status == 'done': data['summary'] = job.note.summary
+    return data
+
+def _publish_summary_event(job_id):
+    row = db.session.query(SummaryJob, User.username).join(User, User.id == SummaryJob.user_id).filter(SummaryJob.id == job_id).first()
+    if not row: return
+    job, username = row
+    chat_bus.publish([username], 'note_summary', job.id, _summary_event_data(job))
+
+def run_summary_job(job):
+    content = db.session.query(Note.content).filter(Note.id == job.note_id).scalar()
+    # 读完笔记就把连接还掉，调 LLM 可能要几十秒
+    db.session.commit()
+    if content is None:
+        _finish_summary_job(job, {'status': 'failed', 'last_error': '笔记已被删除', 'finished_at': datetime.utcnow()})
+        db.session.commit()
+        return
+    try:
+        summary = summarize_text(content, job.course_name)
+    except SummaryTooLongError as e:
+        # 重试也还是这么长，直接标记失败
+        app.logger.warning("summary job %s failed: %s", job.id, e)
+        _fail_summary_job(job, str(e), retry=False)
+        return
+    except Exception as e:
+        # 不只是上游错误：任何异常都要把任务放回队列或标记失败，否则它会一直停在 running
+        if isinstance(e, UpstreamError): app.logger.warning("summary job %s attempt %s failed: %s", job.id, job.attempts, e)
+        else: app.logger.exception("summary job %s attempt %s failed", job.id, job.attempts)
+        _fail_summary_job(job, str(e) if isinstance(e, UpstreamError) else '生成摘要时发生内部错误')
+        return
+    # 摘要写回笔记也是一次数据变更：笔记版本号跟着涨，增量同步和 ETag 才能看到
+    updated = db.session.execute(update(Note).where(Note.id == job.note_id).values(summary=summary, version=_bump_data_version(job.user_id))).rowcount
+    if updated: _finish_summary_job(job, {'status': 'done', 'last_error': None, 'finished_at': datetime.utcnow()})
+    else: _finish_summary_job(job, {'status': 'failed', 'last_error': '笔记已被删除', 'finished_at': datetime.utcnow()})
+    db.session.commit()
+    SUMMARY_JOBS.inc(result='done' if updated else 'failed')
+    _publish_summary_event(job.id)
+
+def _fail_summary_job(job, error, retry=True):
+    retry = retry and job.attempts < SUMMARY_MAX_ATTEMPTS
+    if retry:
+        retry_at = datetime.utcnow() + timedelta(seconds=SUMMARY_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+        _finish_summary_job(job, {'status': 'pending', 'last_error': error, 'run_after': retry_at})
+        SUMMARY_JOBS.inc(result='retry')
+    else:
+        _finish_summary_job(job, {'status': 'failed', 'last_error': error, 'finished_at': datetime.utcnow()})
+        SUMMARY_JOBS.inc(result='failed')
+    db.session.commit()
+    if not retry: _publish_summary_event(job.id)
+
+class SummaryWorkerPool:
+    def __init__(self, size, poll_interval):
+        self.size = size
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._workers_pid = None
+
+    def notify(self):
+        # 本进程刚入队了任务：叫醒空闲的 worker，不用等下一轮轮询
+        self.ensure_started()
+        self._wakeup.set()
+
+    def ensure_started(self):
+        # 和点赞计数的写回线程一样，按进程号判断：gunicorn fork 之后线程不会被继承
+        if self.size <= 0 or self._workers_pid == os.getpid(): return
+        with self._lock:
+            if self._workers_pid == os.getpid(): return
+            self._workers_pid = os.getpid()
+            for i in range(self.size):
+                threading.Thread(target=self.work_forever, name=f'summary-worker-{i}', daemon=True).start()
+
+    def work_forever(self):
+        while True:
+            job = None
+            try:
+                with app.app_context():
+                    job = _claim_summary_job()
+                    if job: run_summary_job(job)
+            except Exception:
+                # 数据库暂时连不上之类的错误：任务还在表里，租约过期后会被重新领取（次数用完则标记失败）
+                app.logger.exception("summary worker error (job %s)", job.id if job else None)
+                job = None
+            if job: continue
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+summary_workers = SummaryWorkerPool(_env_int('SUMMARY_WORKERS', 2 if __name__ == '__main__' else 0), _env_float('SUMMARY_POLL_INTERVAL', 5))
+
+@app.before_request
+def _start_summary_workers():
+    # 设了 SUMMARY_WORKERS 时，每个进程第一次处理请求时启动（之后只是比较一下进程号）；表还没建好时先不启动
+    if schema_is_current(): summary_workers.ensure_started()
+
+@app.cli.command('summary-worker')
+@click.option('--threads', default=2, help='同时处理多少个摘要任务')
+def summary_worker(threads):
+    # 独立的摘要处理进程：web 进程默认不处理摘要任务，由它来消费队列
+    pool = SummaryWorkerPool(threads, summary_workers.poll_interval)
+    pool.ensure_started()
+    print(f"摘要 worker 已启动（{threads} 个线程），按 Ctrl+C 退出")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
 # --- 5. 用户认证 API ---
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -240,7 +2003,7 @@ def login():
     user = User.query.filter_by(username=username).first()
     if user and user.password == password:
         token = jwt.encode({
-            'user_id': user.id, 'username': user.username,
+            'user_id': user.id, 'username': user.username, 'tv': user.token_version,
             # 正确的代码
             'exp': datetime.utcnow() + timedelta(hours=24)
         }, app.config['SECRET_KEY'], algorithm='HS256')
@@ -255,15 +2018,55 @@ def login():
     else:
         return jsonify({'message': '用户名或密码错误'}), 401
 
+@app.route('/api/logout-all', methods=['POST'])
+def logout_all_devices():
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    User.query.filter_by(id=user_info['user_id']).update({User.token_version: User.token_version + 1}, synchronize_session=False)
+    db.session.commit()
+    _token_versions.pop(user_info['user_id'])
+    return jsonify({'message': '已退出所有设备，请重新登录'})
+
 @app.route('/api/user/stats', methods=['GET'])
 def get_user_stats():
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
-    user = User.query.get(user_info['user_id'])
+    user = get_current_user()
     if not user: return jsonify({'error': '用户不存在'}), 404
-    return jsonify({'likes_received': user.likes_received})
+    return jsonify({'likes_received': user.likes_received + like_buffer.pending(user.id)})
 
 # --- 6. 笔记和单词本 API ---
+# 每次写笔记 / 单词本都先把 users.data_version 原子地加一，新版本号写到改动的行和删除记录上。
+# 这一行在提交前一直被锁着，同一个用户的写入按版本号顺序提交，增量同步不会漏掉数据。
+def _bump_data_version(user_id):
+    return db.session.execute(
+        update(User).where(User.id == user_id).values(data_version=User.data_version + 1).returning(User.data_version)
+    ).scalar_one()
+
+def _add_tombstones(user_id, kind, object_ids, version):
+    if object_ids:
+        db.session.execute(insert(SyncTombstone), [{'user_id': user_id, 'kind': kind, 'object_id': object_id, 'version': version} for object_id in object_ids])
+
+def _current_data_version(user_id):
+    return db.session.query(User.data_version).filter_by(id=user_id).scalar() or 0
+
+def _collection_etag(kind, user_id, version):
+    return f'{kind}-{user_id}-{version}'
+
+def _not_modified(etag):
+    # 版本没变就直接 304，不用再查笔记 / 单词
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+def _with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/api/notes', methods=['POST'])
 def add_note():
     user_info = get_user_from_token()
@@ -271,10 +2074,32 @@ def add_note():
     data = request.get_json()
     content, summary = data.get('content'), data.get('summary')
     if not content: return jsonify({'error': '内容不能为空'}), 400
-    new_note = Note(content=content, summary=summary, user_id=user_info['user_id'])
+    new_note = Note(content=content, summary=summary, user_id=user_info['user_id'], version=_bump_data_version(user_info['user_id']))
     db.session.add(new_note)
+    # summarize=true 且没带摘要：笔记先存下来，摘要交给后台任务生成，接口不用等 LLM
+    job = SummaryJob(note=new_note, user_id=user_info['user_id'], course_name=(data.get('course_name') or '')[:200] or None) if data.get('summarize') and not summary else None
+    if job: db.session.add(job)
     db.session.commit()
-    return jsonify({'message': '笔记已保存', 'note': new_note.to_dict()}), 201
+    if not job: return jsonify({'message': '笔记已保存', 'note': new_note.to_dict()}), 201
+    summary_workers.notify()
+    return jsonify({'message': '笔记已保存，摘要生成中', 'note': new_note.to_dict(), 'summary_job': job.to_dict()}), 201
+
+@app.route('/api/note/<int:note_id>/summary', methods=['GET', 'POST'])
+def note_summary_status(note_id):
+    # GET 查询最近一次摘要任务的状态（也可以订阅 /api/chat/stream 的 note_summary 事件）；POST 重新生成摘要
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    note = Note.query.filter_by(id=note_id, user_id=user_info['user_id']).first()
+    if not note: return jsonify({'error': '笔记不存在或无权访问'}), 404
+    job = SummaryJob.query.filter_by(note_id=note.id).order_by(SummaryJob.id.desc()).first()
+    if request.method == 'POST':
+        if job and job.status in ('pending', 'running'): return jsonify({'note_id': note.id, 'summary': note.summary, 'job': job.to_dict()}), 202
+        job = SummaryJob(note_id=note.id, user_id=user_info['user_id'], course_name=job.course_name if job else None)
+        db.session.add(job)
+        db.session.commit()
+        summary_workers.notify()
+        return jsonify({'note_id': note.id, 'summary': note.summary, 'job': job.to_dict()}), 202
+    return jsonify({'note_id': note.id, 'summary': note.summary, 'job': job.to_dict() if job else None})
 
 @app.route('/api/note/<int:note_id>', methods=['GET', 'DELETE'])
 def handle_single_note(note_id):
@@ -284,6 +2109,7 @@ def handle_single_note(note_id):
     if not note: return jsonify({'error': '笔记不存在或无权访问'}), 404
     if request.method == 'GET': return jsonify(note.to_dict())
     if request.method == 'DELETE':
+        _add_tombstones(user_info['user_id'], 'note', [note.id], _bump_data_version(user_info['user_id']))
         db.session.delete(note)
         db.session.commit()
         return jsonify({'message': '笔记已删除'})
@@ -292,8 +2118,15 @@ def handle_single_note(note_id):
 def get_notes():
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
-    notes = Note.query.filter_by(user_id=user_info['user_id']).order_by(desc(Note.created_at)).all()
-    return jsonify([n.to_dict() for n in notes])
+    etag = _collection_etag('notes', user_info['user_id'], _current_data_version(user_info['user_id']))
+    not_modified = _not_modified(etag)
+    if not_modified: return not_modified
+    notes = Note.query.filter_by(user_id=user_info['user_id']).order_by(desc(Note.created_at))
+    return _with_etag(stream_json_array(notes, Note.to_dict), etag)
+
+def _adjust_vocab_count(user_id, delta):
+    # 在数据库里原子地加减，和单词的增删在同一个事务里提交
+    User.query.filter_by(id=user_id).update({User.vocab_count: User.vocab_count + delta}, synchronize_session=False)
 
 @app.route('/api/vocab', methods=['POST'])
 def add_vocab():
@@ -302,8 +2135,9 @@ def add_vocab():
     data = request.get_json()
     if not data or not data.get('word') or not data.get('meaning'): return jsonify({'error': '缺少必要数据'}), 400
     if Vocab.query.filter_by(user_id=user_info['user_id'], word=data['word']).first(): return jsonify({'message': '单词已在您的单词本中'}), 200
-    new_vocab = Vocab(word=data['word'], phonetic=data.get('phonetic'), meaning=data['meaning'], user_id=user_info['user_id'])
+    new_vocab = Vocab(word=data['word'], phonetic=data.get('phonetic'), meaning=data['meaning'], user_id=user_info['user_id'], version=_bump_data_version(user_info['user_id']))
     db.session.add(new_vocab)
+    _adjust_vocab_count(user_info['user_id'], 1)
     db.session.commit()
     return jsonify({'message': '单词已添加', 'vocab': new_vocab.to_dict()}), 201
 
@@ -316,10 +2150,13 @@ def handle_single_vocab(vocab_id):
     if request.method == 'PUT':
         data = request.get_json()
         if 'word' in data: vocab_item.word = data['word']
+        vocab_item.version = _bump_data_version(user_info['user_id'])
         db.session.commit()
         return jsonify({'message': '单词更新成功'}), 200
     if request.method == 'DELETE':
+        _add_tombstones(user_info['user_id'], 'vocab', [vocab_item.id], _bump_data_version(user_info['user_id']))
         db.session.delete(vocab_item)
+        _adjust_vocab_count(user_info['user_id'], -1)
         db.session.commit()
         return jsonify({'message': '单词已删除'})
 
@@ -327,29 +2164,373 @@ def handle_single_vocab(vocab_id):
 def get_vocab():
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
-    vocabs = Vocab.query.filter_by(user_id=user_info['user_id']).order_by(Vocab.word).all()
-    return jsonify([v.to_dict() for v in vocabs])
+    etag = _collection_etag('vocab', user_info['user_id'], _current_data_version(user_info['user_id']))
+    not_modified = _not_modified(etag)
+    if not_modified: return not_modified
+    vocabs = Vocab.query.filter_by(user_id=user_info['user_id']).order_by(Vocab.word)
+    return _with_etag(stream_json_array(vocabs, Vocab.to_dict), etag)
+
+@app.route('/api/sync', methods=['GET'])
+def sync_notes_and_vocab():
+    # 增量同步：返回 since_version 之后新增 / 修改的笔记和单词，以及被删掉的 id。
+    # 客户端保存返回的 version，下次带上它；since_version=0 相当于全量拉取。
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    user_id = user_info['user_id']
+    since = request.args.get('since_version', 0, type=int)
+    current = _current_data_version(user_id)
+    # 客户端的版本比服务器还新（比如数据库被重置过），只能全量同步
+    full = since <= 0 or since > current
+    if full: since = 0
+    etag = _collection_etag('sync', user_id, f'{since}-{current}')
+    not_modified = _not_modified(etag)
+    if not_modified: return not_modified
+    notes, vocabs = Note.query.filter(Note.user_id == user_id), Vocab.query.filter(Vocab.user_id == user_id)
+    if not full:
+        # 只取到 current 为止：读完版本号之后才提交的写入留给下一次同步
+        notes = notes.filter(Note.version > since, Note.version <= current)
+        vocabs = vocabs.filter(Vocab.version > since, Vocab.version <= current)
+    notes, vocabs = notes.order_by(Note.version, Note.id).all(), vocabs.order_by(Vocab.version, Vocab.id).all()
+    deleted = {'notes': [], 'vocab': []}
+    if not full:
+        tombstones = db.session.query(SyncTombstone.kind, SyncTombstone.object_id).filter(
+            SyncTombstone.user_id == user_id, SyncTombstone.version > since, SyncTombstone.version <= current
+        ).order_by(SyncTombstone.version)
+        for kind, object_id in tombstones: deleted['notes' if kind == 'note' else 'vocab'].append(object_id)
+    return _with_etag(jsonify({
+        'version': current,
+        'full': full,
+        'notes': [{**n.to_dict(), 'version': n.version} for n in notes],
+        'vocab': [{**v.to_dict(), 'version': v.version} for v in vocabs],
+        'deleted': deleted
+    }), etag)
+
+# --- 6.1 批量单词本 / 笔记 API ---
+# 导入单词表、离线同步时一次提交很多条：整个批次一个事务、一次 commit，按条返回处理结果
+BULK_MAX_ITEMS = 1000
+
+def _bulk_items(data, key):
+    if not isinstance(data, dict): return None, (jsonify({'error': '请求体必须是 JSON 对象'}), 400)
+    items = data.get(key)
+    if not isinstance(items, list) or not items: return None, (jsonify({'error': f'{key} 必须是非空数组'}), 400)
+    if len(items) > BULK_MAX_ITEMS: return None, (jsonify({'error': f'单次最多处理 {BULK_MAX_ITEMS} 条'}), 400)
+    return items, None
+
+def _is_int_id(value):
+    # JSON 里的 true / false 在 Python 里也是 int，要排除掉
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _valid_vocab_fields(values):
+    # 和表结构一致：word / phonetic 最长 100，word 和 meaning 不能为空；只检查 values 里出现的字段
+    if 'word' in values and not (isinstance(values['word'], str) and 0 < len(values['word']) <= 100): return False
+    if 'meaning' in values and not (isinstance(values['meaning'], str) and values['meaning']): return False
+    if values.get('phonetic') is not None and not (isinstance(values['phonetic'], str) and len(values['phonetic']) <= 100): return False
+    return True
+
+@app.route('/api/vocab/bulk', methods=['POST'])
+def bulk_add_vocab():
+    # on_conflict=ignore（默认）：已存在的单词保持不变；on_conflict=update：用新的音标和释义覆盖
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    data = request.get_json(silent=True)
+    items, error = _bulk_items(data, 'items')
+    if error: return error
+    on_conflict = data.get('on_conflict', 'ignore')
+    if on_conflict not in ('ignore', 'update'): return jsonify({'error': 'on_conflict 只能是 ignore 或 update'}), 400
+    user_id = user_info['user_id']
+    results, rows = [None] * len(items), {}
+    for i, item in enumerate(items):
+        word = item.get('word') if isinstance(item, dict) else None
+        if not isinstance(item, dict) or 'word' not in item or 'meaning' not in item or not _valid_vocab_fields(item):
+            results[i] = {'index': i, 'word': word if isinstance(word, str) else None, 'status': 'invalid'}
+        elif word in rows:
+            results[i] = {'index': i, 'word': word, 'status': 'duplicate'}
+        else:
+            rows[word] = {'word': word, 'phonetic': item.get('phonetic'), 'meaning': item['meaning'], 'user_id': user_id}
+    created = updated = 0
+    if rows:
+        try:
+            version = _bump_data_version(user_id)
+            for row in rows.values(): row['version'] = version
+            existing = {row.word for row in db.session.query(Vocab.word).filter(Vocab.user_id == user_id, Vocab.word.in_(list(rows)))}
+            stmt = _dialect_insert(Vocab).values(list(rows.values()))
+            if on_conflict == 'update':
+                stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'word'], set_={'phonetic': stmt.excluded.phonetic, 'meaning': stmt.excluded.meaning, 'version': stmt.excluded.version})
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=['user_id', 'word'])
+            # RETURNING 只包含真正插入（或更新）了的行
+            written = dict(db.session.execute(stmt.returning(Vocab.word, Vocab.id)).all())
+            created = sum(1 for word in written if word not in existing)
+            updated = len(written) - created
+            if created: _adjust_vocab_count(user_id, created)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Error in bulk_add_vocab: {e}")
+            return jsonify({'error': '批量添加失败，服务器内部错误'}), 500
+        for i, item in enumerate(items):
+            if results[i] is not None: continue
+            word = item['word']
+            if word in written: results[i] = {'index': i, 'word': word, 'status': 'updated' if word in existing else 'created', 'id': written[word]}
+            else: results[i] = {'index': i, 'word': word, 'status': 'exists'}
+    return jsonify({'created': created, 'updated': updated, 'results': results}), 200
+
+@app.route('/api/vocab/bulk', methods=['PUT'])
+def bulk_update_vocab():
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    items, error = _bulk_items(request.get_json(silent=True), 'items')
+    if error: return error
+    if not all(isinstance(item, dict) and _is_int_id(item.get('id')) for item in items): return jsonify({'error': 'items 里每一项都必须带整数 id'}), 400
+    user_id = user_info['user_id']
+    ids = [item['id'] for item in items]
+    owned = {row[0] for row in db.session.query(Vocab.id).filter(Vocab.user_id == user_id, Vocab.id.in_(ids))}
+    results, updates = [], {}
+    for i, item in enumerate(items):
+        vocab_id = item['id']
+        values = {k: item[k] for k in ('word', 'phonetic', 'meaning') if k in item}
+        if vocab_id not in owned:
+            results.append({'index': i, 'id': vocab_id, 'status': 'not_found'})
+        elif not values or not _valid_vocab_fields(values):
+            results.append({'index': i, 'id': vocab_id, 'status': 'invalid'})
+        else:
+            # 要改的字段相同的行放在一组，用一次 executemany 批量更新
+            updates.setdefault(tuple(sorted(values)), []).append({'_id': vocab_id, **values})
+            results.append({'index': i, 'id': vocab_id, 'status': 'updated'})
+    try:
+        version = _bump_data_version(user_id) if updates else None
+        for columns, params in updates.items():
+            stmt = update(Vocab.__table__).where(Vocab.__table__.c.id == db.bindparam('_id')).values(
+                {**{c: db.bindparam(c) for c in columns}, 'version': version})
+            db.session.execute(stmt, params)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': '修改后的单词与单词本中已有单词重复'}), 409
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error in bulk_update_vocab: {e}")
+        return jsonify({'error': '批量修改失败，服务器内部错误'}), 500
+    return jsonify({'updated': sum(len(p) for p in updates.values()), 'results': results}), 200
+
+@app.route('/api/vocab/bulk', methods=['DELETE'])
+def bulk_delete_vocab():
+    # 按 ids 或 words 批量删除
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    data = request.get_json(silent=True)
+    key = 'ids' if isinstance(data, dict) and 'ids' in data else 'words'
+    items, error = _bulk_items(data, key)
+    if error: return error
+    if key == 'ids' and not all(_is_int_id(value) for value in items): return jsonify({'error': 'ids 必须是整数数组'}), 400
+    if key == 'words' and not all(isinstance(value, str) for value in items): return jsonify({'error': 'words 必须是字符串数组'}), 400
+    column = Vocab.id if key == 'ids' else Vocab.word
+    user_id = user_info['user_id']
+    try:
+        deleted = dict(db.session.execute(
+            delete(Vocab).where(Vocab.user_id == user_id, column.in_(items)).returning(Vocab.id, Vocab.word)
+        ).all())
+        if deleted:
+            _adjust_vocab_count(user_id, -len(deleted))
+            _add_tombstones(user_id, 'vocab', list(deleted), _bump_data_version(user_id))
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error in bulk_delete_vocab: {e}")
+        return jsonify({'error': '批量删除失败，服务器内部错误'}), 500
+    found = set(deleted) if key == 'ids' else set(deleted.values())
+    return jsonify({
+        'deleted': len(deleted),
+        'results': [{'index': i, key[:-1]: value, 'status': 'deleted' if value in found else 'not_found'} for i, value in enumerate(items)]
+    }), 200
+
+@app.route('/api/notes/bulk', methods=['POST'])
+def bulk_add_notes():
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    items, error = _bulk_items(request.get_json(silent=True), 'notes')
+    if error: return error
+    results, rows = [], []
+    for i, item in enumerate(items):
+        content = item.get('content') if isinstance(item, dict) else None
+        if not content or not isinstance(content, str) or not isinstance(item.get('summary'), (str, type(None))):
+            results.append({'index': i, 'status': 'invalid'})
+            continue
+        rows.append({'content': content, 'summary': item.get('summary'), 'user_id': user_info['user_id'], 'created_at': datetime.utcnow()})
+        results.append({'index': i, 'status': 'created'})
+    if rows:
+        try:
+            version = _bump_data_version(user_info['user_id'])
+            for row in rows: row['version'] = version
+            inserted = db.session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True), rows).all()
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"Error in bulk_add_notes: {e}")
+            return jsonify({'error': '批量保存失败，服务器内部错误'}), 500
+        created = iter(inserted)
+        for result in results:
+            if result['status'] == 'created': result['id'] = next(created).id
+    return jsonify({'created': len(rows), 'results': results}), 201
+
+# --- 6.2 搜索 API ---
+SEARCH_MAX_LIMIT = 50
+# 高亮标记先用控制字符占位，转义完 HTML 之后再换成 <mark>，用户内容里的标签不会被原样输出
+_SNIPPET_START, _SNIPPET_STOP = '\x02', '\x03'
+SEARCH_RESULT_COLUMNS = {
+    'notes': ('id', 'summary', 'created_at'),
+    'vocab': ('id', 'word', 'phonetic', 'meaning'),
+    'topics': ('id', 'title', 'created_at', 'author_username'),
+}
+
+def _format_snippet(raw):
+    plain = ' '.join(re.sub(r'<[^<>]*>', ' ', raw or '').split())
+    return html.escape(plain).replace(_SNIPPET_START, '<mark>').replace(_SNIPPET_STOP, '</mark>')
+
+def _fts5_query(q):
+    # 用户输入不能直接交给 FTS5 的查询语法：每个词加引号按 AND 组合，最后一个词做前缀匹配
+    terms = [term.replace('"', '') for term in q.split()]
+    terms = [term for term in terms if term]
+    if not terms: return None
+    return ' '.join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+
+def _search_scope(scope, q, user_id, limit, offset):
+    model = SEARCH_SCOPES[scope]['model']
+    table = model.__tablename__
+    columns = ', '.join(f'd.{c}' for c in SEARCH_RESULT_COLUMNS[scope])
+    params = {'q': q, 'user_id': user_id, 'limit': limit + 1, 'offset': offset}
+    user_filter = 'AND d.user_id = :user_id' if SEARCH_SCOPES[scope]['user_scoped'] else ''
+    if db.engine.dialect.name == 'postgresql':
+        # 先按索引取出当前页的 id 和得分，再只对这一页生成高亮片段（ts_headline 很贵）
+        first, second = SEARCH_SCOPES[scope]['columns']
+        params['headline_options'] = f'StartSel={_SNIPPET_START}, StopSel={_SNIPPET_STOP}, MaxFragments=2, MaxWords=20, MinWords=5'
+        sql = f"""
+            WITH query AS (SELECT websearch_to_tsquery('{SEARCH_TS_CONFIG}', :q) AS tsq),
+            hits AS (
+                SELECT d.id, ts_rank({_search_document_sql(scope, 'd')}, query.tsq) AS rank
+                FROM {table} d, query
+                WHERE {_search_document_sql(scope, 'd')} @@ query.tsq {user_filter}
+                ORDER BY rank DESC, d.id DESC LIMIT :limit OFFSET :offset
+            )
+            SELECT {columns}, hits.rank,
+                   ts_headline('{SEARCH_TS_CONFIG}', coalesce(d.{first}, '') || ' ' || coalesce(d.{second}, ''), query.tsq, :headline_options) AS snippet
+            FROM hits JOIN {table} d ON d.id = hits.id, query
+            ORDER BY hits.rank DESC, d.id DESC"""
+    else:
+        params['q'] = _fts5_query(q)
+        if params['q'] is None: return [], False
+        sql = f"""
+            SELECT {columns}, bm25({table}_fts, 4.0, 1.0) AS rank,
+                   snippet({table}_fts, -1, '{_SNIPPET_START}', '{_SNIPPET_STOP}', '…', 16) AS snippet
+            FROM {table}_fts JOIN {table} d ON d.id = {table}_fts.rowid
+            WHERE {table}_fts MATCH :q {user_filter}
+            ORDER BY rank, d.id DESC LIMIT :limit OFFSET :offset"""
+    rows = db.session.execute(text(sql), params).mappings().all()
+    results = []
+    for row in rows[:limit]:
+        item = {c: row[c] for c in SEARCH_RESULT_COLUMNS[scope]}
+        if 'created_at' in item and item['created_at'] is not None:
+            created_at = item['created_at']
+            if isinstance(created_at, str): created_at = datetime.fromisoformat(created_at)
+            item['created_at'] = created_at.isoformat() + 'Z'
+        item['snippet'] = _format_snippet(row['snippet'])
+        results.append(item)
+    return results, len(rows) > limit
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    # scope=all|notes|vocab|topics；笔记和单词本只搜自己的，需要登录；广场帖子不需要
+    q = (request.args.get('q') or '').strip()
+    if not q: return jsonify({'error': '搜索内容不能为空'}), 400
+    if len(q) > 200: return jsonify({'error': '搜索内容过长'}), 400
+    scope = request.args.get('scope', 'all')
+    if scope != 'all' and scope not in SEARCH_SCOPES: return jsonify({'error': 'scope 只能是 all、notes、vocab 或 topics'}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), SEARCH_MAX_LIMIT))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    user_info = get_user_from_token()
+    if scope == 'all': scopes = list(SEARCH_SCOPES) if user_info else ['topics']
+    else: scopes = [scope]
+    if not user_info and any(SEARCH_SCOPES[s]['user_scoped'] for s in scopes): return jsonify({'error': '未授权'}), 401
+    try:
+        results = {}
+        for s in scopes:
+            items, has_more = _search_scope(s, q, user_info and user_info['user_id'], limit, offset)
+            results[s] = {'items': items, 'has_more': has_more}
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error in search: {e}")
+        return jsonify({'error': '搜索时发生服务器错误'}), 500
+    return jsonify({'query': q, 'limit': limit, 'offset': offset, 'results': results})
+
+@app.cli.command('search-reindex')
+def search_reindex():
+    # 建好缺失的搜索索引 / 触发器，然后整体重建一遍
+    _upgrade_search_indexes()
+    for config in SEARCH_SCOPES.values():
+        table = config['model'].__tablename__
+        print(f"正在重建搜索索引: {table} ...")
+        if db.engine.dialect.name == 'postgresql': db.session.execute(text(f'REINDEX INDEX ix_{table}_search'))
+        elif db.engine.dialect.name == 'sqlite': db.session.execute(text(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"))
+        db.session.commit()
+    print("搜索索引重建完成！")
 
 # --- 7. 排名与点赞 API ---
 @app.route('/api/rank', methods=['GET'])
+@use_read_replica
 def get_rank_list():
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
     current_user_id = user_info['user_id']
-  
-    # 【恢复】使用您原来的 group_by 写法，更严谨
-    rank_query = db.session.query(
-        User.id, User.username, User.likes_received,
-        func.count(Vocab.id).label('vocab_count')
-    ).outerjoin(Vocab, User.id == Vocab.user_id)\
-     .group_by(User.id, User.username, User.likes_received)\
-     .order_by(desc('vocab_count'), desc('likes_received'))\
-     .all()
-
-    likes_by_me = Like.query.filter_by(liker_id=current_user_id).all()
-    liked_user_ids = {like.liked_user_id for like in likes_by_me}
-    rank_list = [{'user_id': user.id, 'username': user.username, 'likes_received': user.likes_received, 'vocab_count': user.vocab_count} for user in rank_query]
-    return jsonify({'rankings': rank_list, 'liked_by_me': list(liked_user_ids)})
+    # 只取当前这一页（默认前 100 名），直接按 ix_users_rank 索引顺序读
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    rank_query = _rank_columns_query().order_by(*RANK_ORDER).offset(offset).limit(limit).all()
+    rank_list = [_rank_row_to_dict(user) for user in rank_query]
+    return jsonify({'rankings': rank_list, 'liked_by_me': _liked_user_ids(current_user_id, [user.id for user in rank_query])})
+
+RANK_ORDER = (User.vocab_count.desc(), User.likes_received.desc(), User.id.asc())
+
+def _rank_columns_query():
+    return db.session.query(User.id, User.username, User.likes_received, User.vocab_count)
+
+def _rank_row_to_dict(user, rank=None):
+    row = {'user_id': user.id, 'username': user.username, 'likes_received': user.likes_received, 'vocab_count': user.vocab_count}
+    if rank is not None: row['rank'] = rank
+    return row
+
+def _rank_ahead_of(me):
+    # 排在 me 前面的条件，和 RANK_ORDER 保持一致：单词多 > 获赞多 > id 小
+    return or_(
+        User.vocab_count > me.vocab_count,
+        and_(User.vocab_count == me.vocab_count, User.likes_received > me.likes_received),
+        and_(User.vocab_count == me.vocab_count, User.likes_received == me.likes_received, User.id < me.id)
+    )
+
+def _liked_user_ids(liker_id, user_ids):
+    # 只检查当前页面上的这些用户，而不是把我点过的赞全部查出来
+    if not user_ids: return []
+    return [row[0] for row in db.session.query(Like.liked_user_id).filter(Like.liker_id == liker_id, Like.liked_user_id.in_(user_ids))]
+
+@app.route('/api/rank/me', methods=['GET'])
+@use_read_replica
+def get_my_rank():
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    radius = min(max(request.args.get('radius', 5, type=int), 0), 50)
+    me = _rank_columns_query().filter(User.id == user_info['user_id']).first()
+    if not me: return jsonify({'error': '用户不存在'}), 404
+    ahead = _rank_ahead_of(me)
+    rank = db.session.query(func.count(User.id)).filter(ahead).scalar() + 1
+    above = _rank_columns_query().filter(ahead).order_by(User.vocab_count.asc(), User.likes_received.asc(), User.id.desc()).limit(radius).all() if radius else []
+    below = _rank_columns_query().filter(~ahead, User.id != me.id).order_by(*RANK_ORDER).limit(radius).all() if radius else []
+    neighbours = [_rank_row_to_dict(user, rank - i - 1) for i, user in enumerate(above)][::-1]
+    neighbours.append(_rank_row_to_dict(me, rank))
+    neighbours.extend(_rank_row_to_dict(user, rank + i + 1) for i, user in enumerate(below))
+    return jsonify({
+        'rank': rank,
+        'neighbours': neighbours,
+        'liked_by_me': _liked_user_ids(me.id, [row['user_id'] for row in neighbours if row['user_id'] != me.id])
+    })
 
 @app.route('/api/user/<int:liked_user_id>/like', methods=['POST'])
 def toggle_like(liked_user_id):
@@ -357,20 +2538,19 @@ def toggle_like(liked_user_id):
     if not user_info: return jsonify({'error': '未授权'}), 401
     liker_id = user_info['user_id']
     if liker_id == liked_user_id: return jsonify({'error': '不能给自己点赞'}), 400
-    liked_user = User.query.get(liked_user_id)
-    if not liked_user: return jsonify({'error': '被点赞的用户不存在'}), 404
-    existing_like = Like.query.filter_by(liker_id=liker_id, liked_user_id=liked_user_id).first()
-    if existing_like:
-        db.session.delete(existing_like)
-        liked_user.likes_received = max(0, liked_user.likes_received - 1)
-        message = '取消点赞成功'
+    if not db.session.query(User.id).filter(User.id == liked_user_id).first(): return jsonify({'error': '被点赞的用户不存在'}), 404
+    # 先尝试删除：删掉了就是取消点赞；没有可删的就插入，ON CONFLICT 保证并发重复点赞也只算一次
+    if Like.query.filter_by(liker_id=liker_id, liked_user_id=liked_user_id).delete(synchronize_session=False):
+        delta, message = -1, '取消点赞成功'
     else:
-        new_like = Like(liker_id=liker_id, liked_user_id=liked_user_id)
-        db.session.add(new_like)
-        liked_user.likes_received += 1
-        message = '点赞成功'
+        inserted = db.session.execute(
+            _dialect_insert(Like).values(liker_id=liker_id, liked_user_id=liked_user_id, created_at=datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=['liker_id', 'liked_user_id'])
+        ).rowcount
+        delta, message = (1 if inserted else 0), '点赞成功'
+    new_like_count = _apply_like_delta(liked_user_id, delta)
     db.session.commit()
-    return jsonify({'message': message, 'new_like_count': liked_user.likes_received})
+    return jsonify({'message': message, 'new_like_count': new_like_count})
 
 @app.route('/api/feedback', methods=['POST'])
 def submit_feedback():
@@ -398,115 +2578,249 @@ def deepl_translate_proxy():
     api_key = os.environ.get('DEEPL_API_KEY')
     if not api_key: return jsonify({'error': '服务器未配置 DeepL API Key'}), 500
     data = request.get_json()
+    text, target_lang = data.get('text'), (data.get('target_lang') or 'ZH').upper()
+    cacheable = isinstance(text, str) and text.strip() != ''
+    if cacheable:
+        cached = translation_cache.lookup([text], target_lang).get(text)
+        if cached: return jsonify({'translations': [cached]})
     try:
-        response = requests.post('https://api-free.deepl.com/v2/translate', headers={'Authorization': f'DeepL-Auth-Key {api_key}'}, json={'text': [data.get('text')], 'target_lang': data.get('target_lang', 'ZH')})
-        response.raise_for_status()
+        if cacheable: return jsonify({'translations': [translation_coalescer.submit(text, target_lang, coalesce=request.environ.get('wsgi.multithread', False))]})
+        # 翻译是幂等的，失败可以放心重试
+        response = upstreams['deepl'].request('POST', '/v2/translate', idempotent=True, headers={'Authorization': f'DeepL-Auth-Key {api_key}'}, json={'text': [text], 'target_lang': target_lang})
         return jsonify(response.json())
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': '请求翻译服务失败', 'details': str(e)}), 502
+    except (UpstreamError, ValueError) as e:
+        return _upstream_error_response(e, '请求翻译服务失败')
+
+@app.route('/api/deepl-translate/batch', methods=['POST'])
+def deepl_translate_batch():
+    if not os.environ.get('DEEPL_API_KEY'): return jsonify({'error': '服务器未配置 DeepL API Key'}), 500
+    data = request.get_json(silent=True) or {}
+    texts, target_lang = data.get('texts'), (data.get('target_lang') or 'ZH').upper()
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts): return jsonify({'error': 'texts 必须是字符串数组'}), 400
+    if len(texts) > 500: return jsonify({'error': '单次最多翻译 500 段文本'}), 400
+    normalized = [translation_cache.normalize(t) for t in texts]
+    # 按合并空白后的文本去重、查缓存，只把没命中的发给 DeepL；发出去的是第一次出现的原文
+    originals = {}
+    for text, key in zip(texts, normalized):
+        if key: originals.setdefault(key, text)
+    found = translation_cache.lookup(list(originals), target_lang)
+    missing = [t for t in originals if t not in found]
+    if missing:
+        try:
+            found.update(zip(missing, _deepl_translate_texts([originals[t] for t in missing], target_lang)))
+        except UpstreamError as e:
+            return _upstream_error_response(e, '请求翻译服务失败')
+    return jsonify({'translations': [found[t] if t else {'detected_source_language': None, 'text': ''} for t in normalized]})
+
+@app.route('/admin/translation-cache/<secret_key>', methods=['GET', 'DELETE'])
+def admin_translation_cache(secret_key):
+    if not _is_admin_secret(secret_key): return jsonify({"error": "密码错误，无法执行危险操作"}), 403
+    if request.method == 'GET': return jsonify(translation_cache.stats())
+    try:
+        deleted = translation_cache.purge(expired_only=request.args.get('expired_only') == '1')
+        return jsonify({'message': '翻译缓存已清空', 'deleted': deleted})
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        return jsonify({'error': f'清空翻译缓存时发生错误: {str(e)}'}), 500
 
 @app.route('/api/deepseek-chat', methods=['POST'])
 def deepseek_chat_proxy():
     api_key = os.environ.get('DEEPSEEK_API_KEY')
     if not api_key: return jsonify({'error': '服务器未配置 DeepSeek API Key'}), 500
     data = request.get_json()
+    if data and data.get('stream'): return _stream_deepseek_chat(api_key, data)
     try:
-        response = requests.post('https://api.deepseek.com/chat/completions', headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}, json=data)
-        response.raise_for_status()
+        response = upstreams['deepseek'].request('POST', '/chat/completions', headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}, json=data)
         return jsonify(response.json())
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': '请求 AI 服务失败', 'details': str(e)}), 502
+    except (UpstreamError, ValueError) as e:
+        return _upstream_error_response(e, '请求 AI 服务失败')
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+
+def _stream_deepseek_chat(api_key, data):
+    # 流式透传：上游的 SSE 按行原样转发给前端，不在内存里攒整个回答
+    # 让上游在最后一个 chunk 里带上 usage，方便我们在结尾附上统计信息
+    data.setdefault('stream_options', {'include_usage': True})
+    started = time.monotonic()
+    client = upstreams['deepseek']
+    try:
+        upstream = client.request('POST', '/chat/completions', headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}, json=data, stream=True)
+    except UpstreamError as e:
+        return _upstream_error_response(e, '请求 AI 服务失败')
+
+    def generate():
+        first_chunk_at, usage, completed = None, None, False
+        try:
+            # 上游到一点就转发一点，首 token 延迟最低
+            for line in client.iter_lines(upstream):
+                if first_chunk_at is None and line: first_chunk_at = time.monotonic()
+                if line.startswith(b'data: {') and b'"usage"' in line:
+                    try: usage = json.loads(line[6:]).get('usage') or usage
+                    except ValueError: pass
+                elif line == b'data: [DONE]':
+                    completed = True
+                yield line + b'\n'
+        except UpstreamError as e:
+            # 上游中途断开：告诉前端出错了，而不是让流悄悄结束
+            yield _sse_event('error', {'error': '请求 AI 服务失败', 'details': str(e)})
+        else:
+            yield _sse_event('trailer', {
+                'completed': completed,
+                'usage': usage,
+                'ttft_ms': round((first_chunk_at - started) * 1000) if first_chunk_at else None,
+                'total_ms': round((time.monotonic() - started) * 1000)
+            })
+        finally:
+            # 客户端断开连接（关闭标签页等）时生成器被关闭，也会走到这里，直接停止读取上游
+            upstream.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/dictionary-proxy/<word>', methods=['GET'])
 def dictionary_proxy(word):
+    word = dictionary_cache.normalize(word or '')
     if not word: return jsonify({'error': 'Word parameter is missing'}), 400
-    try:
-        response = requests.get(f"https://api.dictionaryapi.dev/api/v2/entries/en/{word}")
-        return jsonify(response.json()), response.status_code
-    except (requests.exceptions.RequestException, requests.exceptions.JSONDecodeError) as e:
-        return jsonify({'error': '词典服务连接或解析失败', 'details': str(e)}), 502
+    result = _resolve_definitions([word])[word]
+    if isinstance(result, Exception): return _upstream_error_response(result, '词典服务连接或解析失败')
+    # payload 已经是 JSON 文本，直接返回，不用再解析一遍
+    status_code, payload = result
+    return Response(payload, status=status_code, mimetype='application/json')
+
+@app.route('/api/dictionary-proxy/bulk', methods=['POST'])
+def dictionary_proxy_bulk():
+    data = request.get_json(silent=True) or {}
+    words = data.get('words')
+    if not isinstance(words, list) or not all(isinstance(w, str) for w in words): return jsonify({'error': 'words 必须是字符串数组'}), 400
+    if len(words) > 200: return jsonify({'error': '单次最多查询 200 个单词'}), 400
+    normalized = {w: dictionary_cache.normalize(w) for w in words}
+    results = _resolve_definitions([w for w in normalized.values() if w])
+    # 缓存里存的就是 JSON 文本，直接拼接响应，避免反序列化再序列化
+    parts = []
+    for original, word in normalized.items():
+        result = results.get(word)
+        if result is None:
+            body = '{"status": 400, "error": "empty word"}'
+        elif isinstance(result, Exception):
+            body = json.dumps({'status': 503 if isinstance(result, UpstreamUnavailable) else 502, 'error': str(result)}, ensure_ascii=False)
+        else:
+            body = f'{{"status": {result[0]}, "data": {result[1]}}}'
+        parts.append(f'{json.dumps(original, ensure_ascii=False)}: {body}')
+    return Response('{"results": {' + ', '.join(parts) + '}}', mimetype='application/json')
 
 @app.route('/api/plaza/topics', methods=['GET'])
+@use_read_replica
 def get_plaza_topics():
     try:
-        topics = PlazaTopic.query.order_by(PlazaTopic.created_at.desc()).all()
-        return jsonify([topic.to_dict() for topic in topics])
+        topics = PlazaTopic.query.options(joinedload(PlazaTopic.author)).order_by(PlazaTopic.created_at.desc())
+        return stream_json_array(topics, PlazaTopic.to_dict)
     except Exception as e:
         print(f"Error fetching plaza topics: {e}")
         return jsonify({'error': '获取帖子列表时发生服务器错误'}), 500
 
+def _encode_cursor(created_at, row_id):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    # 游标格式错误时抛 ValueError，由调用方返回 400
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    created_at, row_id = raw.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(row_id)
+
+def _plaza_feed_query():
+    # 分页信息流：只返回卡片需要的字段，作者和评论数在同一条 SQL 里查出，正文请走 get_topic_details
+    comment_count = sa_select(func.count(PlazaComment.id)).where(PlazaComment.topic_id == PlazaTopic.id).correlate(PlazaTopic).scalar_subquery()
+    return db.session.query(
+        PlazaTopic.id, PlazaTopic.title, PlazaTopic.excerpt, PlazaTopic.image_url, PlazaTopic.created_at,
+        User.username, User.avatar_url, comment_count.label('comment_count')
+    ).join(User, User.username == PlazaTopic.author_username)
+
+@app.route('/api/plaza/feed', methods=['GET'])
+@use_read_replica
+def get_plaza_feed():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+    query = _plaza_feed_query()
+    cursor = request.args.get('cursor')
+    if cursor:
+        try: cursor_created_at, cursor_id = _decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError): return jsonify({'error': '无效的分页游标'}), 400
+        query = query.filter(tuple_(PlazaTopic.created_at, PlazaTopic.id) < tuple_(cursor_created_at, cursor_id))
+    rows = query.order_by(PlazaTopic.created_at.desc(), PlazaTopic.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        'topics': [{
+            'id': row.id,
+            'title': row.title,
+            'excerpt': row.excerpt or '',
+            'image_url': row.image_url,
+            'created_at': row.created_at.isoformat() + 'Z',
+            'author_username': row.username,
+            'author_avatar_url': row.avatar_url or AVATAR_CHOICES[0],
+            'comment_count': row.comment_count
+        } for row in rows],
+        'next_cursor': _encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
+    })
+
 @app.route('/api/plaza/topics', methods=['POST'])
 def publish_plaza_topic():
-    print("\n--- [DEBUG] Received a new request to /api/plaza/topics ---")
-
     user_info = get_user_from_token()
-    if not user_info:
-        print("[DEBUG] Request rejected: No valid token found.")
-        return jsonify({'error': '未授权，请先登录'}), 401
-
-    user = User.query.get(user_info['user_id'])
-    if not user:
-        print(f"[DEBUG] Request rejected: User with ID {user_info['user_id']} not found.")
-        return jsonify({'error': '用户未找到'}), 404
-        
+    if not user_info: return jsonify({'error': '未授权，请先登录'}), 401
+    user = get_current_user()
+    if not user: return jsonify({'error': '用户未找到'}), 404
     data = request.get_json()
-    if not data:
-        print("[DEBUG] Request rejected: No JSON data received.")
-        return jsonify({"error": "请求体为空"}), 400
-
-    title = data.get('title')
-    raw_content = data.get('content') 
-
-    # --- 关卡 1: 打印从前端收到的原始数据 ---
-    print(f"[DEBUG] 1. Received raw title: {title}")
-    print(f"[DEBUG] 2. Received raw content:\n---\n{raw_content}\n---")
-
-
-    if not title or not raw_content:
-        print("[DEBUG] Request rejected: Title or content is empty.")
-        return jsonify({"error": "标题和内容不能为空"}), 400
-    
+    if not data: return jsonify({"error": "请求体为空"}), 400
+    title, raw_content = data.get('title'), data.get('content')
+    if not title or not raw_content: return jsonify({"error": "标题和内容不能为空"}), 400
+    if len(title) > 255: return jsonify({"error": "标题过长（最多 255 字）"}), 400
+    if len(raw_content) > PLAZA_TOPIC_MAX_CHARS: return jsonify({"error": f"内容过长（最多 {PLAZA_TOPIC_MAX_CHARS} 字）"}), 413
     try:
-        # --- 关卡 2: 调用 mistune 进行转换 ---
-        print("[DEBUG] 3. Calling mistune.html() to convert content...")
-        html_content = mistune.html(raw_content)
-        
-        # --- 关卡 3: 打印转换后的 HTML ---
-        print(f"[DEBUG] 4. Content after mistune conversion:\n---\n{html_content}\n---")
-
+        html_content, content_hash = render_markdown(raw_content)
         new_topic = PlazaTopic(
-            title=title, 
-            content=html_content,  # 确保这里用的是 html_content
+            title=title,
+            content=html_content,
+            content_md=raw_content,
+            content_hash=content_hash,
+            excerpt=PlazaTopic.make_excerpt(html_content),
+            content_text=PlazaTopic.make_plain_text(html_content),
             author_username=user.username
         )
-
-        # --- 关卡 4: 准备保存到数据库 ---
-        print(f"[DEBUG] 5. Creating PlazaTopic object. Content to be saved is:\n---\n{new_topic.content}\n---")
-        
         db.session.add(new_topic)
         db.session.commit()
-
-        # --- 关卡 5: 提交成功后 ---
-        print("[DEBUG] 6. Topic successfully saved to database.")
-        
-        # --- 关卡 6: 准备返回给前端的数据 ---
-        response_data = new_topic.to_dict()
-        print(f"[DEBUG] 7. Returning JSON response. Content in response is:\n---\n{response_data.get('content')}\n---")
-
-        return jsonify(response_data), 201
-
+        return jsonify(new_topic.to_dict()), 201
     except Exception as e:
         db.session.rollback()
-        # --- 异常情况 ---
-        print(f"[DEBUG] !!! An exception occurred: {str(e)} !!!")
-        import traceback
-        traceback.print_exc() # 打印完整的错误堆栈
+        # 只记录错误本身，不要把帖子正文打进日志
+        print(f"Error in publish_plaza_topic: {e}")
         return jsonify({"error": "发布失败，服务器内部错误"}), 500
+
 @app.route('/api/plaza/topics/<int:topic_id>', methods=['GET'])
+@use_read_replica
 def get_topic_details(topic_id):
-    topic = PlazaTopic.query.get_or_404(topic_id)
-    comments = PlazaComment.query.filter_by(topic_id=topic_id).order_by(PlazaComment.created_at.asc()).all()
-    return jsonify({"topic": topic.to_dict(), "comments": [comment.to_dict() for comment in comments]})
+    topic = PlazaTopic.query.options(joinedload(PlazaTopic.author)).filter_by(id=topic_id).first_or_404()
+    comment_count = db.session.query(func.count(PlazaComment.id)).filter(PlazaComment.topic_id == topic_id).scalar()
+    # 评论和作者在同一条 SQL 里 JOIN 出来，to_dict 不会再逐条懒加载作者
+    query = PlazaComment.query.join(PlazaComment.author).options(contains_eager(PlazaComment.author)).filter(PlazaComment.topic_id == topic_id)
+    limit, cursor = request.args.get('limit', type=int), request.args.get('cursor')
+    if limit is None and cursor is None:
+        # 兼容旧客户端：不带分页参数时返回全部评论
+        comments = query.order_by(PlazaComment.created_at.asc(), PlazaComment.id.asc()).all()
+        return jsonify({"topic": topic.to_dict(), "comments": [comment.to_dict() for comment in comments], "comment_count": comment_count})
+    # 按 (created_at, id) 正序翻页，走 (topic_id, created_at, id) 索引
+    limit = min(max(limit or 50, 1), 200)
+    if cursor:
+        try: cursor_created_at, cursor_id = _decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError): return jsonify({'error': '无效的分页游标'}), 400
+        query = query.filter(tuple_(PlazaComment.created_at, PlazaComment.id) > tuple_(cursor_created_at, cursor_id))
+    comments = query.order_by(PlazaComment.created_at.asc(), PlazaComment.id.asc()).limit(limit + 1).all()
+    has_more = len(comments) > limit
+    comments = comments[:limit]
+    return jsonify({
+        "topic": topic.to_dict(),
+        "comments": [comment.to_dict() for comment in comments],
+        "comment_count": comment_count,
+        "next_cursor": _encode_cursor(comments[-1].created_at, comments[-1].id) if has_more else None
+    })
 
 @app.route('/api/plaza/topics/<int:topic_id>/comments', methods=['POST'])
 def post_comment(topic_id):
@@ -515,10 +2829,11 @@ def post_comment(topic_id):
     data = request.get_json()
     content = data.get('content')
     if not content or not content.strip(): return jsonify({"error": "评论内容不能为空"}), 400
-    topic = PlazaTopic.query.get(topic_id)
-    if not topic: return jsonify({"error": "帖子不存在"}), 404
+    if len(content) > PLAZA_COMMENT_MAX_CHARS: return jsonify({"error": f"评论过长（最多 {PLAZA_COMMENT_MAX_CHARS} 字）"}), 413
+    if not db.session.query(PlazaTopic.id).filter(PlazaTopic.id == topic_id).first(): return jsonify({"error": "帖子不存在"}), 404
     try:
-        new_comment = PlazaComment(content=content, topic_id=topic_id, author_username=user_info['username'])
+        html_content, content_hash = render_markdown(content)
+        new_comment = PlazaComment(content=html_content, content_md=content, content_hash=content_hash, topic_id=topic_id, author_username=user_info['username'])
         db.session.add(new_comment)
         db.session.commit()
         return jsonify(new_comment.to_dict()), 201
@@ -531,56 +2846,67 @@ def post_comment(topic_id):
 def like_plaza_comment(comment_id):
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权，请先登录'}), 401
-    comment = PlazaComment.query.get(comment_id)
+    comment = db.session.query(PlazaComment.id, User.id.label('author_id')).outerjoin(User, User.username == PlazaComment.author_username).filter(PlazaComment.id == comment_id).first()
     if not comment: return jsonify({"error": "评论不存在"}), 404
-    author_to_like = User.query.filter_by(username=comment.author_username).first()
-    if not author_to_like: return jsonify({"error": "评论作者不存在"}), 404
-    if author_to_like.id == user_info['user_id']: return jsonify({'error': '不能给自己的评论点赞'}), 400
+    if comment.author_id is None: return jsonify({"error": "评论作者不存在"}), 404
+    if comment.author_id == user_info['user_id']: return jsonify({'error': '不能给自己的评论点赞'}), 400
     try:
-        author_to_like.likes_received += 1
+        new_likes_count = _apply_like_delta(comment.author_id, 1)
         db.session.commit()
-        return jsonify({"message": "点赞成功!", "new_likes_count": author_to_like.likes_received})
+        return jsonify({"message": "点赞成功!", "new_likes_count": new_likes_count})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': '点赞失败，服务器错误'}), 500
 
 @app.route('/api/users', methods=['GET'])
+@use_read_replica
 def get_users():
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
-    users = User.query.filter(User.id != user_info['user_id']).all()
-    return jsonify([user.to_dict() for user in users])
+    users = User.query.filter(User.id != user_info['user_id'])
+    return stream_json_array(users, User.to_dict)
 
 @app.route('/api/users/<int:user_id>/like', methods=['POST'])
 def like_user(user_id):
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
     if user_id == user_info['user_id']: return jsonify({'error': '不能给自己点赞'}), 400
-    user_to_like = User.query.get(user_id)
-    if not user_to_like: return jsonify({'error': '用户不存在'}), 404
+    if not db.session.query(User.id).filter(User.id == user_id).first(): return jsonify({'error': '用户不存在'}), 404
     try:
-        user_to_like.likes_received += 1
+        new_likes_count = _apply_like_delta(user_id, 1)
         db.session.commit()
-        return jsonify({'message': '点赞成功', 'new_likes_count': user_to_like.likes_received})
+        return jsonify({'message': '点赞成功', 'new_likes_count': new_likes_count})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': '服务器错误'}), 500
 
 @app.route('/api/chat/<int:other_user_id>', methods=['GET'])
+@use_read_replica
 def get_chat_history(other_user_id):
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
-    current_user_username = user_info['username']
-    other_user = User.query.get(other_user_id)
+    # 双方用户一次查出来，后面每条消息都复用，不再逐条懒加载
+    participants = {u.username: u for u in User.query.filter(User.id.in_({user_info['user_id'], other_user_id})).all()}
+    other_user = next((u for u in participants.values() if u.id == other_user_id), None)
     if not other_user: return jsonify({'error': '聊天对象不存在'}), 404
-    other_user_username = other_user.username
-    messages = ChatMessage.query.filter(
-        or_(
-            (ChatMessage.sender_username == current_user_username) & (ChatMessage.receiver_username == other_user_username),
-            (ChatMessage.sender_username == other_user_username) & (ChatMessage.receiver_username == current_user_username)
-        )
-    ).order_by(ChatMessage.created_at.asc()).all()
-    return jsonify([message.to_dict() for message in messages])
+    if user_info['username'] not in participants: return jsonify({'error': '用户不存在'}), 404
+    query = ChatMessage.query.filter_by(conversation_key=ChatMessage.make_conversation_key(user_info['username'], other_user.username))
+    before_id, limit = request.args.get('before_id', type=int), request.args.get('limit', type=int)
+    if before_id is None and limit is None:
+        # 兼容旧客户端：不带分页参数时仍返回完整列表（按时间正序）
+        messages = query.order_by(ChatMessage.id.asc())
+        return stream_json_array(messages, lambda message: message.to_dict(participants))
+    # 游标分页：从新到旧，每页 limit 条，下一页用返回的 next_before_id
+    limit = min(max(limit or 50, 1), 200)
+    if before_id is not None: query = query.filter(ChatMessage.id < before_id)
+    messages = query.order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    return jsonify({
+        'participants': [{'id': u.id, 'username': u.username, 'avatar_url': u.avatar_url or AVATAR_CHOICES[0]} for u in participants.values()],
+        'messages': [message.to_compact_dict(participants) for message in messages],
+        'next_before_id': messages[-1].id if has_more else None
+    })
 
 @app.route('/api/chat/send', methods=['POST'])
 def send_chat_message():
@@ -589,18 +2915,96 @@ def send_chat_message():
     data = request.get_json()
     receiver_id, content = data.get('receiver_id'), data.get('content')
     if not receiver_id or not content or not content.strip(): return jsonify({'error': '接收者ID和内容不能为空'}), 400
-    receiver_user = User.query.get(receiver_id)
+    receiver_user = db.session.get(User, receiver_id)
     if not receiver_user: return jsonify({'error': '接收用户不存在'}), 404
     try:
         new_message = ChatMessage(sender_username=user_info['username'], receiver_username=receiver_user.username, content=content)
         db.session.add(new_message)
         db.session.commit()
-        return jsonify(new_message.to_dict()), 201
+        message_data = new_message.to_dict()
+        # 提交成功后再推送，订阅者收到的一定是已经落库的消息
+        chat_bus.publish([new_message.sender_username, new_message.receiver_username], 'chat_message', new_message.id, message_data)
+        return jsonify(message_data), 201
     except Exception as e:
         db.session.rollback()
         print(f"Error in send_chat_message: {e}")
         return jsonify({'error': '发送失败，服务器内部错误'}), 500
 
+CHAT_PREVIEW_LENGTH = 100
+
+def _chat_inbox_query(username):
+    # 一条 SQL 算出所有会话：先按 conversation_key 聚合出最后一条消息 id 和未读数，再连回最后一条消息和对方用户
+    read_marker = and_(ChatReadMarker.username == username, ChatReadMarker.conversation_key == ChatMessage.conversation_key)
+    unread = and_(ChatMessage.receiver_username == username, ChatMessage.id > func.coalesce(ChatReadMarker.last_read_id, 0))
+    conversations = db.session.query(
+        func.max(ChatMessage.id).label('last_id'),
+        func.count(case((unread, 1))).label('unread_count')
+    ).outerjoin(ChatReadMarker, read_marker) \
+        .filter(or_(ChatMessage.sender_username == username, ChatMessage.receiver_username == username)) \
+        .group_by(ChatMessage.conversation_key, ChatReadMarker.last_read_id).subquery()
+    partner_username = case((ChatMessage.sender_username == username, ChatMessage.receiver_username), else_=ChatMessage.sender_username)
+    return db.session.query(
+        ChatMessage.id, func.substr(ChatMessage.content, 1, CHAT_PREVIEW_LENGTH).label('preview'), ChatMessage.created_at, ChatMessage.sender_username,
+        User.id.label('partner_id'), User.username.label('partner_username'), User.avatar_url.label('partner_avatar_url'),
+        conversations.c.unread_count
+    ).join(conversations, ChatMessage.id == conversations.c.last_id).join(User, User.username == partner_username)
+
+@app.route('/api/chat/inbox', methods=['GET'])
+@use_read_replica
+def get_chat_inbox():
+    # 会话列表：每个聊天对象一行，带最后一条消息预览和未读数，按最近活跃倒序，用 before_id 翻页
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    username = user_info['username']
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    before_id = request.args.get('before_id', type=int)
+    query = _chat_inbox_query(username)
+    if before_id is not None: query = query.filter(ChatMessage.id < before_id)
+    rows = query.order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        'conversations': [{
+            'partner': {'id': row.partner_id, 'username': row.partner_username, 'avatar_url': row.partner_avatar_url or AVATAR_CHOICES[0]},
+            'last_message': {
+                'id': row.id,
+                'preview': row.preview,
+                'created_at': row.created_at.isoformat() + 'Z',
+                'from_me': row.sender_username == username
+            },
+            'unread_count': row.unread_count
+        } for row in rows],
+        'next_before_id': rows[-1].id if has_more else None
+    })
+
+@app.route('/api/chat/<int:partner_id>/read', methods=['POST'])
+def mark_chat_read(partner_id):
+    # 把和 partner_id 的会话标记为已读（默认读到最新一条，也可以传 last_read_id）；已读位置只会往前走
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    partner = db.session.query(User.username).filter(User.id == partner_id).first()
+    if not partner: return jsonify({'error': '聊天对象不存在'}), 404
+    username = user_info['username']
+    conversation_key = ChatMessage.make_conversation_key(username, partner.username)
+    latest_id = db.session.query(func.max(ChatMessage.id)).filter(ChatMessage.conversation_key == conversation_key).scalar() or 0
+    requested = (request.get_json(silent=True) or {}).get('last_read_id')
+    if requested is not None and (not isinstance(requested, int) or isinstance(requested, bool) or requested < 0): return jsonify({'error': 'last_read_id 必须是非负整数'}), 400
+    last_read_id = latest_id if requested is None else min(requested, latest_id)
+    stmt = _dialect_insert(ChatReadMarker).values(username=username, conversation_key=conversation_key, last_read_id=last_read_id, updated_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(index_elements=['username', 'conversation_key'], set_={
+        'last_read_id': case((ChatReadMarker.last_read_id > stmt.excluded.last_read_id, ChatReadMarker.last_read_id), else_=stmt.excluded.last_read_id),
+        'updated_at': stmt.excluded.updated_at
+    }).returning(ChatReadMarker.last_read_id)
+    last_read_id = db.session.execute(stmt).scalar()
+    unread_count = db.session.query(func.count(ChatMessage.id)).filter(
+        ChatMessage.conversation_key == conversation_key, ChatMessage.receiver_username == username, ChatMessage.id > last_read_id
+    ).scalar()
+    db.session.commit()
+    data = {'partner_id': partner_id, 'last_read_id': last_read_id, 'unread_count': unread_count}
+    # 同一个用户的其他标签页 / 设备跟着更新未读角标
+    chat_bus.publish([username], 'chat_read', last_read_id, data)
+    return jsonify(data)
+
 @app.route('/api/avatars', methods=['GET'])
 def get_avatar_choices():
     return jsonify(AVATAR_CHOICES)
@@ -612,7 +3016,7 @@ def update_user_avatar():
     data = request.get_json()
     new_avatar_url = data.get('avatar_url')
     if not new_avatar_url or new_avatar_url not in AVATAR_CHOICES: return jsonify({'error': '无效的头像选择'}), 400
-    user = User.query.get(user_info['user_id'])
+    user = get_current_user()
     if not user: return jsonify({'error': '用户不存在'}), 404
     user.avatar_url = new_avatar_url
     db.session.commit()
@@ -623,32 +3027,288 @@ def get_new_chat_messages(partner_id):
     user_info = get_user_from_token()
     if not user_info: return jsonify({'error': '未授权'}), 401
     since_message_id = request.args.get('since', 0, type=int)
-    other_user = User.query.get(partner_id)
+    participants = {u.username: u for u in User.query.filter(User.id.in_({user_info['user_id'], partner_id})).all()}
+    other_user = next((u for u in participants.values() if u.id == partner_id), None)
     if not other_user: return jsonify({'error': '聊天对象不存在'}), 404
-    current_user_username = user_info['username']
-    other_user_username = other_user.username
+    if user_info['username'] not in participants: return jsonify({'error': '用户不存在'}), 404
     messages = ChatMessage.query.filter(
-        ChatMessage.id > since_message_id,
-        or_(
-            (ChatMessage.sender_username == current_user_username) & (ChatMessage.receiver_username == other_user_username),
-            (ChatMessage.sender_username == other_user_username) & (ChatMessage.receiver_username == current_user_username)
-        )
-    ).order_by(ChatMessage.created_at.asc()).all()
-    return jsonify([msg.to_dict() for msg in messages])     
+        ChatMessage.conversation_key == ChatMessage.make_conversation_key(user_info['username'], other_user.username),
+        ChatMessage.id > since_message_id
+    ).order_by(ChatMessage.id.asc()).all()
+    return jsonify([msg.to_dict(participants) for msg in messages])
+
+# EventSource 没法自定义请求头：前端先带着登录 token 换一张短期票据，再用 ?ticket= 打开 SSE 连接。
+# 票据只对 /api/chat/stream 有效、很快过期，就算出现在访问日志里也没什么用；断线后重新换一张再连。
+CHAT_STREAM_TICKET_TTL = _env_int('CHAT_STREAM_TICKET_TTL', 60)
+CHAT_STREAM_TICKET_SCOPE = 'chat_stream'
+
+@app.route('/api/chat/stream-ticket', methods=['POST'])
+def create_chat_stream_ticket():
+    user_info = get_user_from_token()
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    ticket = jwt.encode({
+        'user_id': user_info['user_id'], 'username': user_info['username'], 'tv': _current_token_version(user_info['user_id']),
+        'scope': CHAT_STREAM_TICKET_SCOPE, 'exp': datetime.utcnow() + timedelta(seconds=CHAT_STREAM_TICKET_TTL)
+    }, app.config['SECRET_KEY'], algorithm='HS256')
+    return jsonify({'ticket': ticket, 'expires_in': CHAT_STREAM_TICKET_TTL})
+
+def _verify_stream_ticket(ticket):
+    if not ticket: return None
+    try:
+        data = jwt.decode(ticket, app.config['SECRET_KEY'], algorithms=['HS256'])
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None
+    if data.get('scope') != CHAT_STREAM_TICKET_SCOPE or data.get('tv', 0) != _current_token_version(data['user_id']): return None
+    return {'user_id': data['user_id'], 'username': data['username']}
+
+# 下面几个函数 asgi.py 的异步推送也在用，两边的事件格式、补发和去重规则保持一致
+CHAT_STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def _chat_stream_user(authorization, ticket):
+    token = authorization[7:] if authorization and authorization.startswith('Bearer ') else None
+    return (_verify_token(token) if token else None) or _verify_stream_ticket(ticket)
+
+def _chat_stream_options():
+    return _env_float('CHAT_STREAM_HEARTBEAT', 15), _env_float('CHAT_STREAM_MAX_SECONDS', 600)
+
+def _chat_sse_event(event, event_id, data):
+    head = f"id: {event_id}\n" if event == 'chat_message' else ''
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _chat_backlog(username, last_id):
+    missed = ChatMessage.query.filter(
+        ChatMessage.id > last_id,
+        or_(ChatMessage.sender_username == username, ChatMessage.receiver_username == username)
+    ).order_by(ChatMessage.id.asc()).limit(500).all()
+    if not missed: return []
+    # 双方用户一次查出来，避免每条消息懒加载 sender / receiver
+    usernames = {m.sender_username for m in missed} | {m.receiver_username for m in missed}
+    participants = {u.username: u for u in User.query.filter(User.username.in_(usernames)).all()}
+    return [m.to_dict(participants) for m in missed]
+
+def _chat_event_data(event, event_id):
+    # 超过 NOTIFY 上限的事件只广播了 id，这里回数据库取完整内容
+    if event == 'chat_message':
+        message = db.session.get(ChatMessage, event_id)
+        return message.to_dict() if message else None
+    if event == 'note_summary':
+        job = db.session.get(SummaryJob, event_id)
+        return _summary_event_data(job) if job else None
+    return None
+
+def _chat_skip_event(event, event_id, last_id, backlog_ids):
+    # 只和补发过的消息去重：并发发送的消息推送顺序不一定按 id 递增，不能用"已推送的最大 id"来过滤
+    return event == 'chat_message' and (event_id <= last_id or event_id in backlog_ids)
+
+@app.route('/api/chat/stream', methods=['GET'])
+def chat_event_stream():
+    # SSE 推送：替代轮询 /api/chat/<id>/new。空闲时只发心跳，不查数据库
+    user_info = _chat_stream_user(request.headers.get('Authorization'), request.args.get('ticket'))
+    if not user_info: return jsonify({'error': '未授权'}), 401
+    username = user_info['username']
+    # 断线重连时浏览器会带上 Last-Event-ID，从这条之后补发
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('last_id', 0, type=int)
+    heartbeat, max_duration = _chat_stream_options()
+
+    def generate():
+        # 在生成器里订阅：响应体一直没被读取（客户端已经走了）时不会留下订阅。
+        # 先订阅再补发历史，避免两者之间漏消息
+        subscription = chat_bus.subscribe(username)
+        started = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            backlog = _chat_backlog(username, last_id) if last_id else []
+            # 长连接期间不要一直占着数据库连接
+            db.session.remove()
+            backlog_ids = {message['id'] for message in backlog}
+            for message in backlog: yield _chat_sse_event('chat_message', message['id'], message)
+            while time.monotonic() - started < max_duration and not subscription.overflowed:
+                try:
+                    event, event_id, data = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if _chat_skip_event(event, event_id, last_id, backlog_ids): continue
+                if data is None:
+                    data = _chat_event_data(event, event_id)
+                    db.session.remove()
+                    if data is None: continue
+                yield _chat_sse_event(event, event_id, data)
+        finally:
+            chat_bus.unsubscribe(subscription)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=CHAT_STREAM_HEADERS)
 
 @app.route('/admin/reset-database/areyousure/<secret_key>')
 def reset_database(secret_key):
-    reset_word = os.environ.get('RESET_SECRET_WORD', 'my_default_reset_word')
-    if secret_key != reset_word: return jsonify({"error": "密码错误，无法执行危险操作"}), 403
+    if not _is_admin_secret(secret_key): return jsonify({"error": "密码错误，无法执行危险操作"}), 403
     try:
         with app.app_context():
             db.drop_all()
-            db.create_all()
+            migrate_database()
         return jsonify({"message": "数据库已成功重置！"}), 200
     except Exception as e:
         return jsonify({"error": f"重置数据库时发生错误: {str(e)}"}), 500
 
+# --- 8.1 查询计划审计 ---
+# `flask audit-queries`：把每个接口的代表性查询跑一遍 EXPLAIN，找出大表上的全表扫描和额外排序。
+# 要对着有数据的库跑才有意义（比如 `python bench/run.py --scenarios ''` 造的压测库，或者线上只读副本）。
+# Postgres 上用 EXPLAIN (ANALYZE, FORMAT JSON) 看实际行数；SQLite 没有行数，用表的总行数 / 查询结果行数估算。
+def _audit_samples():
+    # 挑数据最多的用户、帖子和会话，让计划器看到最坏的情况
+    user_id = db.session.query(Note.user_id).group_by(Note.user_id).order_by(func.count().desc()).limit(1).scalar() \
+        or db.session.query(func.min(User.id)).scalar()
+    user = db.session.get(User, user_id) if user_id else None
+    if not user: return None
+    topic_id = db.session.query(PlazaComment.topic_id).group_by(PlazaComment.topic_id).order_by(func.count().desc()).limit(1).scalar() \
+        or db.session.query(func.max(PlazaTopic.id)).scalar() or 0
+    conversation = db.session.query(ChatMessage.conversation_key, func.min(ChatMessage.id), func.max(ChatMessage.id)) \
+        .group_by(ChatMessage.conversation_key).order_by(func.count().desc()).first()
+    conversation_key, first_message_id, last_message_id = conversation or (ChatMessage.make_conversation_key(user.username, user.username), 0, 0)
+    return {'user': user, 'topic_id': topic_id, 'conversation_key': conversation_key,
+            'since_message_id': (first_message_id + last_message_id) // 2, 'version': user.data_version // 2}
+
+def _audit_queries(sample):
+    # (名称, 查询, 是否允许全量读取)：不分页的旧接口本来就要读整张表，只报告不算失败
+    user, uid = sample['user'], sample['user'].id
+    page_ids = [row.id for row in _rank_columns_query().order_by(*RANK_ORDER).limit(100)]
+    return [
+        ('GET /api/notes', Note.query.filter_by(user_id=uid).order_by(desc(Note.created_at)), False),
+        ('GET /api/vocab', Vocab.query.filter_by(user_id=uid).order_by(Vocab.word), False),
+        ('GET /api/sync notes', Note.query.filter(Note.user_id == uid, Note.version > sample['version'], Note.version <= user.data_version).order_by(Note.version, Note.id), False),
+        ('GET /api/sync vocab', Vocab.query.filter(Vocab.user_id == uid, Vocab.version > sample['version'], Vocab.version <= user.data_version).order_by(Vocab.version, Vocab.id), False),
+        ('GET /api/sync tombstones', db.session.query(SyncTombstone.kind, SyncTombstone.object_id).filter(
+            SyncTombstone.user_id == uid, SyncTombstone.version > sample['version'], SyncTombstone.version <= user.data_version).order_by(SyncTombstone.version), False),
+        ('GET /api/rank', _rank_columns_query().order_by(*RANK_ORDER).limit(100), False),
+        ('GET /api/rank liked_by_me', db.session.query(Like.liked_user_id).filter(Like.liker_id == uid, Like.liked_user_id.in_(page_ids or [0])), False),
+        ('GET /api/rank/me', db.session.query(func.count(User.id)).filter(_rank_ahead_of(user)), False),
+        ('GET /api/plaza/topics', PlazaTopic.query.options(joinedload(PlazaTopic.author)).order_by(PlazaTopic.created_at.desc()), True),
+        ('GET /api/plaza/feed', _plaza_feed_query().order_by(PlazaTopic.created_at.desc(), PlazaTopic.id.desc()).limit(21), False),
+        ('GET /api/plaza/topics/<id> comments', PlazaComment.query.join(PlazaComment.author).options(contains_eager(PlazaComment.author))
+            .filter(PlazaComment.topic_id == sample['topic_id']).order_by(PlazaComment.created_at.asc(), PlazaComment.id.asc()).limit(51), False),
+        ('GET /api/plaza/topics/<id> comment_count', db.session.query(func.count(PlazaComment.id)).filter(PlazaComment.topic_id == sample['topic_id']), False),
+        ('GET /api/users', User.query.filter(User.id != uid), True),
+        ('GET /api/chat/<id>', ChatMessage.query.filter_by(conversation_key=sample['conversation_key']).order_by(ChatMessage.id.desc()).limit(51), False),
+        ('GET /api/chat/<id>/new', ChatMessage.query.filter(ChatMessage.conversation_key == sample['conversation_key'], ChatMessage.id > sample['since_message_id'])
+            .order_by(ChatMessage.id.asc()), False),
+        ('GET /api/chat/inbox', _chat_inbox_query(user.username).order_by(ChatMessage.id.desc()).limit(21), False),
+        ('GET /api/chat/stream backlog', ChatMessage.query.filter(
+            ChatMessage.id > sample['since_message_id'],
+            or_(ChatMessage.sender_username == user.username, ChatMessage.receiver_username == user.username)
+        ).order_by(ChatMessage.id.asc()).limit(500), False),
+    ]
+
+def _explain(statement, analyze):
+    compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params()
+    if compiled.positional: params = tuple(params[name] for name in compiled.positiontup)
+    if db.engine.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, FORMAT JSON) ' if analyze else 'EXPLAIN (FORMAT JSON) '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+    return db.session.connection().exec_driver_sql(prefix + str(compiled), params).all()
+
+def _audit_postgres_plan(rows, threshold):
+    plan = rows[0][0]
+    if isinstance(plan, str): plan = json.loads(plan)
+    issues, lines = [], []
+
+    def visit(node, depth):
+        loops = node.get('Actual Loops', 1)
+        produced = node.get('Actual Rows', node.get('Plan Rows', 0)) * loops
+        relation = node.get('Relation Name', '')
+        lines.append(f"{'  ' * depth}{node['Node Type']} {relation} rows={produced}".rstrip())
+        if node['Node Type'] == 'Seq Scan':
+            scanned = produced + node.get('Rows Removed by Filter', 0) * loops
+            if scanned >= threshold: issues.append(f"全表扫描 {relation}：读了 {scanned} 行")
+        elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+            children = node.get('Plans') or [node]
+            sorted_rows = sum(c.get('Actual Rows', c.get('Plan Rows', 0)) * c.get('Actual Loops', 1) for c in children)
+            if sorted_rows >= threshold: issues.append(f"额外排序 {sorted_rows} 行（{node.get('Sort Method', '')}）".replace('（）', ''))
+        for child in node.get('Plans', ()): visit(child, depth + 1)
+
+    visit(plan[0]['Plan'], 0)
+    return issues, lines
+
+def _audit_sqlite_plan(rows, statement, threshold, table_rows):
+    issues, lines = [], []
+    for row in rows:
+        detail = row[-1]
+        lines.append(detail)
+        scan = re.match(r'SCAN (\w+)(?: AS \w+)?$', detail)
+        if scan and scan.group(1) in table_rows and table_rows[scan.group(1)] >= threshold:
+            issues.append(f"全表扫描 {scan.group(1)}：表里有 {table_rows[scan.group(1)]} 行")
+        if detail.startswith('USE TEMP B-TREE'):
+            # 排序的行数 = 去掉 ORDER BY / LIMIT 之后的结果行数
+            unordered = statement.order_by(None).limit(None).offset(None).subquery()
+            sorted_rows = db.session.execute(sa_select(func.count()).select_from(unordered)).scalar()
+            if sorted_rows >= threshold: issues.append(f"额外排序 {sorted_rows} 行（{detail[len('USE TEMP B-TREE FOR '):]}）")
+    return issues, lines
+
+@app.cli.command('audit-queries')
+@click.option('--threshold', default=1000, help='扫描 / 排序超过多少行算问题')
+@click.option('--analyze/--no-analyze', default=True, help='Postgres 上是否真正执行查询（EXPLAIN ANALYZE）')
+@click.option('--verbose', is_flag=True, help='打印每条查询的完整执行计划')
+def audit_queries(threshold, analyze, verbose):
+    sample = _audit_samples()
+    if not sample:
+        print("数据库里没有数据，先用 bench/run.py 或 bench/seed.py 造一批数据再审计")
+        raise SystemExit(1)
+    dialect_name = db.engine.dialect.name
+    table_rows = {}
+    if dialect_name == 'sqlite':
+        for table in db.metadata.tables: table_rows[table] = db.session.execute(text(f'SELECT count(*) FROM {table}')).scalar()
+    queries, failed = _audit_queries(sample), 0
+    for name, query, full_read in queries:
+        statement = query.statement if hasattr(query, 'statement') else query
+        rows = _explain(statement, analyze)
+        if dialect_name == 'postgresql': issues, lines = _audit_postgres_plan(rows, threshold)
+        else: issues, lines = _audit_sqlite_plan(rows, statement, threshold, table_rows)
+        # EXPLAIN ANALYZE 真的执行了查询，别把事务留着
+        db.session.rollback()
+        if issues and not full_read: failed += 1
+        print(f"[{'OK' if not issues else '--' if full_read else '!!'}] {name}")
+        for issue in issues: print(f"     {issue}{'（不分页的旧接口，预期内）' if full_read else ''}")
+        if verbose or (issues and not full_read):
+            for line in lines: print(f"       {line}")
+    print(f"共审计 {len(queries)} 条查询，{failed} 条需要处理（阈值 {threshold} 行，{dialect_name}）")
+    if failed: raise SystemExit(1)
+
 # --- 9. 启动应用 ---
+# 数据库结构落后于代码时，所有接口直接返回 503，而不是让每个接口各自报 500。
+# 不在 import 时退出：`flask upgrade-db` 和 init_db.py 本身也要 import 这个文件。
+# 落后期间每隔 SCHEMA_RECHECK_SECONDS 秒重新查一次版本号，执行完迁移后 worker 不用重启就能恢复服务。
+SCHEMA_RECHECK_SECONDS = _env_float('SCHEMA_RECHECK_SECONDS', 5)
+SCHEMA_UPGRADING_ERROR = '服务正在升级，请稍后再试'
+SCHEMA_RETRY_AFTER = str(max(1, round(SCHEMA_RECHECK_SECONDS)))
+_schema_state = {'current': False, 'checked_at': 0.0}
+
+def schema_is_current():
+    if _schema_state['current']: return True
+    if time.monotonic() - _schema_state['checked_at'] < SCHEMA_RECHECK_SECONDS: return False
+    _schema_state['checked_at'] = time.monotonic()
+    _schema_state['current'] = applied_schema_version() >= SCHEMA_VERSION
+    return _schema_state['current']
+
+@app.before_request
+def _require_current_schema():
+    if not schema_is_current():
+        return jsonify({'error': SCHEMA_UPGRADING_ERROR}), 503, {'Retry-After': SCHEMA_RETRY_AFTER}
+
+def check_schema_version(auto_migrate):
+    # worker 启动时只比对版本号，不做 DDL；AUTO_MIGRATE=1（本地开发、单实例部署）或直接 python app.py 时顺便执行迁移
+    with app.app_context():
+        current = applied_schema_version()
+        if current < SCHEMA_VERSION and auto_migrate: current = migrate_database()
+        _schema_state['current'], _schema_state['checked_at'] = current >= SCHEMA_VERSION, time.monotonic()
+        if current < SCHEMA_VERSION:
+            app.logger.error("数据库结构版本为 %s，当前代码需要 %s：在执行 `flask upgrade-db` 之前所有接口都返回 503", current, SCHEMA_VERSION)
+        db.session.remove()
+        # gunicorn --preload 时在 fork 之前把连接还掉，避免 worker 共用同一个 socket
+        db.engine.dispose()
+
+check_schema_version(auto_migrate=__name__ == '__main__' or os.environ.get('AUTO_MIGRATE') == '1')
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=True)
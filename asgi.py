@@ -0,0 +1,516 @@
+# asgi.py
+
+# 异步运行模式：
+#   uvicorn asgi:application --workers 2
+#   或 gunicorn -k uvicorn.workers.UvicornWorker -w 2 asgi:application
+#
+# 调上游的三个代理接口（deepseek-chat / deepl-translate / dictionary-proxy）直接在事件循环里用
+# httpx.AsyncClient 处理，慢请求只占一个协程，一个进程可以同时挂着几百个；每个上游的并发上限单独配置。
+# 聊天推送 /api/chat/stream 也在事件循环里处理：一个打开的聊天页只是一个协程，不占线程，
+# 连接最长 CHAT_STREAM_MAX_SECONDS 秒也和线程池大小无关；只有鉴权、补发历史这几次查库借用 CACHE_EXECUTOR。
+# 其余接口原样交给 Flask，在一个有上限的线程池里执行（ASGI_WSGI_THREADS，一般和数据库连接池一样大），
+# 这些接口都很快返回，上游再慢、聊天页开得再多也占不到笔记、单词本、登录这些接口的线程。
+# 缓存（翻译缓存、词典缓存）、熔断器、监控指标、数据库版本检查都和 app.py 共用同一份。
+
+import asyncio
+import io
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
+import httpx
+from app import (
+    CHAT_STREAM_HEADERS, HTTP_LATENCY, HTTP_REQUESTS, SCHEMA_RETRY_AFTER, SCHEMA_UPGRADING_ERROR, UPSTREAM_ERRORS,
+    UPSTREAM_LATENCY, UpstreamClient, UpstreamError, UpstreamUnavailable, _chat_backlog, _chat_event_data,
+    _chat_skip_event, _chat_sse_event, _chat_stream_options, _chat_stream_user, _definition_steps, _env_float, _env_int,
+    _json_dumps_bytes, _schema_state, _sse_event, app as flask_app, chat_bus, dictionary_cache, schema_is_current,
+    translation_cache, translation_coalescer, upstreams,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- 1. Flask 接口：有上限的线程池 ---
+WSGI_EXECUTOR = ThreadPoolExecutor(max_workers=_env_int('ASGI_WSGI_THREADS', 16), thread_name_prefix='wsgi')
+
+def _wsgi_environ(scope, body):
+    root_path, path = scope.get('root_path', ''), scope['path']
+    if root_path and path.startswith(root_path): path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin1').upper().replace('-', '_'), value.decode('latin1')
+        if name == 'CONTENT_LENGTH': continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        # 同名请求头合并成一个，Cookie 按 "; " 拼接
+        if key in environ: value = f"{environ[key]}{'; ' if name == 'COOKIE' else ','}{value}"
+        environ[key] = value
+    return environ
+
+class WsgiAdapter:
+    # 把 ASGI 请求转成一次 WSGI 调用，在 WSGI_EXECUTOR 里执行；响应体按块转发，客户端断开后不再继续读 Flask 的响应
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        body = await _read_body(receive)
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+        watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+        def send_sync(message): asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        try:
+            await loop.run_in_executor(WSGI_EXECUTOR, self._run, _wsgi_environ(scope, body), send_sync, disconnected)
+        finally:
+            watcher.cancel()
+
+    def _run(self, environ, send, disconnected):
+        response = {'started': False}
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response['started']: raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+        def send_start():
+            # 第一块非空响应体之前才发响应头：WSGI 允许迭代过程中再调用 start_response
+            if response['started']: return
+            response['started'] = True
+            send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if disconnected.is_set(): return
+                if not chunk: continue
+                send_start()
+                send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_start()
+            send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'): result.close()
+
+flask_application = WsgiAdapter(flask_app)
+
+# 代理接口读写翻译 / 词典缓存也要查数据库，单独用一个小线程池：
+# 几百个代理请求的缓存读写不会排在笔记、单词本这些接口前面。数据库连接数按两个线程池之和来配
+CACHE_EXECUTOR = ThreadPoolExecutor(max_workers=_env_int('ASGI_CACHE_THREADS', 4), thread_name_prefix='cache')
+
+async def run_in_app_context(fn, *args):
+    def call():
+        with flask_app.app_context(): return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(CACHE_EXECUTOR, call)
+
+# --- 2. 异步上游客户端 ---
+class AsyncUpstream:
+    # 地址、超时、重试次数、熔断器都沿用 app.py 里同名的 UpstreamClient（环境变量也一样），
+    # 另外加一个并发上限 <NAME>_ASYNC_CONCURRENCY：超过上限的请求最多排队 <NAME>_QUEUE_TIMEOUT 秒，然后返回 503
+    def __init__(self, client, concurrency):
+        prefix = client.name.upper()
+        self.client = client
+        self.name = client.name
+        self.concurrency = _env_int(f'{prefix}_ASYNC_CONCURRENCY', concurrency)
+        self.queue_timeout = _env_float(f'{prefix}_QUEUE_TIMEOUT', 5)
+        self._http = None
+        self._semaphore = None
+
+    def start(self):
+        # 必须在事件循环里创建
+        connect_timeout, read_timeout = self.client.timeout
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._http = httpx.AsyncClient(
+            base_url=self.client.base_url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=min(self.concurrency, 50)),
+        )
+
+    async def close(self):
+        if self._http is not None: await self._http.aclose()
+
+    @asynccontextmanager
+    async def _slot(self):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamUnavailable(self.name, '上游服务繁忙，排队超时', 503)
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    async def _send(self, method, path, idempotent, raise_for_status, stream, **kwargs):
+        # 要不要重试、怎么退避、怎么计入熔断，都用 UpstreamClient 上的同一套判断，这里只负责异步发请求
+        client = self.client
+        idempotent = client.resolve_idempotent(method, idempotent)
+        client.check_breaker()
+        request = self._http.build_request(method, path, **kwargs)
+        attempt = 0
+        while True:
+            try:
+                response = await self._http.send(request, stream=stream)
+            except httpx.HTTPError as e:
+                if client.should_retry(attempt, idempotent, connect_failed=isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))):
+                    await asyncio.sleep(client.retry_delay(attempt)); attempt += 1
+                    continue
+                raise client.failed(e) from e
+            if client.should_retry(attempt, idempotent, status_code=response.status_code):
+                await response.aclose()
+                await asyncio.sleep(client.retry_delay(attempt)); attempt += 1
+                continue
+            client.record_status(response.status_code)
+            if raise_for_status and response.status_code >= 400:
+                await response.aclose()
+                raise UpstreamError(self.name, f"HTTP {response.status_code}", response.status_code)
+            return response
+
+    def _record_error(self, e):
+        UPSTREAM_ERRORS.inc(upstream=self.name, kind=UpstreamClient.error_kind(e))
+
+    async def request(self, method, path, idempotent=None, raise_for_status=True, **kwargs):
+        started = time.perf_counter()
+        try:
+            async with self._slot():
+                return await self._send(method, path, idempotent, raise_for_status, False, **kwargs)
+        except UpstreamError as e:
+            self._record_error(e)
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream=self.name)
+
+    @asynccontextmanager
+    async def stream(self, method, path, **kwargs):
+        # 流式响应整个读完之前一直占着一个并发名额
+        started = time.perf_counter()
+        try:
+            async with self._slot():
+                response = await self._send(method, path, None, True, True, **kwargs)
+                try:
+                    yield response
+                finally:
+                    await response.aclose()
+        except UpstreamError as e:
+            self._record_error(e)
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream=self.name)
+
+    async def aiter_lines(self, response):
+        # 流式读取时的网络异常同样转换成 UpstreamError，并计入熔断
+        try:
+            async for line in response.aiter_lines(): yield line
+        except httpx.HTTPError as e:
+            UPSTREAM_ERRORS.inc(upstream=self.name, kind='stream')
+            raise self.client.failed(e) from e
+
+async_upstreams = {
+    'deepl': AsyncUpstream(upstreams['deepl'], 100),
+    'deepseek': AsyncUpstream(upstreams['deepseek'], 200),
+    'dictionary': AsyncUpstream(upstreams['dictionary'], 100),
+}
+
+# --- 3. 响应辅助函数 ---
+class HttpRequest:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope.get('headers', [])}
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin1')))
+
+    def get_json(self):
+        # 和 Flask 的 request.get_json(silent=True) 一样：解析失败返回 None
+        try: return json.loads(self.body) if self.body else None
+        except ValueError: return None
+
+def _response_headers(request, content_type, extra=None):
+    # 这几个接口不经过 Flask，CORS 头要自己加（和 CORS(app, supports_credentials=True) 的行为一致）
+    headers = [(b'content-type', content_type.encode())]
+    origin = request.headers.get('origin')
+    if origin:
+        headers += [(b'access-control-allow-origin', origin.encode('latin1')), (b'access-control-allow-credentials', b'true'), (b'vary', b'Origin')]
+    for name, value in (extra or {}).items(): headers.append((name.lower().encode(), value.encode()))
+    return headers
+
+async def send_body(send, request, status, body, content_type='application/json', headers=None):
+    await send({'type': 'http.response.start', 'status': status, 'headers': _response_headers(request, content_type, headers) + [(b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, request, status, payload, headers=None):
+    await send_body(send, request, status, _json_dumps_bytes(payload) + b'\n', headers=headers)
+
+async def send_upstream_error(send, request, e, message):
+    await send_json(send, request, 503 if isinstance(e, UpstreamUnavailable) else 502, {'error': message, 'details': str(e)})
+
+async def _watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+# --- 4. 异步代理接口 ---
+async def deepseek_chat_proxy(request, receive, send):
+    api_key = os.environ.get('DEEPSEEK_API_KEY')
+    if not api_key: return await send_json(send, request, 500, {'error': '服务器未配置 DeepSeek API Key'})
+    data = request.get_json()
+    headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'}
+    upstream = async_upstreams['deepseek']
+    if not (data and data.get('stream')):
+        try:
+            response = await upstream.request('POST', '/chat/completions', headers=headers, json=data)
+            return await send_json(send, request, 200, response.json())
+        except (UpstreamError, ValueError) as e:
+            return await send_upstream_error(send, request, e, '请求 AI 服务失败')
+    # 流式透传，事件格式和 app.py 的 _stream_deepseek_chat 完全一样（最后附一个 trailer 事件）
+    data.setdefault('stream_options', {'include_usage': True})
+    started = time.monotonic()
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        async with upstream.stream('POST', '/chat/completions', headers=headers, json=data) as response:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': _response_headers(
+                request, 'text/event-stream; charset=utf-8', {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})})
+            first_chunk_at, usage, completed = None, None, False
+            try:
+                async for line in upstream.aiter_lines(response):
+                    if disconnected.is_set():
+                        logger.info("deepseek stream: client disconnected after %.2fs", time.monotonic() - started)
+                        return
+                    if first_chunk_at is None and line: first_chunk_at = time.monotonic()
+                    if line.startswith('data: {') and '"usage"' in line:
+                        try: usage = json.loads(line[6:]).get('usage') or usage
+                        except ValueError: pass
+                    elif line == 'data: [DONE]':
+                        completed = True
+                    await send({'type': 'http.response.body', 'body': line.encode('utf-8') + b'\n', 'more_body': True})
+            except UpstreamError as e:
+                tail = _sse_event('error', {'error': '请求 AI 服务失败', 'details': str(e)})
+            else:
+                tail = _sse_event('trailer', {
+                    'completed': completed,
+                    'usage': usage,
+                    'ttft_ms': round((first_chunk_at - started) * 1000) if first_chunk_at else None,
+                    'total_ms': round((time.monotonic() - started) * 1000)
+                })
+            await send({'type': 'http.response.body', 'body': tail})
+    except UpstreamError as e:
+        await send_upstream_error(send, request, e, '请求 AI 服务失败')
+    finally:
+        watcher.cancel()
+
+class AsyncTranslationCoalescer:
+    # 对应 app.py 的 TranslationCoalescer：同一段文本同一时间只发一次上游请求，其余请求等同一个结果。
+    # key 和 translation_cache 一样（合并空白后的文本 + 目标语言）；只合并相同的文本，不把不同文本攒成一批
+    def __init__(self, wait_timeout):
+        self.wait_timeout = wait_timeout
+        self._inflight = {}
+
+    async def submit(self, text, target_lang, translate_fn):
+        key = translation_cache.make_key(text, target_lang)
+        future = self._inflight.get(key)
+        if future is not None:
+            try:
+                # 领头的请求卡住（慢响应 + 重试）时，跟着等的请求最多等 wait_timeout 秒
+                return await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+            except asyncio.TimeoutError:
+                raise UpstreamError('deepl', '等待合并的翻译结果超时')
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await translate_fn(text, target_lang)
+        except BaseException as e:
+            # 领头的请求被取消（客户端断开）时，跟着等的请求拿到一个上游错误，而不是跟着被取消
+            future.set_exception(e if isinstance(e, Exception) else UpstreamError('deepl', '合并的翻译请求已取消'))
+            future.exception()  # 没有请求在等时，不要打印 "exception was never retrieved"
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+async_translation_coalescer = AsyncTranslationCoalescer(translation_coalescer.wait_timeout)
+
+async def _translate_one(text, target_lang):
+    # 翻译是幂等的，失败可以放心重试
+    response = await async_upstreams['deepl'].request('POST', '/v2/translate', idempotent=True, headers={'Authorization': f"DeepL-Auth-Key {os.environ.get('DEEPL_API_KEY')}"}, json={'text': [text], 'target_lang': target_lang})
+    translations = response.json().get('translations') or []
+    if len(translations) != 1: raise UpstreamError('deepl', '翻译结果数量与请求不一致')
+    await run_in_app_context(translation_cache.store, [(text, translations[0])], target_lang)
+    return translations[0]
+
+async def deepl_translate_proxy(request, receive, send):
+    api_key = os.environ.get('DEEPL_API_KEY')
+    if not api_key: return await send_json(send, request, 500, {'error': '服务器未配置 DeepL API Key'})
+    data = request.get_json() or {}
+    text, target_lang = data.get('text'), (data.get('target_lang') or 'ZH').upper()
+    cacheable = isinstance(text, str) and text.strip() != ''
+    if cacheable:
+        cached = (await run_in_app_context(translation_cache.lookup, [text], target_lang)).get(text)
+        if cached: return await send_json(send, request, 200, {'translations': [cached]})
+    try:
+        if cacheable: return await send_json(send, request, 200, {'translations': [await async_translation_coalescer.submit(text, target_lang, _translate_one)]})
+        response = await async_upstreams['deepl'].request('POST', '/v2/translate', idempotent=True, headers={'Authorization': f'DeepL-Auth-Key {api_key}'}, json={'text': [text], 'target_lang': target_lang})
+        return await send_json(send, request, 200, response.json())
+    except (UpstreamError, ValueError) as e:
+        return await send_upstream_error(send, request, e, '请求翻译服务失败')
+
+async def _fetch_definition(word):
+    # 查词流程（含词原形兜底）在 app.py 的 _definition_steps 里，这里只负责异步发请求
+    upstream = async_upstreams['dictionary']
+    steps = _definition_steps(word)
+    target = next(steps)
+    try:
+        while True:
+            try: response = await upstream.request('GET', f"/api/v2/entries/en/{target}", raise_for_status=False)
+            except UpstreamError as e: target = steps.throw(e)
+            else: target = steps.send((response.status_code, response.text))
+    except StopIteration as done:
+        return done.value
+
+async def dictionary_proxy(request, receive, send, word):
+    word = dictionary_cache.normalize(word or '')
+    if not word: return await send_json(send, request, 400, {'error': 'Word parameter is missing'})
+    result = (await run_in_app_context(dictionary_cache.lookup, [word])).get(word)
+    if result is None:
+        try:
+            result = await _fetch_definition(word)
+        except (UpstreamError, ValueError) as e:
+            return await send_upstream_error(send, request, e, '词典服务连接或解析失败')
+        await run_in_app_context(dictionary_cache.store, {word: result})
+    # payload 已经是 JSON 文本，直接返回
+    status_code, payload = result
+    await send_body(send, request, status_code, payload.encode('utf-8'))
+
+# --- 5. 聊天推送 ---
+def _int_or_none(value):
+    try: return int(value)
+    except (TypeError, ValueError): return None
+
+async def chat_event_stream(request, receive, send):
+    # 和 app.py 的 /api/chat/stream 行为一致（同样的鉴权、补发、去重和事件格式），但等待新消息时不占线程
+    user_info = await run_in_app_context(_chat_stream_user, request.headers.get('authorization'), request.args.get('ticket'))
+    if not user_info: return await send_json(send, request, 401, {'error': '未授权'})
+    username = user_info['username']
+    # 断线重连时浏览器会带上 Last-Event-ID，从这条之后补发
+    last_id = _int_or_none(request.headers.get('last-event-id')) or _int_or_none(request.args.get('last_id')) or 0
+    heartbeat, max_duration = _chat_stream_options()
+    loop = asyncio.get_running_loop()
+    wakeup, disconnected = asyncio.Event(), asyncio.Event()
+
+    async def watch():
+        await _watch_disconnect(receive, disconnected)
+        wakeup.set()
+
+    async def emit(chunk):
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+
+    watcher = asyncio.create_task(watch())
+    # 先订阅再补发历史，避免两者之间漏消息；发布方在别的线程里，通过 call_soon_threadsafe 叫醒这里
+    subscription = chat_bus.subscribe(username, notify=lambda: loop.call_soon_threadsafe(wakeup.set))
+    started = time.monotonic()
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': _response_headers(request, 'text/event-stream; charset=utf-8', CHAT_STREAM_HEADERS)})
+        await emit("retry: 3000\n\n")
+        backlog = await run_in_app_context(_chat_backlog, username, last_id) if last_id else []
+        backlog_ids = {message['id'] for message in backlog}
+        for message in backlog: await emit(_chat_sse_event('chat_message', message['id'], message))
+        while not disconnected.is_set() and not subscription.overflowed:
+            remaining = max_duration - (time.monotonic() - started)
+            if remaining <= 0: break
+            try:
+                event, event_id, data = subscription.queue.get_nowait()
+            except queue.Empty:
+                wakeup.clear()
+                # clear 之前刚好进来的事件（或断开）不能漏掉
+                if not subscription.queue.empty() or disconnected.is_set(): continue
+                try: await asyncio.wait_for(wakeup.wait(), min(heartbeat, remaining))
+                except asyncio.TimeoutError: await emit(": ping\n\n")
+                continue
+            if _chat_skip_event(event, event_id, last_id, backlog_ids): continue
+            if data is None:
+                data = await run_in_app_context(_chat_event_data, event, event_id)
+                if data is None: continue
+            await emit(_chat_sse_event(event, event_id, data))
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        chat_bus.unsubscribe(subscription)
+        watcher.cancel()
+
+# (方法, 路径正则, 处理函数, 监控指标里的路由名，和 Flask 的 url_rule 保持一致)
+ASYNC_ROUTES = [
+    ('POST', re.compile(r'^/api/deepseek-chat$'), deepseek_chat_proxy, '/api/deepseek-chat'),
+    ('POST', re.compile(r'^/api/deepl-translate$'), deepl_translate_proxy, '/api/deepl-translate'),
+    ('GET', re.compile(r'^/api/dictionary-proxy/(?P<word>[^/]+)$'), dictionary_proxy, '/api/dictionary-proxy/<word>'),
+    ('GET', re.compile(r'^/api/chat/stream$'), chat_event_stream, '/api/chat/stream'),
+]
+
+# --- 6. ASGI 入口 ---
+_started = False
+
+def _start_upstreams():
+    global _started
+    if _started: return
+    for upstream in async_upstreams.values(): upstream.start()
+    _started = True
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _start_upstreams()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for upstream in async_upstreams.values(): await upstream.close()
+            WSGI_EXECUTOR.shutdown(wait=False)
+            CACHE_EXECUTOR.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'): return b''.join(chunks)
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan': return await _lifespan(receive, send)
+    if scope['type'] == 'http':
+        for method, pattern, handler, rule in ASYNC_ROUTES:
+            match = pattern.match(scope['path'])
+            if not match or scope['method'] != method: continue
+            # 服务器不支持 lifespan 时，第一个请求进来再创建客户端
+            _start_upstreams()
+            started, status = time.perf_counter(), [500]
+            async def tracking_send(message):
+                if message['type'] == 'http.response.start': status[0] = message['status']
+                await send(message)
+            try:
+                request = HttpRequest(scope, await _read_body(receive))
+                # 这几个接口不经过 Flask 的 before_request：数据库版本落后时同样直接返回 503，不查缓存表、不调上游
+                if not _schema_state['current'] and not await run_in_app_context(schema_is_current):
+                    return await send_json(tracking_send, request, 503, {'error': SCHEMA_UPGRADING_ERROR}, {'Retry-After': SCHEMA_RETRY_AFTER})
+                return await handler(request, receive, tracking_send, **match.groupdict())
+            finally:
+                HTTP_REQUESTS.inc(endpoint=rule, method=method, status=status[0])
+                HTTP_LATENCY.observe(time.perf_counter() - started, endpoint=rule, method=method)
+    # 其余接口（包括这几个路径的 OPTIONS 预检）交给 Flask
+    await flask_application(scope, receive, send)
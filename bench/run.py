@@ -0,0 +1,195 @@
+# bench/run.py
+# 压测脚本：用合成数据 + 假上游跑一组固定场景，输出每个场景的 p50/p95/p99 延迟、吞吐量和每请求 SQL 条数。
+#
+# 用法（在仓库根目录执行）：
+#   python bench/run.py                                   # 默认 SQLite，小规模
+#   python bench/run.py --db postgresql://localhost/bench --users 2000 --topics 5000
+#   python bench/run.py --scenarios rank,plaza_feed --requests 500 --concurrency 16
+# 结果同时写到 bench_output.txt（已在 .gitignore 里）。
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import stubs  # noqa: E402
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values: return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+# 每个压测线程自己数 SQL 条数：流式响应的查询在读响应体时才执行，响应头里没有 X-Query-Count
+_queries = threading.local()
+
+
+def _count_query(*args):
+    _queries.count = getattr(_queries, 'count', 0) + 1
+
+
+def _make_token(app_module, user_id, username):
+    import jwt
+    return jwt.encode({'user_id': user_id, 'username': username, 'tv': 0, 'exp': datetime.utcnow() + timedelta(hours=1)},
+                      app_module.app.config['SECRET_KEY'], algorithm='HS256')
+
+
+def build_scenarios(app_module, data, rng):
+    # 每个场景是一个函数：返回 (method, path, json_body, headers)
+    users = list(data['user_ids'].items())
+    tokens = {uid: _make_token(app_module, uid, name) for name, uid in users}
+    auth = lambda uid: {'Authorization': f'Bearer {tokens[uid]}'}
+    any_user = lambda: rng.choice(users)[1]
+
+    def chat_pair():
+        me, other = rng.choice(data['chat_pairs'])
+        return (me, other) if rng.random() < 0.5 else (other, me)
+
+    def chat_history():
+        me, other = chat_pair()
+        return 'GET', f'/api/chat/{other}', None, auth(me)
+
+    def chat_history_page():
+        me, other = chat_pair()
+        return 'GET', f'/api/chat/{other}?limit=50', None, auth(me)
+
+    def chat_poll():
+        me, other = chat_pair()
+        return 'GET', f'/api/chat/{other}/new?since={data["max_message_id"]}', None, auth(me)
+
+    return {
+        'rank': lambda: ('GET', '/api/rank', None, auth(any_user())),
+        'rank_me': lambda: ('GET', '/api/rank/me', None, auth(any_user())),
+        'plaza_topics': lambda: ('GET', '/api/plaza/topics', None, {}),
+        'plaza_feed': lambda: ('GET', '/api/plaza/feed', None, {}),
+        'topic_details': lambda: ('GET', f'/api/plaza/topics/{rng.choice(data["topic_ids"])}', None, {}),
+        'chat_history': chat_history,
+        'chat_history_page': chat_history_page,
+        'chat_poll': chat_poll,
+        'chat_inbox': lambda: ('GET', '/api/chat/inbox', None, auth(chat_pair()[0])),
+        'notes': lambda: ('GET', '/api/notes', None, auth(any_user())),
+        'vocab': lambda: ('GET', '/api/vocab', None, auth(any_user())),
+        'translate': lambda: ('POST', '/api/deepl-translate', {'text': rng.choice(stubs_sentences), 'target_lang': 'ZH'}, {}),
+        'dictionary': lambda: ('GET', f'/api/dictionary-proxy/word{rng.randint(0, 300)}', None, {}),
+    }
+
+
+stubs_sentences = [f'Sentence number {i} from a lecture.' for i in range(200)]
+
+
+def run_scenario(app_module, make_request, total, concurrency):
+    latencies, query_counts, statuses = [], [], {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(_):
+        client = getattr(local, 'client', None)
+        if client is None: client = local.client = app_module.app.test_client()
+        method, path, body, headers = make_request()
+        _queries.count = 0
+        started = time.perf_counter()
+        # 线程池压测相当于 gthread worker：告诉应用有并发，翻译请求才会合并
+        response = client.open(path, method=method, json=body, headers=headers, environ_overrides={'wsgi.multithread': concurrency > 1})
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            query_counts.append(_queries.count)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': total,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'rps': total / wall if wall else 0.0,
+        'queries_per_request': sum(query_counts) / len(query_counts) if query_counts else 0.0,
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='backend-DT 压测')
+    parser.add_argument('--db', default='sqlite:////tmp/backend_dt_bench.db', help='数据库 URL（SQLite 或本地 Postgres）')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--vocab-per-user', type=int, default=50)
+    parser.add_argument('--notes-per-user', type=int, default=10)
+    parser.add_argument('--topics', type=int, default=300)
+    parser.add_argument('--comments-per-topic', type=int, default=20)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--messages-per-chat', type=int, default=100)
+    parser.add_argument('--upstream-latency-ms', type=float, default=30)
+    parser.add_argument('--requests', type=int, default=200, help='每个场景的请求数')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios', default='rank,rank_me,plaza_topics,plaza_feed,topic_details,chat_history,chat_history_page,chat_poll,translate')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-seed', action='store_true', help='复用数据库里已有的数据（必须是之前用同样参数生成的）')
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args()
+
+    # app.py 在导入时读取环境变量，所以要先启动假上游、设置好环境变量再导入
+    os.environ.update(stubs.start_all(args.upstream_latency_ms))
+    os.environ['DATABASE_URL'] = args.db
+    import app as app_module
+    from bench.seed import seed
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, 'after_cursor_execute', _count_query)
+
+    seed_kwargs = dict(users=args.users, vocab_per_user=args.vocab_per_user, notes_per_user=args.notes_per_user, topics=args.topics,
+                       comments_per_topic=args.comments_per_topic, chats=args.chats, messages_per_chat=args.messages_per_chat, seed_value=args.seed)
+    if args.skip_seed:
+        with app_module.app.app_context():
+            db = app_module.db
+            data = {
+                'user_ids': dict(db.session.query(app_module.User.username, app_module.User.id)),
+                'topic_ids': [row[0] for row in db.session.query(app_module.PlazaTopic.id)],
+                'chat_pairs': [],
+                'max_message_id': db.session.query(db.func.max(app_module.ChatMessage.id)).scalar() or 0,
+            }
+            names = {name: uid for name, uid in data['user_ids'].items()}
+            for sender, receiver in db.session.query(app_module.ChatMessage.sender_username, app_module.ChatMessage.receiver_username).distinct().limit(1000):
+                data['chat_pairs'].append((names[sender], names[receiver]))
+    else:
+        print('正在生成压测数据...')
+        started = time.perf_counter()
+        data = seed(app_module, **seed_kwargs)
+        print(f'数据生成完成，用时 {time.perf_counter() - started:.1f}s')
+
+    rng = random.Random(args.seed)
+    scenarios = build_scenarios(app_module, data, rng)
+    selected = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown: parser.error(f'未知场景: {", ".join(unknown)}（可选: {", ".join(scenarios)}）')
+
+    header = f'{"scenario":<20}{"reqs":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}{"q/req":>8}  statuses'
+    lines = [f'# backend-DT bench {datetime.utcnow().isoformat()}Z db={args.db.split("@")[-1]} ' + ' '.join(f'{k}={v}' for k, v in seed_kwargs.items()),
+             f'# requests={args.requests} concurrency={args.concurrency} upstream_latency_ms={args.upstream_latency_ms}', header]
+    print(header)
+    for name in selected:
+        # 先预热几次，避免把首次连接、首次编译 SQL 的开销算进去
+        run_scenario(app_module, scenarios[name], min(10, args.requests), 1)
+        result = run_scenario(app_module, scenarios[name], args.requests, args.concurrency)
+        line = (f'{name:<20}{result["requests"]:>7}{result["p50_ms"]:>10.1f}{result["p95_ms"]:>10.1f}{result["p99_ms"]:>10.1f}'
+                f'{result["rps"]:>10.1f}{result["queries_per_request"]:>8.1f}  {result["statuses"]}')
+        print(line)
+        lines.append(line)
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n\n')
+    print(f'结果已追加到 {args.output}')
+
+
+if __name__ == '__main__':
+    main()
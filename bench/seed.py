@@ -0,0 +1,104 @@
+# bench/seed.py
+# 合成压测数据：N 个用户，以及他们的单词本、笔记、广场帖子和评论、私聊记录。
+# 用同一个 --seed 生成的数据完全一样，方便前后对比。
+
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+WORDS = ('algorithm', 'entropy', 'gradient', 'lecture', 'theorem', 'protein', 'velocity', 'matrix', 'syntax', 'equilibrium',
+         'hypothesis', 'catalyst', 'spectrum', 'integral', 'neuron', 'tensor', 'kernel', 'lattice', 'quantum', 'vector')
+SENTENCES = ('Today we will talk about the second law of thermodynamics.',
+             'Please open your textbook to chapter three.',
+             'The gradient points in the direction of steepest ascent.',
+             'Any questions before we move on?',
+             'This result follows directly from the previous theorem.')
+
+
+def _insert(db, table, rows, batch_size=1000):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start:start + batch_size])
+    db.session.commit()
+
+
+def seed(app_module, users=200, vocab_per_user=50, notes_per_user=10, topics=500, comments_per_topic=20,
+         chats=300, messages_per_chat=100, seed_value=42):
+    # 清空数据库后重新生成；返回压测脚本需要用到的一些 id
+    app, db = app_module.app, app_module.db
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    with app.app_context():
+        db.drop_all()
+        app_module.migrate_database()
+
+        usernames = [f'bench_user_{i}' for i in range(users)]
+        _insert(db, app_module.User.__table__, [{
+            'username': name, 'password': 'bench', 'likes_received': rng.randint(0, 500),
+            'avatar_url': rng.choice(app_module.AVATAR_CHOICES), 'vocab_count': 0, 'token_version': 0
+        } for name in usernames])
+        user_ids = dict(db.session.query(app_module.User.username, app_module.User.id))
+        # 点赞关系只用来让 likes 表有数据（获赞数上面已经随机好了，两者不要求一致）
+        like_pairs = {tuple(rng.sample(range(users), 2)) for _ in range(users * 5)} if users > 1 else set()
+        _insert(db, app_module.Like.__table__, [{'liker_id': user_ids[usernames[a]], 'liked_user_id': user_ids[usernames[b]], 'created_at': now}
+                                                for a, b in sorted(like_pairs)])
+
+        vocab_rows = []
+        for name in usernames:
+            words = rng.sample(range(5000), min(vocab_per_user, 5000))
+            vocab_rows.extend({'word': f'{rng.choice(WORDS)}{w}', 'phonetic': '/bench/', 'meaning': '压测释义', 'user_id': user_ids[name]} for w in words)
+        # 同一个用户可能随机到重复单词，先去重以满足 (user_id, word) 唯一约束
+        vocab_rows = list({(r['user_id'], r['word']): r for r in vocab_rows}.values())
+        vocab_counts = {}
+        for row in vocab_rows: vocab_counts[row['user_id']] = vocab_counts.get(row['user_id'], 0) + 1
+        _insert(db, app_module.Vocab.__table__, vocab_rows)
+        db.session.execute(app_module.User.__table__.update().where(app_module.User.id == bindparam('uid')).values(vocab_count=bindparam('cnt')),
+                           [{'uid': uid, 'cnt': cnt} for uid, cnt in vocab_counts.items()])
+        db.session.commit()
+
+        _insert(db, app_module.Note.__table__, [{
+            'content': ' '.join(rng.choice(SENTENCES) for _ in range(20)), 'summary': '压测摘要',
+            'created_at': now - timedelta(minutes=rng.randint(0, 100000)), 'user_id': user_ids[name]
+        } for name in usernames for _ in range(notes_per_user)])
+
+        topic_rows = []
+        for i in range(topics):
+            raw = f'# 帖子 {i}\n\n' + '\n\n'.join(rng.choice(SENTENCES) for _ in range(30))
+            rendered, content_hash = app_module.render_markdown(raw)
+            topic_rows.append({
+                'title': f'压测帖子 {i}', 'content': rendered, 'content_md': raw, 'content_hash': content_hash,
+                'excerpt': app_module.PlazaTopic.make_excerpt(rendered), 'content_text': app_module.PlazaTopic.make_plain_text(rendered), 'image_url': None,
+                'created_at': now - timedelta(minutes=topics - i), 'author_username': rng.choice(usernames)
+            })
+        _insert(db, app_module.PlazaTopic.__table__, topic_rows)
+        topic_ids = [row[0] for row in db.session.query(app_module.PlazaTopic.id)]
+
+        comment_rows = []
+        for topic_id in topic_ids:
+            for j in range(comments_per_topic):
+                raw = rng.choice(SENTENCES)
+                rendered, content_hash = app_module.render_markdown(raw)
+                comment_rows.append({'content': rendered, 'content_md': raw, 'content_hash': content_hash, 'topic_id': topic_id,
+                                     'created_at': now - timedelta(seconds=comments_per_topic - j), 'author_username': rng.choice(usernames)})
+        _insert(db, app_module.PlazaComment.__table__, comment_rows)
+
+        pairs = set()
+        while len(pairs) < min(chats, users * (users - 1) // 2):
+            a, b = rng.sample(usernames, 2)
+            pairs.add(tuple(sorted((a, b))))
+        pairs = sorted(pairs)
+        message_rows = []
+        for a, b in pairs:
+            key = app_module.ChatMessage.make_conversation_key(a, b)
+            for k in range(messages_per_chat):
+                sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+                message_rows.append({'content': rng.choice(SENTENCES), 'sender_username': sender, 'receiver_username': receiver,
+                                     'conversation_key': key, 'created_at': now - timedelta(seconds=messages_per_chat - k)})
+        _insert(db, app_module.ChatMessage.__table__, message_rows)
+
+        return {
+            'user_ids': user_ids,
+            'topic_ids': topic_ids,
+            'chat_pairs': [(user_ids[a], user_ids[b]) for a, b in pairs],
+            'max_message_id': db.session.query(db.func.max(app_module.ChatMessage.id)).scalar() or 0,
+        }
@@ -0,0 +1,111 @@
+# bench/stubs.py
+# 本地假上游：DeepL、DeepSeek、词典 API，各自可以配置固定延迟，压测时不消耗真实额度。
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+
+class DeepLStub(_StubHandler):
+    def do_POST(self):
+        data = self._read_json()
+        time.sleep(self.latency)
+        texts = data.get('text') or []
+        self._send_json(200, {'translations': [{'detected_source_language': 'EN', 'text': f'[{data.get("target_lang")}] {t}'} for t in texts]})
+
+
+class DeepSeekStub(_StubHandler):
+    def do_POST(self):
+        data = self._read_json()
+        time.sleep(self.latency)
+        answer = '这是压测用的固定回答。'
+        if not data.get('stream'):
+            self._send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': answer}}], 'usage': {'total_tokens': 10}})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_chunk(payload):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+            self.wfile.flush()
+
+        for char in answer:
+            write_chunk(b'data: ' + json.dumps({'choices': [{'delta': {'content': char}}]}, ensure_ascii=False).encode('utf-8') + b'\n\n')
+        write_chunk(b'data: ' + json.dumps({'choices': [], 'usage': {'total_tokens': 10}}).encode('utf-8') + b'\n\n')
+        write_chunk(b'data: [DONE]\n\n')
+        write_chunk(b'')
+
+
+class DictionaryStub(_StubHandler):
+    def do_GET(self):
+        word = self.path.rsplit('/', 1)[-1]
+        time.sleep(self.latency)
+        # 以 zz 开头的单词模拟"查无此词"
+        if word.startswith('zz'):
+            self._send_json(404, {'title': 'No Definitions Found'})
+            return
+        self._send_json(200, [{'word': word, 'phonetic': f'/{word}/', 'meanings': [{'partOfSpeech': 'noun', 'definitions': [{'definition': f'definition of {word}'}]}]}])
+
+
+class _StubServer(ThreadingHTTPServer):
+    # 默认的 listen backlog 只有 5，几百个并发连接时假上游自己就成了瓶颈
+    request_queue_size = 1024
+
+
+def start_stub(handler, latency_ms=0, port=0):
+    # 返回 (server, base_url)；port=0 表示随机端口
+    handler_class = type(handler.__name__, (handler,), {'latency': latency_ms / 1000})
+    server = _StubServer(('127.0.0.1', port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def start_all(latency_ms=0):
+    # 启动三个假上游，返回应该设置的环境变量
+    _, deepl_url = start_stub(DeepLStub, latency_ms)
+    _, deepseek_url = start_stub(DeepSeekStub, latency_ms)
+    _, dictionary_url = start_stub(DictionaryStub, latency_ms)
+    return {
+        'DEEPL_API_URL': deepl_url,
+        'DEEPL_API_KEY': 'bench',
+        'DEEPSEEK_API_URL': deepseek_url,
+        'DEEPSEEK_API_KEY': 'bench',
+        'DICTIONARY_API_URL': dictionary_url,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='单独启动假上游服务')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    args = parser.parse_args()
+    for key, value in start_all(args.latency_ms).items(): print(f'{key}={value}')
+    print('假上游已启动，Ctrl+C 退出')
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,53 @@
+# 测试统一跑在一个临时 SQLite 文件上：每个测试前删表重建、清空进程内缓存。
+# 后台摘要线程关掉（SUMMARY_WORKERS=0），摘要任务由测试自己调用 _claim_summary_job / run_summary_job 推进。
+import os
+import sys
+import tempfile
+
+import pytest
+
+DB_PATH = os.path.join(tempfile.gettempdir(), f'backend_dt_test_{os.getpid()}.db')
+os.environ.update(DATABASE_URL=f'sqlite:///{DB_PATH}', AUTO_MIGRATE='1', SUMMARY_WORKERS='0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+def pytest_configure(config):
+    # 不再允许新代码用 Query.get() 之类的旧接口
+    config.addinivalue_line('filterwarnings', 'error::sqlalchemy.exc.LegacyAPIWarning')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _remove_test_database():
+    yield
+    if os.path.exists(DB_PATH): os.remove(DB_PATH)
+
+
+@pytest.fixture
+def app():
+    with app_module.app.app_context():
+        app_module.db.session.remove()
+        app_module.db.drop_all()
+        app_module.migrate_database()
+        app_module.db.session.remove()
+    for value in vars(app_module).values():
+        if isinstance(value, app_module.TTLCache): value.clear()
+    app_module.translation_cache.memory.clear()
+    app_module.dictionary_cache.memory.clear()
+    yield app_module
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
+
+
+@pytest.fixture
+def make_user(client):
+    # 注册并登录，返回 {'id', 'username', 'headers'}
+    def make(username):
+        client.post('/api/register', json={'username': username, 'password': 'pw123456'})
+        body = client.post('/api/login', json={'username': username, 'password': 'pw123456'}).get_json()
+        return {'id': body['user_id'], 'username': username, 'headers': {'Authorization': f"Bearer {body['token']}"}}
+    return make
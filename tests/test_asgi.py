@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import asgi
+
+
+@pytest.fixture
+def upstream_calls(app, monkeypatch):
+    # 三个异步上游都换成 MockTransport；handlers[名字] 决定返回什么，calls 记录每次请求
+    calls = {name: [] for name in asgi.async_upstreams}
+    handlers = {}
+    monkeypatch.setenv('DEEPL_API_KEY', 'test-key')
+    monkeypatch.setenv('DEEPSEEK_API_KEY', 'test-key')
+    monkeypatch.setattr(asgi, '_started', True)
+    for name, upstream in asgi.async_upstreams.items():
+        async def handle(request, name=name):
+            calls[name].append(request)
+            return await handlers[name](request)
+        monkeypatch.setattr(upstream, '_http', httpx.AsyncClient(base_url=upstream.client.base_url, transport=httpx.MockTransport(handle)))
+        monkeypatch.setattr(upstream, '_semaphore', None)
+        monkeypatch.setattr(upstream.client.breaker, '_opened_at', None)
+    calls['handlers'] = handlers
+    return calls
+
+
+def _run(coro_fn):
+    # 信号量要在测试自己的事件循环里创建
+    async def main():
+        for upstream in asgi.async_upstreams.values():
+            if upstream._semaphore is None: upstream._semaphore = asyncio.Semaphore(upstream.concurrency)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi.application), base_url='http://test') as client:
+            return await coro_fn(client)
+    return asyncio.run(main())
+
+
+def test_dictionary_proxy_caches_lookups(upstream_calls):
+    async def found(request): return httpx.Response(200, json=[{'word': 'apple'}])
+    upstream_calls['handlers']['dictionary'] = found
+    async def scenario(client):
+        first = await client.get('/api/dictionary-proxy/Apple')
+        second = await client.get('/api/dictionary-proxy/apple')
+        return first, second
+    first, second = _run(scenario)
+    assert first.status_code == 200 and first.json() == [{'word': 'apple'}]
+    assert second.json() == first.json()
+    assert [r.url.path for r in upstream_calls['dictionary']] == ['/api/v2/entries/en/apple']
+
+
+def test_translate_coalesces_identical_concurrent_requests(upstream_calls):
+    async def translate(request):
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, json={'translations': [{'detected_source_language': 'EN', 'text': '你好'}]})
+    upstream_calls['handlers']['deepl'] = translate
+    async def scenario(client):
+        texts = ['hello world', 'hello  world', ' hello world'] * 3
+        return await asyncio.gather(*(client.post('/api/deepl-translate', json={'text': t}) for t in texts))
+    responses = _run(scenario)
+    assert {r.status_code for r in responses} == {200}
+    assert {r.json()['translations'][0]['text'] for r in responses} == {'你好'}
+    assert len(upstream_calls['deepl']) == 1
+    # 发给上游的是先到的那个请求的原文
+    assert json.loads(upstream_calls['deepl'][0].content)['text'][0] in {'hello world', 'hello  world', ' hello world'}
+
+
+def test_translate_coalesced_failure_reaches_every_waiter(upstream_calls):
+    async def broken(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(400, json={'message': 'bad'})
+    upstream_calls['handlers']['deepl'] = broken
+    async def scenario(client):
+        return await asyncio.gather(*(client.post('/api/deepl-translate', json={'text': 'hello'}) for _ in range(3)))
+    assert [r.status_code for r in _run(scenario)] == [502, 502, 502]
+    assert len(upstream_calls['deepl']) == 1
+
+
+def test_deepseek_chat_proxy(upstream_calls):
+    async def complete(request):
+        if json.loads(request.content).get('stream'):
+            return httpx.Response(200, content=b'data: {"choices": []}\n\ndata: [DONE]\n\n', headers={'content-type': 'text/event-stream'})
+        return httpx.Response(200, json={'choices': [{'message': {'content': '你好'}}]})
+    upstream_calls['handlers']['deepseek'] = complete
+    async def scenario(client):
+        plain = await client.post('/api/deepseek-chat', json={'messages': []})
+        streamed = await client.post('/api/deepseek-chat', json={'messages': [], 'stream': True})
+        return plain, streamed
+    plain, streamed = _run(scenario)
+    assert plain.json()['choices'][0]['message']['content'] == '你好'
+    assert streamed.headers['content-type'].startswith('text/event-stream')
+    assert 'data: [DONE]' in streamed.text and 'event: trailer' in streamed.text
+    assert '"completed": true' in streamed.text
+
+
+def test_upstream_queue_timeout_returns_503(upstream_calls, monkeypatch):
+    async def slow(request):
+        await asyncio.sleep(0.3)
+        return httpx.Response(200, json=[])
+    upstream_calls['handlers']['dictionary'] = slow
+    dictionary = asgi.async_upstreams['dictionary']
+    monkeypatch.setattr(dictionary, 'concurrency', 1)
+    monkeypatch.setattr(dictionary, 'queue_timeout', 0.05)
+    async def scenario(client):
+        return await asyncio.gather(client.get('/api/dictionary-proxy/apple'), client.get('/api/dictionary-proxy/pear'))
+    assert sorted(r.status_code for r in _run(scenario)) == [200, 503]
+
+
+def test_async_routes_answer_503_until_schema_is_current(upstream_calls, make_user, monkeypatch):
+    alice = make_user('alice')
+    monkeypatch.setitem(asgi._schema_state, 'current', False)
+    monkeypatch.setitem(asgi._schema_state, 'checked_at', time.monotonic())
+    async def scenario(client):
+        return await client.get('/api/dictionary-proxy/apple'), await client.get('/api/notes', headers=alice['headers'])
+    proxied, flask_routed = _run(scenario)
+    for response in (proxied, flask_routed):
+        assert response.status_code == 503 and response.headers['Retry-After']
+        assert response.json() == {'error': '服务正在升级，请稍后再试'}
+    assert upstream_calls['dictionary'] == []
+
+
+def test_flask_routes_run_through_the_wsgi_adapter(upstream_calls):
+    async def scenario(client):
+        await client.post('/api/register', json={'username': 'alice', 'password': 'pw123456'})
+        token = (await client.post('/api/login', json={'username': 'alice', 'password': 'pw123456'})).json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+        await client.post('/api/notes', json={'content': '异步入口'}, headers=headers)
+        notes = await client.get('/api/notes', headers=headers)
+        preflight = await client.options('/api/deepl-translate', headers={'Origin': 'http://example.com', 'Access-Control-Request-Method': 'POST'})
+        return notes, preflight
+    notes, preflight = _run(scenario)
+    assert notes.status_code == 200 and [n['content'] for n in notes.json()] == ['异步入口']
+    assert preflight.headers['access-control-allow-origin'] == 'http://example.com'
+
+
+def test_lifespan_starts_and_closes_clients(monkeypatch):
+    monkeypatch.setattr(asgi, '_started', False)
+    monkeypatch.setattr(asgi, 'WSGI_EXECUTOR', ThreadPoolExecutor(1))
+    monkeypatch.setattr(asgi, 'CACHE_EXECUTOR', ThreadPoolExecutor(1))
+    for upstream in asgi.async_upstreams.values():
+        monkeypatch.setattr(upstream, '_http', None)
+        monkeypatch.setattr(upstream, '_semaphore', None)
+    sent = []
+    async def main():
+        messages = asyncio.Queue()
+        for message in ({'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}): messages.put_nowait(message)
+        async def send(message): sent.append(message['type'])
+        await asgi.application({'type': 'lifespan'}, messages.get, send)
+    asyncio.run(main())
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert all(upstream._http.is_closed for upstream in asgi.async_upstreams.values())
+
+
+def test_open_chat_streams_do_not_starve_other_routes(upstream_calls, client, make_user, monkeypatch):
+    # 线程池只有 2 个线程，却同时开着 6 个聊天推送：推送不占线程，笔记接口照常响应
+    monkeypatch.setattr(asgi, 'WSGI_EXECUTOR', ThreadPoolExecutor(2))
+    monkeypatch.setenv('CHAT_STREAM_MAX_SECONDS', '1.5')
+    monkeypatch.setenv('CHAT_STREAM_HEARTBEAT', '0.2')
+    alice, bob = make_user('alice'), make_user('bob')
+    ticket = client.post('/api/chat/stream-ticket', headers=alice['headers']).get_json()['ticket']
+    async def scenario(http):
+        streams = [asyncio.create_task(http.get('/api/chat/stream', headers=alice['headers'])) for _ in range(5)]
+        streams.append(asyncio.create_task(http.get('/api/chat/stream', params={'ticket': ticket})))
+        await asyncio.sleep(0.3)
+        notes = await asyncio.wait_for(http.get('/api/notes', headers=alice['headers']), 1)
+        sent = await asyncio.wait_for(http.post('/api/chat/send', json={'receiver_id': alice['id'], 'content': '在吗'}, headers=bob['headers']), 1)
+        assert not any(stream.done() for stream in streams)
+        return notes, sent, await asyncio.gather(*streams)
+    notes, sent, streams = _run(scenario)
+    assert notes.status_code == 200 and sent.status_code == 201
+    for stream in streams:
+        assert stream.status_code == 200 and stream.headers['content-type'].startswith('text/event-stream')
+        assert f"id: {sent.json()['id']}\nevent: chat_message\n" in stream.text and '在吗' in stream.text
+
+
+def test_chat_stream_replays_backlog_and_requires_login(upstream_calls, client, make_user, monkeypatch):
+    monkeypatch.setenv('CHAT_STREAM_MAX_SECONDS', '0.1')
+    alice, bob = make_user('alice'), make_user('bob')
+    first = client.post('/api/chat/send', json={'receiver_id': alice['id'], 'content': '一'}, headers=bob['headers']).get_json()['id']
+    client.post('/api/chat/send', json={'receiver_id': alice['id'], 'content': '二'}, headers=bob['headers'])
+    async def scenario(http):
+        replay = await http.get('/api/chat/stream', headers={**alice['headers'], 'Last-Event-ID': str(first)})
+        return replay, await http.get('/api/chat/stream')
+    replay, anonymous = _run(scenario)
+    assert replay.text.count('event: chat_message') == 1 and '二' in replay.text
+    assert anonymous.status_code == 401
@@ -0,0 +1,137 @@
+import pytest
+
+
+def _vocab_words(client, user):
+    return {v['word']: v for v in client.get('/api/vocab', headers=user['headers']).get_json()}
+
+
+def _vocab_count(app, user):
+    with app.app.app_context():
+        return app.db.session.get(app.User, user['id']).vocab_count
+
+
+def test_bulk_add_vocab_reports_each_item(app, client, make_user):
+    alice = make_user('alice')
+    client.post('/api/vocab', json={'word': 'apple', 'meaning': '苹果'}, headers=alice['headers'])
+    r = client.post('/api/vocab/bulk', headers=alice['headers'], json={'items': [
+        {'word': 'apple', 'meaning': '新释义'},
+        {'word': 'banana', 'meaning': '香蕉', 'phonetic': '/bəˈnɑːnə/'},
+        {'word': 'banana', 'meaning': '重复'},
+        {'word': 'cherry'},
+    ]})
+    assert r.status_code == 200
+    body = r.get_json()
+    assert body['created'] == 1 and body['updated'] == 0
+    assert [item['status'] for item in body['results']] == ['exists', 'created', 'duplicate', 'invalid']
+    words = _vocab_words(client, alice)
+    assert words['apple']['meaning'] == '苹果' and words['banana']['phonetic'] == '/bəˈnɑːnə/'
+    assert _vocab_count(app, alice) == 2
+
+
+def test_bulk_add_vocab_on_conflict_update(client, make_user):
+    alice = make_user('alice')
+    client.post('/api/vocab', json={'word': 'apple', 'meaning': '苹果'}, headers=alice['headers'])
+    body = client.post('/api/vocab/bulk', headers=alice['headers'], json={'on_conflict': 'update', 'items': [{'word': 'apple', 'meaning': '新释义'}]}).get_json()
+    assert body['updated'] == 1 and body['results'][0]['status'] == 'updated'
+    assert _vocab_words(client, alice)['apple']['meaning'] == '新释义'
+
+
+@pytest.mark.parametrize('item', [
+    {'word': 123, 'meaning': 'x'},
+    {'word': '', 'meaning': 'x'},
+    {'word': 'w' * 101, 'meaning': 'x'},
+    {'word': 'ok', 'meaning': ['x']},
+    {'word': 'ok', 'meaning': 'x', 'phonetic': 'p' * 101},
+    'not-an-object',
+])
+def test_bulk_add_vocab_marks_malformed_items_invalid(client, make_user, item):
+    alice = make_user('alice')
+    r = client.post('/api/vocab/bulk', headers=alice['headers'], json={'items': [item]})
+    assert r.status_code == 200
+    assert r.get_json()['results'][0]['status'] == 'invalid'
+
+
+@pytest.mark.parametrize('body', [None, {}, {'items': []}, {'items': 'apple'}, {'items': [{'word': 'a', 'meaning': 'b'}] * 1001}, {'items': [{'word': 'a', 'meaning': 'b'}], 'on_conflict': 'replace'}])
+def test_bulk_add_vocab_rejects_bad_requests(client, make_user, body):
+    alice = make_user('alice')
+    assert client.post('/api/vocab/bulk', headers=alice['headers'], json=body).status_code == 400
+
+
+def test_bulk_update_vocab(client, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    ids = [item['id'] for item in client.post('/api/vocab/bulk', headers=alice['headers'], json={'items': [
+        {'word': 'apple', 'meaning': '苹果'}, {'word': 'banana', 'meaning': '香蕉'}]}).get_json()['results']]
+    bob_id = client.post('/api/vocab/bulk', headers=bob['headers'], json={'items': [{'word': 'kiwi', 'meaning': '猕猴桃'}]}).get_json()['results'][0]['id']
+    r = client.put('/api/vocab/bulk', headers=alice['headers'], json={'items': [
+        {'id': ids[0], 'meaning': '红苹果'},
+        {'id': ids[1], 'word': ''},
+        {'id': bob_id, 'meaning': '别人的单词'},
+    ]})
+    assert r.status_code == 200
+    assert [item['status'] for item in r.get_json()['results']] == ['updated', 'invalid', 'not_found']
+    assert _vocab_words(client, alice)['apple']['meaning'] == '红苹果'
+    assert _vocab_words(client, bob)['kiwi']['meaning'] == '猕猴桃'
+
+
+def test_bulk_update_vocab_conflicting_word_is_409(client, make_user):
+    alice = make_user('alice')
+    ids = [item['id'] for item in client.post('/api/vocab/bulk', headers=alice['headers'], json={'items': [
+        {'word': 'apple', 'meaning': '苹果'}, {'word': 'banana', 'meaning': '香蕉'}]}).get_json()['results']]
+    assert client.put('/api/vocab/bulk', headers=alice['headers'], json={'items': [{'id': ids[1], 'word': 'apple'}]}).status_code == 409
+
+
+@pytest.mark.parametrize('items', [[{'word': 'x'}], [{'id': 'abc'}], [{'id': True}], [{'id': [1]}], [{'id': {'a': 1}}], ['x'], []])
+def test_bulk_update_vocab_requires_integer_ids(client, make_user, items):
+    alice = make_user('alice')
+    assert client.put('/api/vocab/bulk', headers=alice['headers'], json={'items': items}).status_code == 400
+
+
+def test_bulk_delete_vocab_by_ids_and_words(app, client, make_user):
+    alice = make_user('alice')
+    ids = [item['id'] for item in client.post('/api/vocab/bulk', headers=alice['headers'], json={'items': [
+        {'word': 'apple', 'meaning': '苹果'}, {'word': 'banana', 'meaning': '香蕉'}, {'word': 'cherry', 'meaning': '樱桃'}]}).get_json()['results']]
+    body = client.delete('/api/vocab/bulk', headers=alice['headers'], json={'ids': [ids[0], 999]}).get_json()
+    assert body['deleted'] == 1 and [item['status'] for item in body['results']] == ['deleted', 'not_found']
+    body = client.delete('/api/vocab/bulk', headers=alice['headers'], json={'words': ['banana']}).get_json()
+    assert body['deleted'] == 1
+    assert list(_vocab_words(client, alice)) == ['cherry']
+    assert _vocab_count(app, alice) == 1
+
+
+@pytest.mark.parametrize('body', [{'ids': ['1']}, {'ids': [True]}, {'ids': [1.5]}, {'words': [1]}, {'ids': []}, {}])
+def test_bulk_delete_vocab_rejects_bad_requests(client, make_user, body):
+    alice = make_user('alice')
+    assert client.delete('/api/vocab/bulk', headers=alice['headers'], json=body).status_code == 400
+
+
+def test_bulk_add_notes(client, make_user):
+    alice = make_user('alice')
+    r = client.post('/api/notes/bulk', headers=alice['headers'], json={'notes': [
+        {'content': '第一条', 'summary': '摘要'}, {'content': ''}, {'content': 42}, {'content': '第二条', 'summary': ['x']}, {'content': '第三条'}]})
+    assert r.status_code == 201
+    body = r.get_json()
+    assert body['created'] == 2
+    assert [item['status'] for item in body['results']] == ['created', 'invalid', 'invalid', 'invalid', 'created']
+    assert sorted(n['content'] for n in client.get('/api/notes', headers=alice['headers']).get_json()) == ['第一条', '第三条']
+
+
+def test_bulk_endpoints_require_login(client):
+    assert client.post('/api/vocab/bulk', json={'items': [{'word': 'a', 'meaning': 'b'}]}).status_code == 401
+    assert client.post('/api/notes/bulk', json={'notes': [{'content': 'a'}]}).status_code == 401
+
+
+@pytest.mark.parametrize('method, path', [('post', '/api/vocab/bulk'), ('put', '/api/vocab/bulk'), ('delete', '/api/vocab/bulk'), ('post', '/api/notes/bulk')])
+def test_bulk_endpoints_reject_non_object_bodies(client, make_user, method, path):
+    alice = make_user('alice')
+    assert getattr(client, method)(path, headers=alice['headers'], json=[{'word': 'a', 'id': 1}]).status_code == 400
+
+
+def test_bulk_delete_vocab_rolls_back_on_database_error(app, client, make_user, monkeypatch):
+    alice = make_user('alice')
+    client.post('/api/vocab/bulk', headers=alice['headers'], json={'items': [{'word': 'apple', 'meaning': '苹果'}]})
+    def broken(*args): raise app.SQLAlchemyError('boom')
+    monkeypatch.setattr(app, '_add_tombstones', broken)
+    r = client.delete('/api/vocab/bulk', headers=alice['headers'], json={'words': ['apple']})
+    assert r.status_code == 500 and r.get_json()['error']
+    assert list(_vocab_words(client, alice)) == ['apple']
+    assert _vocab_count(app, alice) == 1
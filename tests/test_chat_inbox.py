@@ -0,0 +1,65 @@
+import pytest
+
+
+def _send(client, sender, receiver, content):
+    return client.post('/api/chat/send', json={'receiver_id': receiver['id'], 'content': content}, headers=sender['headers']).get_json()['id']
+
+
+def _inbox(client, user, **params):
+    return client.get('/api/chat/inbox', query_string=params, headers=user['headers']).get_json()
+
+
+def test_inbox_lists_conversations_with_unread_counts(client, make_user):
+    alice, bob, carol = make_user('alice'), make_user('bob'), make_user('carol')
+    _send(client, bob, alice, '你好')
+    _send(client, bob, alice, '在吗')
+    _send(client, alice, carol, '明天见')
+    last = _send(client, carol, alice, '好的' * 80)
+    conversations = _inbox(client, alice)['conversations']
+    assert [(c['partner']['username'], c['unread_count']) for c in conversations] == [('carol', 1), ('bob', 2)]
+    assert conversations[0]['last_message']['id'] == last
+    assert conversations[0]['last_message']['from_me'] is False
+    assert len(conversations[0]['last_message']['preview']) == 100
+    assert [(c['partner']['username'], c['unread_count'], c['last_message']['from_me']) for c in _inbox(client, carol)['conversations']] == [('alice', 1, True)]
+
+
+def test_mark_read_clears_unread_and_only_moves_forward(client, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    first = _send(client, bob, alice, '一')
+    _send(client, bob, alice, '二')
+    body = client.post(f"/api/chat/{bob['id']}/read", json={'last_read_id': first}, headers=alice['headers']).get_json()
+    assert body == {'partner_id': bob['id'], 'last_read_id': first, 'unread_count': 1}
+    assert _inbox(client, alice)['conversations'][0]['unread_count'] == 1
+    body = client.post(f"/api/chat/{bob['id']}/read", headers=alice['headers']).get_json()
+    assert body['unread_count'] == 0
+    # 已读位置不会倒退
+    body = client.post(f"/api/chat/{bob['id']}/read", json={'last_read_id': 0}, headers=alice['headers']).get_json()
+    assert body['unread_count'] == 0 and body['last_read_id'] > first
+    _send(client, bob, alice, '三')
+    assert _inbox(client, alice)['conversations'][0]['unread_count'] == 1
+
+
+def test_inbox_pages_with_before_id(client, make_user):
+    alice = make_user('alice')
+    partners = [make_user(f'user{i}') for i in range(5)]
+    for partner in partners: _send(client, partner, alice, 'hi')
+    page = _inbox(client, alice, limit=2)
+    seen = [c['partner']['username'] for c in page['conversations']]
+    while page['next_before_id']:
+        page = _inbox(client, alice, limit=2, before_id=page['next_before_id'])
+        seen += [c['partner']['username'] for c in page['conversations']]
+    assert seen == [p['username'] for p in reversed(partners)]
+
+
+@pytest.mark.parametrize('body', [{'last_read_id': -1}, {'last_read_id': 'abc'}, {'last_read_id': True}, {'last_read_id': 1.5}])
+def test_mark_read_rejects_bad_last_read_id(client, make_user, body):
+    alice, bob = make_user('alice'), make_user('bob')
+    _send(client, bob, alice, 'hi')
+    assert client.post(f"/api/chat/{bob['id']}/read", json=body, headers=alice['headers']).status_code == 400
+
+
+def test_mark_read_unknown_partner_and_auth(client, make_user):
+    alice = make_user('alice')
+    assert client.post('/api/chat/999/read', headers=alice['headers']).status_code == 404
+    assert client.post('/api/chat/1/read').status_code == 401
+    assert client.get('/api/chat/inbox').status_code == 401
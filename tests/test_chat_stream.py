@@ -0,0 +1,35 @@
+import json
+
+from sqlalchemy import event
+
+
+def _events(body):
+    return [dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line) for block in body.split('\n\n') if block.startswith('id:')]
+
+
+def test_stream_replays_backlog_after_last_event_id(app, client, make_user, monkeypatch):
+    monkeypatch.setenv('CHAT_STREAM_MAX_SECONDS', '0.1')
+    monkeypatch.setenv('CHAT_STREAM_HEARTBEAT', '0.05')
+    alice, bob = make_user('alice'), make_user('bob')
+    first = client.post('/api/chat/send', json={'receiver_id': alice['id'], 'content': '一'}, headers=bob['headers']).get_json()['id']
+    for content in ('二', '三', '四'):
+        client.post('/api/chat/send', json={'receiver_id': alice['id'], 'content': content}, headers=bob['headers'])
+        client.post('/api/chat/send', json={'receiver_id': bob['id'], 'content': content}, headers=alice['headers'])
+    statements = []
+    with app.app.app_context():
+        engine = app.db.engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        body = client.get('/api/chat/stream', headers={**alice['headers'], 'Last-Event-ID': str(first)}).get_data(as_text=True)
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    events = _events(body)
+    assert [json.loads(e['data'])['content'] for e in events] == ['二', '二', '三', '三', '四', '四']
+    assert {json.loads(e['data'])['sender_username'] for e in events} == {'alice', 'bob'}
+    # 补发多少条消息，查询次数都固定，不随消息条数增长
+    assert len(statements) <= 4
+
+
+def test_stream_requires_login(client):
+    assert client.get('/api/chat/stream').status_code == 401
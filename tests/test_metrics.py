@@ -0,0 +1,5 @@
+def test_metrics_exposes_pool_gauges(client, make_user):
+    make_user('alice')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'db_pool_size ' in body and 'db_pool_checked_out ' in body
+    assert 'http_requests_total' in body
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+
+
+def _publish(client, user, count):
+    return [client.post('/api/plaza/topics', json={'title': f'帖子 {i}', 'content': f'**正文** {i}'}, headers=user['headers']).get_json()['id'] for i in range(count)]
+
+
+def _walk_feed(client, limit):
+    ids, cursor = [], None
+    while True:
+        body = client.get('/api/plaza/feed', query_string={'limit': limit, **({'cursor': cursor} if cursor else {})}).get_json()
+        ids.extend(topic['id'] for topic in body['topics'])
+        cursor = body['next_cursor']
+        if not cursor: return ids
+
+
+def test_feed_pages_newest_first_without_gaps(client, make_user):
+    alice = make_user('alice')
+    ids = _publish(client, alice, 7)
+    assert _walk_feed(client, 3) == ids[::-1]
+
+
+def test_feed_breaks_created_at_ties_by_id(app, client, make_user):
+    alice = make_user('alice')
+    ids = _publish(client, alice, 5)
+    with app.app.app_context():
+        app.PlazaTopic.query.update({app.PlazaTopic.created_at: datetime(2026, 1, 1)})
+        app.db.session.commit()
+    assert _walk_feed(client, 2) == ids[::-1]
+
+
+def test_feed_cards(client, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    topic_id = _publish(client, alice, 1)[0]
+    client.post(f'/api/plaza/topics/{topic_id}/comments', json={'content': '沙发'}, headers=bob['headers'])
+    body = client.get('/api/plaza/feed').get_json()
+    card = body['topics'][0]
+    assert body['next_cursor'] is None
+    assert card['comment_count'] == 1 and card['author_username'] == 'alice'
+    assert card['excerpt'] == '正文 0' and 'content' not in card
+
+
+@pytest.mark.parametrize('cursor', ['not-a-cursor', 'bm90LWEtY3Vyc29y', '%%%'])
+def test_feed_rejects_malformed_cursor(client, cursor):
+    assert client.get('/api/plaza/feed', query_string={'cursor': cursor}).status_code == 400
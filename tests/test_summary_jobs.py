@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def note(client, make_user):
+    alice = make_user('alice')
+    body = client.post('/api/notes', json={'content': '今天学了二叉树', 'summarize': True, 'course_name': '数据结构'}, headers=alice['headers']).get_json()
+    return {'user': alice, 'id': body['note']['id'], 'job': body['summary_job']}
+
+
+def _job(app, job_id):
+    with app.app.app_context():
+        job = app.db.session.get(app.SummaryJob, job_id)
+        return {**job.to_dict(), 'last_error': job.last_error}
+
+
+def _claim_and_run(app):
+    with app.app.app_context():
+        job = app._claim_summary_job()
+        if job: app.run_summary_job(job)
+        return job
+
+
+def _make_due(app):
+    # 跳过重试退避
+    with app.app.app_context():
+        app.SummaryJob.query.update({app.SummaryJob.run_after: datetime.utcnow() - timedelta(seconds=1)})
+        app.db.session.commit()
+
+
+def test_add_note_enqueues_a_pending_job(note):
+    assert note['job']['status'] == 'pending' and note['job']['attempts'] == 0
+
+
+def test_successful_job_writes_summary_and_bumps_sync_version(app, client, note, monkeypatch):
+    seen = []
+    monkeypatch.setattr(app, 'summarize_text', lambda content, course_name=None: seen.append((content, course_name)) or '二叉树的摘要')
+    version = client.get('/api/sync', headers=note['user']['headers']).get_json()['version']
+    assert _claim_and_run(app).attempts == 1
+    assert seen == [('今天学了二叉树', '数据结构')]
+    job = _job(app, note['job']['id'])
+    assert job['status'] == 'done' and job['error'] is None and job['finished_at']
+    body = client.get(f"/api/note/{note['id']}/summary", headers=note['user']['headers']).get_json()
+    assert body['summary'] == '二叉树的摘要' and body['job']['status'] == 'done'
+    assert client.get('/api/sync', headers=note['user']['headers']).get_json()['version'] > version
+    assert _claim_and_run(app) is None
+
+
+@pytest.mark.parametrize('error', ['upstream', 'bug'])
+def test_failures_retry_then_fail_after_max_attempts(app, note, monkeypatch, error):
+    def fail(content, course_name=None):
+        if error == 'upstream': raise app.UpstreamError('deepseek', 'HTTP 503', 503)
+        raise RuntimeError('unexpected')
+    monkeypatch.setattr(app, 'summarize_text', fail)
+    for attempt in range(1, app.SUMMARY_MAX_ATTEMPTS):
+        _claim_and_run(app)
+        job = _job(app, note['job']['id'])
+        assert job['status'] == 'pending' and job['attempts'] == attempt and job['last_error'] and job['error'] is None
+        # 退避时间没到之前不会被领取
+        assert _claim_and_run(app) is None
+        _make_due(app)
+    _claim_and_run(app)
+    job = _job(app, note['job']['id'])
+    assert job['status'] == 'failed' and job['attempts'] == app.SUMMARY_MAX_ATTEMPTS and job['finished_at']
+
+
+def test_expired_lease_is_reclaimed_until_attempts_run_out(app, note):
+    with app.app.app_context():
+        app.SummaryJob.query.update({app.SummaryJob.status: 'running', app.SummaryJob.locked_at: datetime.utcnow() - timedelta(seconds=app.SUMMARY_JOB_LEASE + 1), app.SummaryJob.attempts: 1})
+        app.db.session.commit()
+        claimed = app._claim_summary_job()
+        assert claimed.attempts == 2
+        app.SummaryJob.query.update({app.SummaryJob.locked_at: datetime.utcnow() - timedelta(seconds=app.SUMMARY_JOB_LEASE + 1), app.SummaryJob.attempts: app.SUMMARY_MAX_ATTEMPTS})
+        app.db.session.commit()
+        assert app._claim_summary_job() is None
+    job = _job(app, note['job']['id'])
+    assert job['status'] == 'failed' and job['error']
+
+
+def test_running_job_with_a_live_lease_is_not_claimed_twice(app, note):
+    with app.app.app_context():
+        assert app._claim_summary_job() is not None
+        assert app._claim_summary_job() is None
+
+
+def test_resummarize_endpoint(app, client, note, monkeypatch):
+    headers = note['user']['headers']
+    # 任务还没跑完时不会重复入队
+    r = client.post(f"/api/note/{note['id']}/summary", headers=headers)
+    assert r.status_code == 202 and r.get_json()['job']['id'] == note['job']['id']
+    monkeypatch.setattr(app, 'summarize_text', lambda content, course_name=None: '摘要')
+    _claim_and_run(app)
+    r = client.post(f"/api/note/{note['id']}/summary", headers=headers)
+    assert r.status_code == 202 and r.get_json()['job']['id'] != note['job']['id'] and r.get_json()['job']['status'] == 'pending'
+
+
+def test_deleting_a_note_removes_its_jobs(app, client, note):
+    assert client.delete(f"/api/note/{note['id']}", headers=note['user']['headers']).status_code == 200
+    with app.app.app_context():
+        assert app.SummaryJob.query.count() == 0
+
+
+def test_summary_endpoint_errors(client, make_user, note):
+    bob = make_user('bob')
+    assert client.get(f"/api/note/{note['id']}/summary", headers=bob['headers']).status_code == 404
+    assert client.post(f"/api/note/{note['id']}/summary", headers=bob['headers']).status_code == 404
+    assert client.get(f"/api/note/{note['id']}/summary").status_code == 401
+
+
+def test_summarize_text_stops_after_max_rounds(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_CHARS', 20)
+    # 模型每块都返回比输入还长的内容
+    monkeypatch.setattr(app, '_deepseek_complete', lambda prompt, chunk, course_name=None: calls.append(chunk) or '要点' * 20)
+    with pytest.raises(app.SummaryTooLongError):
+        app.summarize_text('一段很长的笔记\n' * 10)
+    assert 0 < len(calls) < 200
+
+
+def test_summarize_text_reduces_long_notes(app, monkeypatch):
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_CHARS', 20)
+    monkeypatch.setattr(app, '_deepseek_complete', lambda prompt, chunk, course_name=None: '总结' if prompt == app.SUMMARY_REDUCE_PROMPT else '要点')
+    assert app.summarize_text('一段很长的笔记\n' * 10) == '总结'
+
+
+def test_too_long_summary_fails_without_retry(app, note, monkeypatch):
+    def too_long(content, course_name=None): raise app.SummaryTooLongError('笔记太长')
+    monkeypatch.setattr(app, 'summarize_text', too_long)
+    _claim_and_run(app)
+    job = _job(app, note['job']['id'])
+    assert job['status'] == 'failed' and job['attempts'] == 1 and job['error'] == '笔记太长'
@@ -0,0 +1,60 @@
+import pytest
+
+
+def test_notes_etag_revalidation(client, make_user):
+    alice = make_user('alice')
+    client.post('/api/notes', json={'content': '第一条'}, headers=alice['headers'])
+    r = client.get('/api/notes', headers=alice['headers'])
+    assert r.status_code == 200 and r.headers['ETag']
+    etag = r.headers['ETag']
+    assert client.get('/api/notes', headers={**alice['headers'], 'If-None-Match': etag}).status_code == 304
+    client.post('/api/notes', json={'content': '第二条'}, headers=alice['headers'])
+    r = client.get('/api/notes', headers={**alice['headers'], 'If-None-Match': etag})
+    assert r.status_code == 200 and r.headers['ETag'] != etag and len(r.get_json()) == 2
+
+
+def test_vocab_etag_changes_only_for_the_writer(client, make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    etag = client.get('/api/vocab', headers=alice['headers']).headers['ETag']
+    client.post('/api/vocab', json={'word': 'apple', 'meaning': '苹果'}, headers=bob['headers'])
+    assert client.get('/api/vocab', headers={**alice['headers'], 'If-None-Match': etag}).status_code == 304
+    client.post('/api/vocab', json={'word': 'apple', 'meaning': '苹果'}, headers=alice['headers'])
+    assert client.get('/api/vocab', headers={**alice['headers'], 'If-None-Match': etag}).status_code == 200
+
+
+def test_delta_sync_returns_changes_and_deletions(client, make_user):
+    alice = make_user('alice')
+    note_id = client.post('/api/notes', json={'content': '旧笔记'}, headers=alice['headers']).get_json()['note']['id']
+    vocab_id = client.post('/api/vocab', json={'word': 'apple', 'meaning': '苹果'}, headers=alice['headers']).get_json()['vocab']['id']
+    first = client.get('/api/sync?since_version=0', headers=alice['headers']).get_json()
+    assert first['full'] is True and len(first['notes']) == 1 and len(first['vocab']) == 1
+
+    client.delete(f'/api/note/{note_id}', headers=alice['headers'])
+    client.put(f'/api/vocab/{vocab_id}', json={'word': 'apples'}, headers=alice['headers'])
+    client.post('/api/notes', json={'content': '新笔记'}, headers=alice['headers'])
+    delta = client.get(f"/api/sync?since_version={first['version']}", headers=alice['headers']).get_json()
+    assert delta['full'] is False and delta['version'] > first['version']
+    assert [n['content'] for n in delta['notes']] == ['新笔记']
+    assert [v['word'] for v in delta['vocab']] == ['apples']
+    assert delta['deleted'] == {'notes': [note_id], 'vocab': []}
+
+    again = client.get(f"/api/sync?since_version={delta['version']}", headers=alice['headers'])
+    assert again.get_json()['notes'] == [] and again.get_json()['deleted'] == {'notes': [], 'vocab': []}
+    assert client.get(f"/api/sync?since_version={delta['version']}", headers={**alice['headers'], 'If-None-Match': again.headers['ETag']}).status_code == 304
+
+
+def test_sync_from_a_future_version_falls_back_to_full(client, make_user):
+    alice = make_user('alice')
+    client.post('/api/notes', json={'content': '笔记'}, headers=alice['headers'])
+    body = client.get('/api/sync?since_version=999', headers=alice['headers']).get_json()
+    assert body['full'] is True and len(body['notes']) == 1
+
+
+@pytest.mark.parametrize('path', ['/api/notes', '/api/vocab', '/api/sync'])
+def test_sync_endpoints_require_login(client, path):
+    assert client.get(path).status_code == 401
+
+
+def test_add_note_requires_content(client, make_user):
+    alice = make_user('alice')
+    assert client.post('/api/notes', json={'content': ''}, headers=alice['headers']).status_code == 400